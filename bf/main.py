@@ -4,14 +4,57 @@ import tarfile
 import json
 import asyncio
 import datetime
+import random
 import re
 import tempfile
 import secrets
-
-from pagermaid.hook import Hook
-from pagermaid.listener import listener
-from pagermaid.enums import Message
-from pagermaid.services import bot, scheduler
+import sqlite3
+import functools
+import hashlib
+import importlib
+import io
+import collections
+import contextlib
+import multiprocessing
+import queue
+import struct
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.request import pathname2url
+
+# 打包进程（forkserver/spawn）会按模块名重新导入本文件来取得工作函数。
+# 子进程里跳过 PagerMaid / Telethon 的导入：工作函数只用标准库，
+# 而导入 pagermaid.services 会在子进程中重建 bot、scheduler 并打开会话数据库。
+_IN_ARCHIVE_WORKER = multiprocessing.parent_process() is not None
+
+if not _IN_ARCHIVE_WORKER:
+    from apscheduler.triggers.base import BaseTrigger
+    from pagermaid.hook import Hook
+    from pagermaid.listener import listener
+    from pagermaid.enums import Message
+    from pagermaid.services import bot, scheduler
+    from pagermaid.utils import pip_install
+    from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+    from telethon.tl.types import InputFile, InputFileBig
+else:
+    # 仅用于让模块级的类定义与装饰器能执行，子进程不会调用这些命令与定时任务
+    BaseTrigger = Message = object
+
+    def _no_register(*_args, **_kwargs):
+        return lambda func: func
+
+    class Hook:
+        load_success = staticmethod(_no_register)
+
+    listener = _no_register
+
+try:
+    import zstandard
+except ImportError:
+    # 可选依赖：选择 zst 编码或恢复 .tar.zst 时再安装
+    zstandard = None
 
 # 统一时区：北京（UTC+8）
 BJ_TZ = datetime.timezone(datetime.timedelta(hours=8), name="UTC+8")
@@ -140,6 +183,159 @@ def set_cron_last_run(ts: str):
     save_config(cfg)
 
 
+def get_cron_mode() -> str:
+    """定时备份模式：full（每次全量）或 inc（增量）"""
+    mode = load_config().get("cron_mode")
+    return mode if mode in ("full", "inc") else "full"
+
+
+def set_cron_mode(mode: str):
+    cfg = load_config()
+    cfg["cron_mode"] = mode
+    save_config(cfg)
+
+
+# 归档内的元数据文件名（写在归档最前面）
+BACKUP_INFO_NAME = "backup_info.json"
+# data/ 下由 bf 自身维护、不应进入备份的文件
+_BF_INTERNAL_DATA_FILES = (
+    "bf_manifest.json",
+    "bf_catalog.json",
+    "bf_bench.jsonl",
+    "_hf_selected_backup.tar.gz",
+)
+# 增量链最大长度（含全量），超过后自动做一次全量
+_INC_MAX_CHAIN_DEFAULT = 48
+
+
+def get_manifest_file():
+    """获取增量备份清单路径"""
+    return os.path.join(get_program_dir(), "data", "bf_manifest.json")
+
+
+def load_manifest():
+    """
+    加载最近一次成功上传的标准/增量备份清单，无则返回 None。
+    结构：{"backup_id", "chain": [全量ID, 增量ID...], "created_at",
+          "files": {归档名: [大小, mtime_ns, sha256]}}
+    """
+    manifest_file = get_manifest_file()
+    if not os.path.exists(manifest_file):
+        return None
+    try:
+        with open(manifest_file, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if isinstance(manifest.get("files"), dict) and manifest.get("chain"):
+            return manifest
+    except Exception:
+        pass
+    return None
+
+
+def save_manifest(backup_id: str, chain: list, files: dict):
+    """在备份上传成功后保存清单，作为下一次增量的基准"""
+    manifest_file = get_manifest_file()
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    manifest = {
+        "backup_id": backup_id,
+        "chain": list(chain) + [backup_id],
+        "created_at": now_bj().isoformat(),
+        "files": files,
+    }
+    tmp_file = f"{manifest_file}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_file, manifest_file)
+
+
+# ==================== 备份目录 ====================
+# 每次上传成功后记录备份所在的消息（聊天 + 消息ID），hf 选择/下载备份时直接按记录取回，
+# 不必在收藏夹或目标聊天中逐条翻找。
+
+_CATALOG_MAX_ENTRIES = 500
+CATALOG_TYPES = {
+    "standard": "标准",
+    "incremental": "增量",
+    "full": "完整",
+    "plugins": "插件",
+    "pre_restore": "恢复前",
+}
+_CATALOG_TYPE_ALIASES = {
+    "std": "standard",
+    "inc": "incremental",
+    "all": "full",
+    "p": "plugins",
+    "pre": "pre_restore",
+}
+
+
+def get_catalog_file():
+    return os.path.join(get_program_dir(), "data", "bf_catalog.json")
+
+
+def load_catalog() -> list:
+    """读取备份目录（按上传时间从旧到新）"""
+    try:
+        with open(get_catalog_file(), "r", encoding="utf-8") as f:
+            entries = json.load(f).get("backups", [])
+        return [e for e in entries if isinstance(e, dict) and e.get("key")]
+    except Exception:
+        return []
+
+
+def record_backup(entry: dict):
+    """追加一条备份记录（同 key 的旧记录会被替换），只保留最近 _CATALOG_MAX_ENTRIES 条"""
+    entries = [e for e in load_catalog() if e.get("key") != entry["key"]]
+    entries.append(entry)
+    entries = entries[-_CATALOG_MAX_ENTRIES:]
+    catalog_file = get_catalog_file()
+    os.makedirs(os.path.dirname(catalog_file), exist_ok=True)
+    tmp_file = f"{catalog_file}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump({"backups": entries}, f, ensure_ascii=False)
+    os.replace(tmp_file, catalog_file)
+
+
+def find_catalog_entry(key: str):
+    """按目录 key（标准/增量备份即备份ID）查找记录"""
+    for entry in reversed(load_catalog()):
+        if entry.get("key") == key or entry.get("backup_id") == key:
+            return entry
+    return None
+
+
+def filter_catalog(backup_type: str | None = None, date_prefix: str | None = None):
+    """按类型与日期前缀（YYYY / YYYY-MM / YYYY-MM-DD）过滤，新的在前"""
+    return [
+        e
+        for e in reversed(load_catalog())
+        if (not backup_type or e.get("type") == backup_type)
+        and (not date_prefix or str(e.get("created_at", "")).startswith(date_prefix))
+    ]
+
+
+def manifest_digest(files: dict) -> str:
+    """文件清单的 sha256，用于核对备份内容"""
+    payload = json.dumps(files, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _catalog_entry(backup_type: str, file_name: str, plan=None, files=None) -> dict:
+    """构造待记录的目录项（上传后由 send_backup_to_targets 补充位置与大小）"""
+    entry = {
+        "key": plan["backup_id"] if plan else secrets.token_hex(4),
+        "type": backup_type,
+        "file_name": file_name,
+        "created_at": now_bj().isoformat(timespec="seconds"),
+    }
+    if plan:
+        entry["backup_id"] = plan["backup_id"]
+        entry["chain"] = plan["chain"]
+    if files is not None:
+        entry["manifest_sha256"] = manifest_digest(files)
+    return entry
+
+
 def _parse_cron_field(field: str, min_v: int, max_v: int):
     """解析单个 cron 字段，返回允许的整数集合。
     支持: "*", "*/n", 具体数字, 逗号列表, 区间a-b, 以及结合步进 a-b/n。
@@ -191,65 +387,175 @@ def _parse_cron_field(field: str, min_v: int, max_v: int):
     return {v for v in values if min_v <= v <= max_v}
 
 
-def _cron_matches(now: datetime.datetime, expr: str) -> bool:
-    """判断当前时间是否匹配5段 cron: m h dom mon dow (标准cron语义)"""
-    try:
-        fields = expr.split()
-        if len(fields) != 5:
-            return False
-        m_set = _parse_cron_field(fields[0], 0, 59)
-        h_set = _parse_cron_field(fields[1], 0, 23)
-        dom_set = _parse_cron_field(fields[2], 1, 31)
-        mon_set = _parse_cron_field(fields[3], 1, 12)
-        dow_set = _parse_cron_field(fields[4], 0, 6)  # 0=周日（cron语义）
+def _cron_bits(field: str, min_v: int, max_v: int) -> int:
+    """把 cron 字段解析为位掩码：第 v 位为 1 表示取值 v 允许"""
+    bits = 0
+    for v in _parse_cron_field(field, min_v, max_v):
+        bits |= 1 << v
+    if not bits:
+        raise ValueError(f"字段 `{field}` 没有可用的取值（范围 {min_v}-{max_v}）")
+    return bits
 
-        # Python: Monday=0..Sunday=6
-        cron_dow = (now.weekday() + 1) % 7  # Monday(0)->1, ..., Sunday(6)->0
 
-        dom_match = now.day in dom_set
-        dow_match = cron_dow in dow_set
+def _next_bit(bits: int, start: int):
+    """返回 >= start 的最小取值，不存在时返回 None"""
+    rest = bits >> start
+    if not rest:
+        return None
+    return start + (rest & -rest).bit_length() - 1
+
 
-        # 标准cron语义：day-of-month 与 day-of-week 之间是 OR 关系
-        if dom_set != set(range(1, 32)) and dow_set != set(range(0, 7)):
-            day_ok = dom_match or dow_match
-        else:
-            day_ok = dom_match and dow_match
+_CRON_ALL_DOM = sum(1 << v for v in range(1, 32))
+_CRON_ALL_DOW = sum(1 << v for v in range(0, 7))
+# 2 月 29 日最长 8 年出现一次（如 2096 -> 2104）
+_CRON_SEARCH_YEARS = 8
+
+
+class CronExpr:
+    """预编译的5段 cron 表达式：m h dom mon dow（标准cron语义）。
+    每个字段解析为位掩码，匹配与计算下次触发时间时按字段跳跃，不再逐分钟搜索。
+    """
+
+    def __init__(self, expr: str):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError("必须为5段，如：* * * * *")
+        self.expr = " ".join(fields)
+        self.minutes = _cron_bits(fields[0], 0, 59)
+        self.hours = _cron_bits(fields[1], 0, 23)
+        self.doms = _cron_bits(fields[2], 1, 31)
+        self.months = _cron_bits(fields[3], 1, 12)
+        self.dows = _cron_bits(fields[4], 0, 6)  # 0=周日（cron语义）
+        # 标准cron语义：day-of-month 与 day-of-week 都受限时是 OR 关系
+        self.day_or = self.doms != _CRON_ALL_DOM and self.dows != _CRON_ALL_DOW
+
+    def day_matches(self, day: datetime.date) -> bool:
+        # Python: Monday=0..Sunday=6
+        cron_dow = (day.weekday() + 1) % 7  # Monday(0)->1, ..., Sunday(6)->0
+        dom_match = bool(self.doms >> day.day & 1)
+        dow_match = bool(self.dows >> cron_dow & 1)
+        return (dom_match or dow_match) if self.day_or else (dom_match and dow_match)
 
+    def matches(self, now: datetime.datetime) -> bool:
         return (
-            (now.minute in m_set)
-            and (now.hour in h_set)
-            and (now.month in mon_set)
-            and day_ok
+            bool(self.minutes >> now.minute & 1)
+            and bool(self.hours >> now.hour & 1)
+            and bool(self.months >> now.month & 1)
+            and self.day_matches(now)
         )
+
+    def next_after(self, base: datetime.datetime):
+        """返回严格晚于 base 的下一次触发时间（保留 base 的时区），找不到时返回 None"""
+        t = base.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit_year = t.year + _CRON_SEARCH_YEARS
+        while t.year <= limit_year:
+            if not self.months >> t.month & 1:
+                # 跳到下一个月的 1 日 00:00
+                year, month = (t.year + 1, 1) if t.month == 12 else (t.year, t.month + 1)
+                t = t.replace(year=year, month=month, day=1, hour=0, minute=0)
+                continue
+            if not self.day_matches(t):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+                continue
+            hour = _next_bit(self.hours, t.hour)
+            if hour is None:
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+                continue
+            if hour != t.hour:
+                t = t.replace(hour=hour, minute=0)
+            minute = _next_bit(self.minutes, t.minute)
+            if minute is None:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+            return t.replace(minute=minute)
+        return None
+
+
+@functools.lru_cache(maxsize=16)
+def compile_cron(expr: str) -> CronExpr:
+    """编译并缓存 cron 表达式，非法时抛出 ValueError"""
+    return CronExpr(expr)
+
+
+def _cron_matches(now: datetime.datetime, expr: str) -> bool:
+    """判断当前时间是否匹配5段 cron: m h dom mon dow (标准cron语义)"""
+    try:
+        return compile_cron(expr).matches(now)
     except Exception:
         return False
 
 
-def get_next_cron_time(
-    expr: str,
-    from_dt: datetime.datetime | None = None,
-    max_minutes: int = 365 * 24 * 60,
-):
-    """估算下次匹配时间（本地时区）。按分钟粒度向前搜索，最多一年。
+def get_next_cron_time(expr: str, from_dt: datetime.datetime | None = None):
+    """计算下次匹配时间（本地时区），不含 from_dt 所在的分钟。
     返回 datetime 或 None。"""
     try:
-        base = from_dt or now_bj()
-        # 从下一分钟开始找，避免当前分钟重复
-        start = base.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
-        for i in range(max_minutes):
-            t = start + datetime.timedelta(minutes=i)
-            if _cron_matches(t, expr):
-                return t
+        return compile_cron(expr).next_after(from_dt or now_bj())
     except Exception:
-        pass
-    return None
+        return None
+
+
+def _plan_standard_backup(incremental: bool):
+    """
+    规划一次标准备份（data + plugins）。
+    incremental=True 时若存在可用清单且链未超长，则做增量，否则退回全量。
+    返回 dict: backup_id / backup_type / chain / base_files / backup_info
+    """
+    backup_id = secrets.token_hex(4)
+    manifest = load_manifest() if incremental else None
+    max_chain = int(load_config().get("inc_max_chain", _INC_MAX_CHAIN_DEFAULT))
+    if manifest and len(manifest["chain"]) < max_chain:
+        backup_type = "incremental"
+        chain = list(manifest["chain"])
+        base_files = manifest["files"]
+    else:
+        backup_type = "standard"
+        chain = []
+        base_files = None
+
+    backup_info = create_backup_info(backup_type)
+    backup_info.update(
+        {
+            "backup_id": backup_id,
+            # 恢复本备份前需要按顺序先恢复的备份（全量在前）
+            "chain": chain,
+            "base_id": chain[0] if chain else backup_id,
+            "parent_id": chain[-1] if chain else None,
+        }
+    )
+    return {
+        "backup_id": backup_id,
+        "backup_type": backup_type,
+        "chain": chain,
+        "base_files": base_files,
+        "backup_info": backup_info,
+    }
+
+
+def _standard_backup_filename(plan: dict, now_str: str, codec: str = "gz") -> str:
+    """备份文件名中带上备份ID，便于恢复增量链时按ID查找"""
+    prefix = "pagermaid_inc" if plan["backup_type"] == "incremental" else "pagermaid_backup"
+    return f"{prefix}_{now_str}_{plan['backup_id']}{_archive_ext(codec)}"
+
+
+def _standard_backup_caption_lines(plan: dict, result: dict) -> str:
+    """标准/增量备份说明中与备份链相关的部分"""
+    text = f"• 备份ID: `{plan['backup_id']}`\n"
+    if plan["backup_type"] == "incremental":
+        text += (
+            f"• 类型: 增量（基于 `{plan['chain'][-1]}`，链长 {len(plan['chain']) + 1}）\n"
+            f"• 变更: {result['archived']} 个文件，删除 {len(result['deleted'])} 个\n"
+        )
+        if result.get("delta"):
+            text += f"• 块级增量: {result['delta']} 个大文件仅上传变化的块\n"
+    return text
 
 
 async def _run_standard_backup_via_client():
     """
     无消息上下文的标准备份：打包 data+plugins（默认排除 session），
     如配置允许（upload_sessions=True）则同时生成 sessions 包。
-    上传逻辑：若存在目标ID且>1，先上传到收藏夹再转发，以节省重复上传。
+    定时模式为 inc 时只打包自上次备份以来变化的文件；没有变化则跳过上传。
+    上传逻辑：只上传一次，再按文件引用发送到所有目标（见 send_backup_to_targets）。
     """
     client = bot
     program_dir = get_program_dir()
@@ -258,87 +564,83 @@ async def _run_standard_backup_via_client():
     # 清理 data/ 下的历史配置快照，仅保留最新一份
     _prune_config_backups(data_dir)
     now_str = now_bj().strftime("%Y%m%d_%H%M%S")
+    plan = _plan_standard_backup(incremental=get_cron_mode() == "inc")
+    codec, codec_level = get_backup_codec()
 
     tmpdir = tempfile.gettempdir()
-    backup_path = os.path.join(tmpdir, f"pagermaid_backup_{now_str}.tar.gz")
+    backup_name = _standard_backup_filename(plan, now_str, codec)
     sessions_path = os.path.join(tmpdir, f"pagermaid_sessions_{now_str}.tar.gz")
 
     # 是否上传 sessions 由配置决定（默认 False）
     cfg = load_config()
     upload_sessions = bool(cfg.get("upload_sessions", False))
 
+    def has_changes(result):
+        # 增量备份自上次以来没有任何变化时不上传
+        return (
+            plan["backup_type"] != "incremental"
+            or result["archived"]
+            or result["deleted"]
+        )
+
     try:
-        # 创建主备份（排除 session 文件）
-        create_data_plugins_backup(
-            backup_path, program_dir=program_dir, exclude_session=True, compresslevel=5
+        # 创建主备份（排除 session 文件），打包进程的输出直接流式上传
+        result, input_file = await stream_archive_upload(
+            client,
+            create_data_plugins_backup,
+            file_name=backup_name,
+            should_upload=has_changes,
+            program_dir=program_dir,
+            exclude_session=True,
+            compresslevel=codec_level or 5,
+            codec=codec,
+            backup_info=plan["backup_info"],
+            base_files=plan["base_files"],
+            sqlite_snapshot=get_sqlite_snapshot(),
+            delta_min_mb=get_delta_min_mb(),
         )
+        if input_file is None:
+            return
 
         # 如需上传 session，则另外创建 sessions 包（但若配置禁止，则跳过）
         sessions_created = None
         if upload_sessions:
-            sessions_created = create_sessions_archive(
-                sessions_path, program_dir=program_dir
+            sessions_created = await run_archive_job(
+                create_sessions_archive, sessions_path, program_dir=program_dir
             )
 
         caption = (
-            f"📦 **Pagermaid定时标准备份**\n\n"
+            f"📦 **Pagermaid定时{'增量' if plan['backup_type'] == 'incremental' else '标准'}备份**\n\n"
             f"• 创建时间: {now_bj().strftime('%Y-%m-%d %H:%M:%S')}\n"
             f"• 包含: data (不含 session) + plugins\n"
+            f"{_standard_backup_caption_lines(plan, result)}"
             f"• 触发: cron 定时任务"
         )
 
+        # 只上传一次，再按文件引用并发发送到各目标；单个目标失败不影响其余目标
         targets = get_target_chat_ids()
-        if targets:
-            # 多目标优化：单目标直接上传，多目标先上传到收藏夹再转发
-            if len(targets) == 1:
-                await client.send_file(int(targets[0]), backup_path, caption=caption)
-                if sessions_created:
-                    await client.send_file(
-                        int(targets[0]),
-                        sessions_created,
-                        caption="🔐 会话（session）备份 — 请妖善保管（敏感）",
-                    )
-            else:
-                # 上传到收藏夹
-                sent_msg = await client.send_file("me", backup_path, caption=caption)
-                for tgt in targets:
-                    try:
-                        await client.forward_messages(int(tgt), sent_msg, "me")
-                    except Exception:
-                        # 若转发失败则退回直接上传
-                        await client.send_file(int(tgt), backup_path, caption=caption)
-                # sessions 如果生成了也同样处理
-                if sessions_created:
-                    sent_s = await client.send_file(
-                        "me",
-                        sessions_created,
-                        caption="🔐 会话（session）备份 — 请妥善保管（敏感）",
-                    )
-                    for tgt in targets:
-                        try:
-                            await client.forward_messages(int(tgt), sent_s, "me")
-                        except Exception:
-                            await client.send_file(
-                                int(tgt),
-                                sessions_created,
-                                caption="🔐 会话（session）备份 — 请妥善保管（敏感）",
-                            )
-        else:
-            # 无目标则发送到收藏夹
-            await client.send_file("me", backup_path, caption=caption)
-            if sessions_created:
-                await client.send_file(
-                    "me",
-                    sessions_created,
-                    caption="🔐 会话（session）备份 — 请妥善保管（敏感）",
-                )
+        _, failed = await send_backup_to_targets(
+            client,
+            input_file,
+            caption,
+            targets,
+            catalog_entry=_catalog_entry(
+                plan["backup_type"], backup_name, plan, result["files"]
+            ),
+        )
+        if sessions_created:
+            await send_backup_to_targets(
+                client,
+                sessions_created,
+                "🔐 会话（session）备份 — 请妥善保管（敏感）",
+                targets,
+            )
+        for tgt, err in failed.items():
+            print(f"[bf] 定时备份发送到 {tgt} 失败: {err}")
+        # 上传成功后才更新清单，保证增量链中的每个备份都已送达
+        save_manifest(plan["backup_id"], plan["chain"], result["files"])
     finally:
         # 清理临时文件
-        try:
-            if os.path.exists(backup_path):
-                os.remove(backup_path)
-        except Exception:
-            pass
         try:
             if os.path.exists(sessions_path):
                 os.remove(sessions_path)
@@ -346,34 +648,63 @@ async def _run_standard_backup_via_client():
             pass
 
 
+class _CronExprTrigger(BaseTrigger):
+    """APScheduler 触发器：用编译后的 CronExpr 计算下次触发时间。
+    任务常驻，备份超时导致的重叠触发只会被跳过一次，不会丢失后续计划。"""
+
+    def __init__(self, expr: str):
+        self.cron = compile_cron(expr)
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        base = previous_fire_time or now
+        return self.cron.next_after(base.astimezone(BJ_TZ))
+
+    def __str__(self):
+        return f"bf_cron[{self.cron.expr}]"
+
+    def __repr__(self):
+        return f"<_CronExprTrigger (expr={self.cron.expr!r})>"
+
+
 async def _cron_loop():
     expr = get_cron_expr()
     if not expr:
         # 未配置
         return
     now = now_bj()
-    if not _cron_matches(now, expr):
-        return
     await _run_standard_backup_via_client()
     # 记录最近一次触发时间
     set_cron_last_run(now.strftime("%Y-%m-%d %H:%M:%S"))
 
 
+def _schedule_next_cron(expr: str):
+    """注册常驻的 cron 任务，返回下次触发时间；表达式非法时返回 None"""
+    try:
+        trigger = _CronExprTrigger(expr)
+    except ValueError:
+        return None
+    job = scheduler.add_job(
+        _cron_loop,
+        trigger,
+        id="bf_cron_task",
+        name="bf_cron_task",
+        replace_existing=True,
+        # 上一次备份仍在运行时跳过本次触发（任务本身保留），积压的触发合并为一次
+        max_instances=1,
+        coalesce=True,
+        misfire_grace_time=300,
+    )
+    return getattr(job, "next_run_time", None)
+
+
 @Hook.load_success()
 async def _restart_cron_task():
-    """在插件加载完成后添加定时任务"""
-    expr = get_cron_expr()
-    if expr and not scheduler.get_job("bf_cron_task"):
-        scheduler.add_job(
-            _cron_loop,
-            "cron",
-            minute="*",
-            id="bf_cron_task",
-            name="bf_cron_task",
-        )
-    elif not expr and scheduler.get_job("bf_cron_task"):
-        # 如果没有配置则移除任务
+    """在插件加载完成或表达式变更后重新安排定时任务（睡到下次触发时间，而不是每分钟轮询）"""
+    if scheduler.get_job("bf_cron_task"):
         scheduler.remove_job("bf_cron_task")
+    expr = get_cron_expr()
+    if expr:
+        _schedule_next_cron(expr)
 
 
 # 目标聊天ID管理（支持多目标）
@@ -427,246 +758,2037 @@ def remove_target_chat_id(id_to_remove):
     return exist
 
 
-def create_tar_gz(
-    source_dirs,
-    output_filename,
-    exclude_dirs=None,
-    exclude_exts=None,
-    max_file_size_mb=None,
-    compresslevel=5,
-):
-    """
-    创建 tar.gz 压缩包，支持排除目录/后缀/大文件，并使用可调压缩级别。
+class BackupCancelled(Exception):
+    """备份任务被用户取消（bf cancel）"""
 
-    exclude_dirs: 目录名黑名单（命中则整目录跳过），如 ['.git', '__pycache__']
-    exclude_exts: 文件后缀黑名单（含点），如 ['.log', '.zip']
-    max_file_size_mb: 跳过大于此大小的单文件（单位MB），None表示不限制
-    compresslevel: gzip压缩等级，1(快/大) - 9(慢/小)，默认5折中
-    """
-    exclude_dirs = set(exclude_dirs or [])
-    exclude_exts = set(exclude_exts or [])
-    size_limit = (max_file_size_mb * 1024 * 1024) if max_file_size_mb else None
 
-    # Python 3.8+ 支持 compresslevel 参数
-    with tarfile.open(output_filename, "w:gz", compresslevel=compresslevel) as tar:
-        for source_dir in source_dirs:
-            if not os.path.exists(source_dir):
-                raise FileNotFoundError(f"{source_dir} 不存在")
+# 打包时单次读取的块大小，兼顾进度粒度与吞吐
+_ARCHIVE_COPY_BUFSIZE = 1024 * 1024
 
-            base_name = os.path.basename(source_dir.rstrip(os.sep))
 
-            # 如果是单个文件，直接添加
-            if os.path.isfile(source_dir):
-                fname = os.path.basename(source_dir)
-                _, ext = os.path.splitext(fname)
-                if ext in exclude_exts:
-                    continue
-                if size_limit is not None:
-                    try:
-                        if os.path.getsize(source_dir) > size_limit:
-                            continue
-                    except Exception:
-                        continue
-                arcname = os.path.join("pagermaid_backup", base_name)
-                tar.add(source_dir, arcname=arcname)
-                continue
+class _ArchiveProgress:
+    """
+    打包进度统计（运行在打包子进程内）。
+    - 节流后把 (已完成文件数, 总文件数, 已完成字节, 总字节) 写入 progress_queue
+    - 同时检查 cancel_event，被置位时抛出 BackupCancelled
+    两者都可为 None（同步调用时不汇报、不可取消）。
+    """
 
-            # 目录则递归遍历
-            for root, dirs, files in os.walk(source_dir):
-                # 过滤目录
-                dirs[:] = [d for d in dirs if d not in exclude_dirs]
+    def __init__(self, progress_queue=None, cancel_event=None, interval=0.5):
+        self.queue = progress_queue
+        self.cancel_event = cancel_event
+        self.interval = interval
+        self.total_files = 0
+        self.total_bytes = 0
+        self.done_files = 0
+        self.done_bytes = 0
+        self._last = 0.0
+
+    def start(self, entries):
+        self.total_files = len(entries)
+        self.total_bytes = sum(size for _, _, size in entries)
+        self._emit(force=True)
+
+    def advance(self, nbytes=0, files=0):
+        self.done_bytes += nbytes
+        self.done_files += files
+        self._emit()
+
+    def finish(self):
+        self._emit(force=True)
+
+    def _emit(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last < self.interval:
+            return
+        self._last = now
+        # 取消标记与进度都走 IPC，一并节流
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise BackupCancelled("备份已取消")
+        if self.queue is not None:
+            try:
+                self.queue.put_nowait(
+                    (self.done_files, self.total_files, self.done_bytes, self.total_bytes)
+                )
+            except Exception:
+                pass
 
-                for fname in files:
-                    fpath = os.path.join(root, fname)
-                    # 过滤后缀
-                    _, ext = os.path.splitext(fname)
-                    if ext in exclude_exts:
-                        continue
-                    # 过滤大文件
-                    if size_limit is not None:
-                        try:
-                            if os.path.getsize(fpath) > size_limit:
-                                continue
-                        except Exception:
-                            continue
-
-                    # 归档名：pagermaid_backup/<source_dir_name>/<relative_path>
-                    rel = os.path.relpath(fpath, source_dir)
-                    # 确保使用相对路径，防止路径穿越
-                    rel = os.path.normpath(rel)
-                    if os.path.isabs(rel) or rel.startswith(".."):
-                        continue  # 跳过危险路径
-                    arcname = os.path.join("pagermaid_backup", base_name, rel)
-                    tar.add(fpath, arcname=arcname)
 
+class _ProgressReader:
+    """
+    包装文件对象，读取时累计进度并顺带计算 sha256（供 tar.addfile 使用）。
+    指定 block_size 时同时计算每个定长块的 sha256（块级增量的索引）。
+    """
 
-def _gather_session_files(data_dir: str):
-    """返回 data 目录下所有 session 相关文件的绝对路径列表"""
-    sessions = []
-    if not os.path.isdir(data_dir):
-        return sessions
-    for root, dirs, files in os.walk(data_dir):
-        for f in files:
-            if f.endswith(".session") or f.endswith(".session-journal"):
-                sessions.append(os.path.join(root, f))
-    return sessions
+    def __init__(self, fileobj, progress: _ArchiveProgress, block_size=None):
+        self.fileobj = fileobj
+        self.progress = progress
+        self.hasher = hashlib.sha256()
+        self.block_size = block_size
+        self.blocks = []
+        self._block = hashlib.sha256()
+        self._block_fill = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        if self.block_size:
+            self._hash_blocks(data)
+        self.progress.advance(len(data))
+        return data
 
+    def _hash_blocks(self, data):
+        view = memoryview(data)
+        pos = 0
+        while pos < len(view):
+            take = min(self.block_size - self._block_fill, len(view) - pos)
+            self._block.update(view[pos : pos + take])
+            self._block_fill += take
+            pos += take
+            if self._block_fill == self.block_size:
+                self.blocks.append(self._block.hexdigest())
+                self._block = hashlib.sha256()
+                self._block_fill = 0
+
+    def block_digests(self) -> list:
+        if self._block_fill:
+            self.blocks.append(self._block.hexdigest())
+            self._block = hashlib.sha256()
+            self._block_fill = 0
+        return self.blocks
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
 
-def create_data_plugins_backup(
-    output_filename: str,
-    program_dir: str | None = None,
-    exclude_session: bool = True,
-    compresslevel: int = 5,
-    archive_root: str = "pagermaid_backup",
-):
+
+def _add_tar_entry(tar, fpath, arcname, progress: _ArchiveProgress, block_size=None):
     """
-    只打包 program_dir 下的 data 与 plugins（可选择排除 session 文件）。
-    - output_filename: 完整路径
-    - exclude_session: True 则跳过 *.session / *.session-journal
-    - archive_root: 压缩包内的根目录名（默认 pagermaid_backup）
+    向归档添加单个文件；文件在打包过程中消失时静默跳过。
+    普通文件返回清单记录 [大小, mtime_ns, sha256]，其余返回 None。
+    指定 block_size 时记录末尾追加定长块的 sha256 列表，供下次做块级增量。
     """
-    program_dir = program_dir or get_program_dir()
-    data_dir = os.path.join(program_dir, "data")
-    plugins_dir = os.path.join(program_dir, "plugins")
+    try:
+        st = os.lstat(fpath)
+        tarinfo = tar.gettarinfo(fpath, arcname=arcname)
+    except OSError:
+        return None
+    if tarinfo is None:
+        # socket 等无法归档的类型
+        return None
+    record = None
+    if tarinfo.isreg():
+        with open(fpath, "rb") as f:
+            reader = _ProgressReader(f, progress, block_size)
+            tar.addfile(tarinfo, reader)
+        record = [tarinfo.size, st.st_mtime_ns, reader.hasher.hexdigest()]
+        if block_size:
+            record.append(reader.block_digests())
+    else:
+        tar.addfile(tarinfo)
+    progress.advance(files=1)
+    return record
 
-    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
 
-    # 使用 explicit walk 以便精确控制哪些文件会被加入
-    with tarfile.open(output_filename, "w:gz", compresslevel=compresslevel) as tar:
+# ==================== 块级增量 ====================
+# 大文件（如数百 MB 的数据库、缓存）按定长块切分，清单中记录每块的 sha256。
+# 增量备份时只打包基准中不存在的块（<root>/.bfdelta/<sha256>），
+# 并在归档末尾写入 recipes.json 描述如何用旧文件中的块与新块拼出新文件。
+
+_DELTA_DIR = ".bfdelta"
+_DELTA_RECIPES = "recipes.json"
+_DELTA_BLOCK_SIZE = 128 * 1024
+_DELTA_MIN_MB_DEFAULT = 32
+_SHA256_HEX_RE = re.compile(r"^[0-9a-f]{64}$")
 
-        def _add_tree(src_dir):
-            if not os.path.isdir(src_dir):
-                return
-            for root, dirs, files in os.walk(src_dir):
-                # 排除 __pycache__ 等临时目录
-                dirs[:] = [d for d in dirs if d != "__pycache__"]
-                for fname in files:
-                    if exclude_session and (
-                        fname.endswith(".session") or fname.endswith(".session-journal")
-                    ):
-                        continue
-                    full = os.path.join(root, fname)
-                    # 归档内路径：以 program_dir 为基准 => pagermaid_backup/<relative_path>
-                    rel = os.path.relpath(full, program_dir)
-                    # 防止路径穿越与绝对路径：rel 不应以 .. 开头
-                    if rel.startswith(".."):
-                        continue
-                    arcname = os.path.join(archive_root, rel) if archive_root else rel
-                    tar.add(full, arcname=arcname)
 
-        # 先添加 plugins，再添加 data（顺序无关）
-        _add_tree(plugins_dir)
-        _add_tree(data_dir)
+def get_delta_min_mb() -> int:
+    """达到此大小（MB）的文件做块级增量，0 表示关闭"""
+    try:
+        return max(0, int(load_config().get("delta_min_mb", _DELTA_MIN_MB_DEFAULT)))
+    except (TypeError, ValueError):
+        return _DELTA_MIN_MB_DEFAULT
 
 
-def create_sessions_archive(output_filename: str, program_dir: str | None = None):
+def _add_delta_entry(tar, fpath, arcname, base_blocks, emitted, delta_root, progress):
     """
-    将 data 下的 session 文件（*.session, *.session-journal）打包为单独的 archive。
-    若不存在 session 文件，返回 None；否则返回 output_filename。
+    以块级增量的方式添加大文件：逐块计算 sha256，只把 base_blocks 与本归档中
+    都没有的块写成 <delta_root>/<sha256> 成员。
+    返回 (清单记录, 拼装说明)；文件消失时返回 (None, None)。
     """
-    program_dir = program_dir or get_program_dir()
-    data_dir = os.path.join(program_dir, "data")
-    sessions = _gather_session_files(data_dir)
-    if not sessions:
-        return None
+    try:
+        st = os.stat(fpath)
+        f = open(fpath, "rb")
+    except OSError:
+        return None, None
+    hasher = hashlib.sha256()
+    blocks = []
+    size = 0
+    with f:
+        while True:
+            data = f.read(_DELTA_BLOCK_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+            digest = hashlib.sha256(data).hexdigest()
+            blocks.append(digest)
+            size += len(data)
+            if digest not in base_blocks and digest not in emitted:
+                tarinfo = tarfile.TarInfo(f"{delta_root}/{digest}")
+                tarinfo.size = len(data)
+                tarinfo.mtime = int(st.st_mtime)
+                tarinfo.mode = 0o600
+                tar.addfile(tarinfo, io.BytesIO(data))
+                emitted.add(digest)
+            progress.advance(len(data))
+    progress.advance(files=1)
+    sha = hasher.hexdigest()
+    record = [size, st.st_mtime_ns, sha, blocks]
+    recipe = {
+        "size": size,
+        "sha256": sha,
+        "mtime": int(st.st_mtime),
+        "block_size": _DELTA_BLOCK_SIZE,
+        "blocks": blocks,
+    }
+    return record, recipe
+
+
+def _add_json_member(tar, arcname, payload):
+    """把 JSON 元数据直接写入归档（不落临时文件）"""
+    data = json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8")
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.size = len(data)
+    tarinfo.mtime = int(time.time())
+    tarinfo.mode = 0o600
+    tar.addfile(tarinfo, io.BytesIO(data))
+
+
+# 压缩编码：
+# - gz : 标准单线程 gzip（默认，兼容性最好）
+# - pgz: 分块并行 gzip，输出为标准 gzip（与 pigz 相同的格式），解压无需任何依赖
+# - zst: 多线程 zstd（需要 zstandard），速度与压缩率均优于 gzip
+BACKUP_CODECS = {
+    "gz": {"ext": ".tar.gz", "levels": (1, 9), "desc": "gzip 单线程"},
+    "pgz": {"ext": ".tar.gz", "levels": (1, 9), "desc": "gzip 多线程（pigz 兼容）"},
+    "zst": {"ext": ".tar.zst", "levels": (1, 19), "desc": "zstd 多线程"},
+}
+_PGZ_BLOCK_SIZE = 1024 * 1024
+# deflate 回溯窗口大小，pgz 以上一块末尾作为下一块的预设字典
+_DEFLATE_WINDOW = 32 * 1024
+
+
+def _require_zstandard():
+    """按需导入 zstandard，缺失时自动安装"""
+    global zstandard
+    if zstandard is None:
+        try:
+            zstandard = importlib.import_module("zstandard")
+        except ModuleNotFoundError:
+            pip_install("zstandard")
+            importlib.invalidate_caches()
+            zstandard = importlib.import_module("zstandard")
+    return zstandard
 
-    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
-    with tarfile.open(output_filename, "w:gz") as tar:
-        for fpath in sessions:
-            # arcname 放到 sessions/<relative_path_from_data>
-            rel = os.path.relpath(fpath, data_dir)
-            if rel.startswith(".."):
-                # 防护：不接受 data 目录外的文件
-                continue
-            arcname = os.path.join("sessions", rel)
-            tar.add(fpath, arcname=arcname)
-    return output_filename
 
+def get_backup_codec():
+    """返回 (编码, 压缩等级或 None)，None 表示使用各备份模式的默认等级"""
+    cfg = load_config()
+    codec = cfg.get("codec")
+    if codec not in BACKUP_CODECS:
+        return "gz", None
+    level = cfg.get("codec_level")
+    return codec, level if isinstance(level, int) else None
 
-def _prune_config_backups(data_dir: str, keep_count: int = 1):
-    """清理 data/ 下的历史配置快照，仅保留最新一份"""
-    try:
-        # 这里可以添加具体的清理逻辑，比如删除旧的配置备份文件
-        # 目前为空实现，可根据实际需要添加
-        pass
-    except Exception:
-        pass
 
+def set_backup_codec(codec: str, level: int | None):
+    cfg = load_config()
+    cfg["codec"] = codec
+    if level is None:
+        cfg.pop("codec_level", None)
+    else:
+        cfg["codec_level"] = level
+    save_config(cfg)
 
-def delete_specific_files_from_backup(backup_file, temp_dir, files_to_delete):
-    with tarfile.open(backup_file, "r:gz") as tar:
-        tar.extractall(path=temp_dir)
-    for root, dirs, files in os.walk(temp_dir):
-        for file_name in files:
-            if file_name in files_to_delete:
-                file_path = os.path.join(root, file_name)
-                os.remove(file_path)
-    new_backup_file = backup_file.replace(".tar.gz", "_modified.tar.gz")
-    with tarfile.open(new_backup_file, "w:gz") as tar:
-        tar.add(temp_dir, arcname="pagermaid_backup")
-    return new_backup_file
 
+def _archive_ext(codec: str) -> str:
+    return BACKUP_CODECS.get(codec, BACKUP_CODECS["gz"])["ext"]
 
-def safe_extract(tar, path="."):
-    """严格的安全解压函数，防止路径穿越攻击"""
-    abs_path = os.path.abspath(path)
 
-    for member in tar.getmembers():
-        # 规范化路径
-        member_path = os.path.normpath(member.name)
+def _is_backup_filename(name) -> bool:
+    return bool(name) and name.endswith(
+        tuple({c["ext"] for c in BACKUP_CODECS.values()} | {_VOLUME_INDEX_SUFFIX})
+    )
 
-        # 检查绝对路径
-        if os.path.isabs(member_path):
-            raise Exception(f"检测到绝对路径，拒绝解压: {member.name}")
 
-        # 检查路径穿越
-        full_path = os.path.abspath(os.path.join(path, member_path))
-        if not full_path.startswith(abs_path + os.sep) and full_path != abs_path:
-            raise Exception(f"路径穿越检测到，终止恢复: {member.name}")
+# ==================== 分卷 ====================
+# 超过分卷大小的备份拆成若干独立文件（<name>.001、<name>.002 …）并发上传，
+# 最后发送分卷索引 <name>.bfvol.json（各卷名称、大小与 sha256）。
+# 恢复时索引下载到原本的归档路径，各卷下载到 <路径>.001 …，读取时按顺序拼接。
+
+_VOLUME_INDEX_FORMAT = "bfvol"
+_VOLUME_INDEX_SUFFIX = ".bfvol.json"
+_VOLUME_MB_DEFAULT = 1536
+_VOLUME_MB_MIN = 64
+# 非会员账号单文件上限 2000 MB（4000 个 512 KB 分片），超过会在上传时失败
+_VOLUME_MB_MAX = 2000
 
-        # 检查允许的目录（白名单）
-        allowed_dirs = ["plugins", "data", "pagermaid_backup"]
-        path_parts = member_path.split(os.sep)
-        if path_parts and path_parts[0] not in allowed_dirs:
-            raise Exception(f"不允许的目录路径: {member.name}")
 
-    # 所有检查通过，执行解压
-    tar.extractall(path)
+def get_volume_size_mb() -> int:
+    """分卷大小（MB）"""
+    try:
+        size = int(load_config().get("volume_mb", _VOLUME_MB_DEFAULT))
+    except (TypeError, ValueError):
+        return _VOLUME_MB_DEFAULT
+    return min(max(size, _VOLUME_MB_MIN), _VOLUME_MB_MAX)
 
 
-def un_tar_gz(filename, dirs):
-    """安全解压 .tar.gz 到指定目录，避免路径穿越"""
+def read_volume_index(filename: str):
+    """filename 为分卷索引时返回索引内容，否则返回 None"""
     try:
-        with tarfile.open(filename, "r:gz") as tar:
-            safe_extract(tar, dirs)
-        return True
-    except Exception as e:
-        print(f"解压失败: {e}")
-        return False
+        with open(filename, "rb") as f:
+            if f.read(1) != b"{":
+                return None
+            f.seek(0)
+            index = json.loads(f.read().decode("utf-8"))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(index, dict) or index.get("format") != _VOLUME_INDEX_FORMAT:
+        return None
+    return index
 
 
-def sanitize_filename(filename):
-    """清理文件名，确保安全"""
-    # 移除或替换危险字符
-    safe_name = re.sub(r"[^a-zA-Z0-9_.-]", "_", filename)
-    # 限制长度
-    if len(safe_name) > 100:
-        safe_name = safe_name[:100]
-    return safe_name
+def _volume_paths(filename: str, index: dict) -> list:
+    return [f"{filename}.{i:03d}" for i in range(1, len(index["volumes"]) + 1)]
 
 
-def generate_smart_package_name(backup_type="backup"):
-    """AI智能生成包名"""
-    # 获取当前时间信息
-    now = now_bj()
-    timestamp = now.strftime("%Y%m%d_%H%M%S")
+def remove_backup_file(filename: str):
+    """删除本地备份文件；分卷索引连同已下载的各卷一起删除"""
+    index = read_volume_index(filename)
+    paths = _volume_paths(filename, index) if index else []
+    for path in paths + [filename]:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
 
-    # 根据备份类型生成前缀
-    if backup_type == "plugins":
-        prefix = "bf_p"
-    elif backup_type == "data":
-        prefix = "bf_d"
-    elif backup_type == "full":
+
+class _ConcatReader(io.RawIOBase):
+    """把多个分卷文件按顺序拼接成一个只读流"""
+
+    def __init__(self, paths):
+        self._paths = list(paths)
+        self._current = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            if self._current is None:
+                if not self._paths:
+                    return 0
+                self._current = open(self._paths.pop(0), "rb")
+            n = self._current.readinto(b)
+            if n:
+                return n
+            self._current.close()
+            self._current = None
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        super().close()
+
+
+def _deflate_block(block: bytes, zdict: bytes, level: int, last: bool) -> bytes:
+    """独立压缩一个数据块为 raw deflate；非末块以 Z_SYNC_FLUSH 字节对齐，便于直接拼接"""
+    if zdict:
+        comp = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, zdict
+        )
+    else:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    out = comp.compress(block)
+    out += comp.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return out
+
+
+class _ParallelGzipWriter:
+    """
+    分块并行 gzip 写入器（pigz 算法）：
+    数据按块切分，在线程池中各自压缩（zlib 压缩时释放 GIL），以上一块末尾 32KB 作为字典
+    保持压缩率；按顺序拼接成单个标准 gzip 成员，CRC32 在写入线程顺序累计。
+    """
+
+    def __init__(self, fileobj, compresslevel=5, block_size=_PGZ_BLOCK_SIZE, threads=None):
+        self.fileobj = fileobj
+        self.level = compresslevel
+        self.block_size = block_size
+        threads = threads or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        # 限制在途块数量，内存占用约为 2 * threads * block_size
+        self.max_pending = threads * 2
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.prev_tail = b""
+        self.crc = 0
+        self.size = 0
+        # gzip 头：magic, CM=deflate, FLG=0, MTIME, XFL=0, OS=255(unknown)
+        self.fileobj.write(struct.pack("<4sIBB", b"\x1f\x8b\x08\x00", int(time.time()), 0, 255))
+
+    def write(self, data) -> int:
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[: self.block_size])
+            del self.buffer[: self.block_size]
+            self._submit(block, last=False)
+        return len(data)
+
+    def _submit(self, block: bytes, last: bool):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(
+            self.pool.submit(_deflate_block, block, self.prev_tail, self.level, last)
+        )
+        self.prev_tail = block[-_DEFLATE_WINDOW:]
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        try:
+            self._submit(bytes(self.buffer), last=True)
+            self.buffer.clear()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            self.fileobj.write(struct.pack("<II", self.crc & 0xFFFFFFFF, self.size & 0xFFFFFFFF))
+        finally:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+@contextlib.contextmanager
+def _open_tar_writer(target, codec="gz", compresslevel=5):
+    """
+    打开用于写入的 tar 归档。target 为文件路径或可写文件对象。
+    gz 走 tarfile 自带实现；pgz/zst 以流模式（w|）写入外部压缩器。
+    """
+    if codec == "gz":
+        kwargs = {"fileobj": target} if not isinstance(target, str) else {"name": target}
+        with tarfile.open(
+            mode="w:gz",
+            compresslevel=compresslevel,
+            copybufsize=_ARCHIVE_COPY_BUFSIZE,
+            **kwargs,
+        ) as tar:
+            yield tar
+        return
+
+    with contextlib.ExitStack() as stack:
+        raw = stack.enter_context(open(target, "wb")) if isinstance(target, str) else target
+        if codec == "pgz":
+            stream = _ParallelGzipWriter(raw, compresslevel)
+            # 打包失败或取消时 close() 不会执行，这里确保线程池被关闭、排队的压缩块被取消
+            stack.callback(stream.pool.shutdown, wait=False, cancel_futures=True)
+        elif codec == "zst":
+            cctx = _require_zstandard().ZstdCompressor(level=compresslevel, threads=-1)
+            stream = cctx.stream_writer(raw)
+        elif codec == "tar":
+            stream = raw
+        else:
+            raise ValueError(f"未知的压缩编码: {codec}")
+        with tarfile.open(
+            fileobj=stream,
+            mode="w|",
+            bufsize=_ARCHIVE_COPY_BUFSIZE,
+            copybufsize=_ARCHIVE_COPY_BUFSIZE,
+        ) as tar:
+            yield tar
+        if codec == "pgz":
+            stream.close()
+        elif codec == "zst":
+            stream.flush(zstandard.FLUSH_FRAME)
+
+
+def _detect_codec(filename: str) -> str:
+    """根据文件头识别压缩编码（gzip / zstd / 未压缩 tar）"""
+    with open(filename, "rb") as f:
+        magic = f.read(4)
+    if magic[:2] == b"\x1f\x8b":
+        return "gz"
+    if magic == b"\x28\xb5\x2f\xfd":
+        return "zst"
+    return "tar"
+
+
+@contextlib.contextmanager
+def open_backup_archive(filename: str):
+    """
+    以流模式打开备份归档，自动识别 gz/pgz/zst。
+    流模式只能顺序遍历成员（for member in tar），不能 getmembers 后回头读取。
+    filename 为分卷索引时按顺序读取同目录下已下载的各卷。
+    """
+    index = read_volume_index(filename)
+    if index is not None:
+        paths = _volume_paths(filename, index)
+        codec = _detect_codec(paths[0])
+        raw_file = io.BufferedReader(_ConcatReader(paths), _ARCHIVE_COPY_BUFSIZE)
+    else:
+        codec = _detect_codec(filename)
+        raw_file = open(filename, "rb")
+    with raw_file as raw:
+        if codec == "zst":
+            stream = _require_zstandard().ZstdDecompressor().stream_reader(raw)
+            mode = "r|"
+        elif codec == "gz":
+            stream, mode = raw, "r|gz"
+        else:
+            stream, mode = raw, "r|"
+        with tarfile.open(fileobj=stream, mode=mode, bufsize=_ARCHIVE_COPY_BUFSIZE) as tar:
+            yield tar
+
+
+def _write_tar_entries(
+    output_filename,
+    entries,
+    compresslevel=5,
+    progress_queue=None,
+    cancel_event=None,
+    backup_info=None,
+    codec="gz",
+    delta_min_size=None,
+    delta_entries=None,
+    delta_root=None,
+):
+    """
+    将 entries [(绝对路径, 归档名, 大小), ...] 写入压缩归档（编码见 BACKUP_CODECS）。
+    - backup_info: 若提供，作为 backup_info.json 写在归档最前面，恢复时可先读到
+    - delta_min_size: 不小于此字节数的文件在清单中记录块索引（供下次块级增量）
+    - delta_entries: [(绝对路径, 归档名, 大小, 基准块列表), ...]，以块级增量写入
+      delta_root 目录，拼装说明写在归档末尾的 <delta_root>/recipes.json
+    返回本次写入的文件清单 {归档名: [大小, mtime_ns, sha256(, 块列表)]}。
+    被取消时删除不完整的输出文件并抛出 BackupCancelled。
+    """
+    delta_entries = delta_entries or []
+    progress = _ArchiveProgress(progress_queue, cancel_event)
+    progress.start(list(entries) + [entry[:3] for entry in delta_entries])
+    files = {}
+    try:
+        with _open_tar_writer(output_filename, codec, compresslevel) as tar:
+            if backup_info is not None:
+                _add_json_member(tar, BACKUP_INFO_NAME, backup_info)
+            for fpath, arcname, size in entries:
+                block_size = (
+                    _DELTA_BLOCK_SIZE
+                    if delta_min_size and size >= delta_min_size
+                    else None
+                )
+                record = _add_tar_entry(tar, fpath, arcname, progress, block_size)
+                if record is not None:
+                    files[arcname] = record
+            recipes, emitted = {}, set()
+            for fpath, arcname, _, base_blocks in delta_entries:
+                record, recipe = _add_delta_entry(
+                    tar, fpath, arcname, set(base_blocks), emitted, delta_root, progress
+                )
+                if record is not None:
+                    files[arcname] = record
+                    recipes[arcname] = recipe
+            if recipes:
+                _add_json_member(tar, f"{delta_root}/{_DELTA_RECIPES}", recipes)
+        progress.finish()
+        return files
+    except BaseException:
+        try:
+            if isinstance(output_filename, str) and os.path.exists(output_filename):
+                os.remove(output_filename)
+        except Exception:
+            pass
+        raise
+
+
+def _collect_tar_gz_entries(
+    source_dirs,
+    exclude_dirs=None,
+    exclude_exts=None,
+    max_file_size_mb=None,
+):
+    """按 create_tar_gz 的规则遍历 source_dirs，返回待打包条目列表"""
+    exclude_dirs = set(exclude_dirs or [])
+    exclude_exts = set(exclude_exts or [])
+    size_limit = (max_file_size_mb * 1024 * 1024) if max_file_size_mb else None
+    entries = []
+
+    for source_dir in source_dirs:
+        if not os.path.exists(source_dir):
+            raise FileNotFoundError(f"{source_dir} 不存在")
+
+        base_name = os.path.basename(source_dir.rstrip(os.sep))
+
+        # 如果是单个文件，直接添加
+        if os.path.isfile(source_dir):
+            fname = os.path.basename(source_dir)
+            _, ext = os.path.splitext(fname)
+            if ext in exclude_exts:
+                continue
+            size = _file_size(source_dir)
+            if size_limit is not None and size > size_limit:
+                continue
+            arcname = os.path.join("pagermaid_backup", base_name)
+            entries.append((source_dir, arcname, size))
+            continue
+
+        # 目录则递归遍历
+        for root, dirs, files in os.walk(source_dir):
+            # 过滤目录
+            dirs[:] = [d for d in dirs if d not in exclude_dirs]
+
+            for fname in files:
+                fpath = os.path.join(root, fname)
+                # 过滤后缀
+                _, ext = os.path.splitext(fname)
+                if ext in exclude_exts:
+                    continue
+                # 过滤大文件
+                size = _file_size(fpath)
+                if size_limit is not None and size > size_limit:
+                    continue
+
+                # 归档名：pagermaid_backup/<source_dir_name>/<relative_path>
+                rel = os.path.relpath(fpath, source_dir)
+                # 确保使用相对路径，防止路径穿越
+                rel = os.path.normpath(rel)
+                if os.path.isabs(rel) or rel.startswith(".."):
+                    continue  # 跳过危险路径
+                arcname = os.path.join("pagermaid_backup", base_name, rel)
+                entries.append((fpath, arcname, size))
+    return entries
+
+
+def create_tar_gz(
+    source_dirs,
+    output_filename,
+    exclude_dirs=None,
+    exclude_exts=None,
+    max_file_size_mb=None,
+    compresslevel=5,
+    progress_queue=None,
+    cancel_event=None,
+    codec="gz",
+):
+    """
+    创建 tar.gz 压缩包，支持排除目录/后缀/大文件，并使用可调压缩级别。
+
+    exclude_dirs: 目录名黑名单（命中则整目录跳过），如 ['.git', '__pycache__']
+    exclude_exts: 文件后缀黑名单（含点），如 ['.log', '.zip']
+    max_file_size_mb: 跳过大于此大小的单文件（单位MB），None表示不限制
+    compresslevel: gzip压缩等级，1(快/大) - 9(慢/小)，默认5折中
+    progress_queue / cancel_event: 由 run_archive_job 传入，用于进度汇报与取消
+    codec: 压缩编码（gz / pgz / zst），见 BACKUP_CODECS
+    """
+    entries = _collect_tar_gz_entries(
+        source_dirs,
+        exclude_dirs=exclude_dirs,
+        exclude_exts=exclude_exts,
+        max_file_size_mb=max_file_size_mb,
+    )
+    _write_tar_entries(
+        output_filename,
+        entries,
+        compresslevel=compresslevel,
+        progress_queue=progress_queue,
+        cancel_event=cancel_event,
+        codec=codec,
+    )
+    return output_filename
+
+
+def _gather_session_files(data_dir: str):
+    """返回 data 目录下所有 session 相关文件的绝对路径列表"""
+    sessions = []
+    if not os.path.isdir(data_dir):
+        return sessions
+    for root, dirs, files in os.walk(data_dir):
+        for f in files:
+            if f.endswith(".session") or f.endswith(".session-journal"):
+                sessions.append(os.path.join(root, f))
+    return sessions
+
+
+def _collect_data_plugins_entries(
+    program_dir: str,
+    exclude_session: bool = True,
+    archive_root: str = "pagermaid_backup",
+):
+    """按 create_data_plugins_backup 的规则遍历 plugins 与 data，返回待打包条目列表"""
+    entries = []
+    internal = {
+        os.path.normpath(os.path.join(program_dir, "data", name))
+        for name in _BF_INTERNAL_DATA_FILES
+    }
+
+    def _add_tree(src_dir):
+        if not os.path.isdir(src_dir):
+            return
+        for root, dirs, files in os.walk(src_dir):
+            # 排除 __pycache__ 等临时目录
+            dirs[:] = [d for d in dirs if d != "__pycache__"]
+            for fname in files:
+                if exclude_session and (
+                    fname.endswith(".session") or fname.endswith(".session-journal")
+                ):
+                    continue
+                full = os.path.join(root, fname)
+                # bf 自身的状态文件（增量清单、预下载的备份及其分卷等）不进入备份
+                if re.sub(r"\.\d{3}$", "", os.path.normpath(full)) in internal:
+                    continue
+                # 归档内路径：以 program_dir 为基准 => pagermaid_backup/<relative_path>
+                rel = os.path.relpath(full, program_dir)
+                # 防止路径穿越与绝对路径：rel 不应以 .. 开头
+                if rel.startswith(".."):
+                    continue
+                arcname = os.path.join(archive_root, rel) if archive_root else rel
+                entries.append((full, arcname, _file_size(full)))
+
+    # 先添加 plugins，再添加 data（顺序无关）
+    _add_tree(os.path.join(program_dir, "plugins"))
+    _add_tree(os.path.join(program_dir, "data"))
+    return entries
+
+
+def _hash_file(fpath, progress: _ArchiveProgress | None = None):
+    """计算文件 sha256（分块读取，可被取消）"""
+    hasher = hashlib.sha256()
+    with open(fpath, "rb") as f:
+        while True:
+            chunk = f.read(_ARCHIVE_COPY_BUFSIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if progress is not None:
+                progress.advance(0)
+    return hasher.hexdigest()
+
+
+def _diff_entries_against_manifest(entries, base_files, progress=None):
+    """
+    对比当前文件与上次清单，返回 (需要打包的条目, 未变化文件的清单记录, 已删除的归档名列表)。
+    大小与 mtime 一致视为未变化；否则计算 sha256，内容相同（仅 touch）也视为未变化。
+    """
+    changed, unchanged = [], {}
+    seen = set()
+    for fpath, arcname, size in entries:
+        seen.add(arcname)
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            continue
+        old = base_files.get(arcname)
+        if old and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+            unchanged[arcname] = old
+            continue
+        if old and old[0] == st.st_size:
+            try:
+                digest = _hash_file(fpath, progress)
+            except OSError:
+                continue
+            if digest == old[2]:
+                unchanged[arcname] = [st.st_size, st.st_mtime_ns, digest] + old[3:]
+                continue
+        changed.append((fpath, arcname, size))
+    deleted = sorted(name for name in base_files if name not in seen)
+    return changed, unchanged, deleted
+
+
+# ==================== SQLite 在线快照 ====================
+# 直接打包正在写入的 .db 可能得到撕裂的镜像；开启后改用 sqlite3 在线备份 API
+# 先生成一致的快照再打包（归档名不变），数据库的 -wal/-shm/-journal 旁文件不再打包。
+
+_SQLITE_HEADER = b"SQLite format 3\x00"
+_SQLITE_SIDE_SUFFIXES = ("-wal", "-shm", "-journal")
+_SQLITE_BACKUP_PAGES = 1024  # 每步复制的页数，步间释放源库的读锁
+_SQLITE_BACKUP_SLEEP = 0.01  # 步间让出的时间（秒），给写入方提交的机会
+_SQLITE_MAX_RESTARTS = 3
+
+
+def get_sqlite_snapshot() -> bool:
+    """是否对 data/ 中的 SQLite 数据库做在线快照（手动与定时备份共用）"""
+    return bool(load_config().get("sqlite_snapshot", False))
+
+
+def set_sqlite_snapshot(enabled: bool):
+    cfg = load_config()
+    cfg["sqlite_snapshot"] = bool(enabled)
+    save_config(cfg)
+
+
+def _is_sqlite_file(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(_SQLITE_HEADER)) == _SQLITE_HEADER
+    except OSError:
+        return False
+
+
+class _SnapshotRestarted(Exception):
+    """分步复制期间源库被反复修改"""
+
+
+def _is_wal_database(path: str) -> bool:
+    """文件头第 18/19 字节为 2 表示 WAL 模式"""
+    try:
+        with open(path, "rb") as f:
+            header = f.read(20)
+        return len(header) == 20 and header[18] == 2 and header[19] == 2
+    except OSError:
+        return False
+
+
+def _snapshot_sqlite(src_path: str, dst_path: str, progress=None):
+    """
+    用 sqlite3 在线备份 API 把 src_path 复制为一致的数据库镜像 dst_path。
+    - WAL 模式：读事务不阻塞写入方，一步完成复制
+    - 回滚日志模式：按 _SQLITE_BACKUP_PAGES 分步复制，步间释放读锁，写入方可以提交；
+      源库被其他连接修改时 sqlite 会重新开始复制，反复重来超过 _SQLITE_MAX_RESTARTS 次
+      则退回一步复制（只在复制期间短暂持有读锁）
+    结果总是源库某一时刻的完整镜像。
+    """
+    uri = "file:" + pathname2url(os.path.abspath(src_path)) + "?mode=ro"
+    pages = -1 if _is_wal_database(src_path) else _SQLITE_BACKUP_PAGES
+    src = sqlite3.connect(uri, uri=True, timeout=30)
+    try:
+        while True:
+            dst = sqlite3.connect(dst_path)
+            state = {"remaining": None, "restarts": 0}
+
+            def _step(status, remaining, total):
+                if progress is not None:
+                    # 顺带检查取消
+                    progress.advance()
+                last = state["remaining"]
+                if last is not None and remaining > last:
+                    state["restarts"] += 1
+                    if state["restarts"] > _SQLITE_MAX_RESTARTS:
+                        raise _SnapshotRestarted()
+                state["remaining"] = remaining
+
+            try:
+                src.backup(
+                    dst, pages=pages, progress=_step, sleep=_SQLITE_BACKUP_SLEEP
+                )
+                return
+            except _SnapshotRestarted:
+                pages = -1
+            finally:
+                dst.close()
+    finally:
+        src.close()
+
+
+def _snapshot_sqlite_entries(entries, snapshot_dir: str, progress=None):
+    """
+    把 entries 中的 SQLite 数据库替换为 snapshot_dir 中的快照（归档名不变），
+    并去掉这些数据库的 -wal/-shm/-journal 旁文件。快照失败时退回按普通文件打包。
+    """
+    snapshots = {}
+    for fpath, _, size in entries:
+        if size < 512 or fpath.endswith(_SQLITE_SIDE_SUFFIXES):
+            continue
+        if not _is_sqlite_file(fpath):
+            continue
+        snap = os.path.join(snapshot_dir, f"{len(snapshots)}.db")
+        try:
+            _snapshot_sqlite(fpath, snap, progress)
+        except BackupCancelled:
+            raise
+        except Exception as e:
+            print(f"[bf] SQLite 快照失败，按普通文件打包: {fpath}: {e}")
+            continue
+        snapshots[fpath] = snap
+
+    result = []
+    for fpath, arcname, size in entries:
+        if fpath in snapshots:
+            snap = snapshots[fpath]
+            result.append((snap, arcname, _file_size(snap)))
+            continue
+        side_of = next(
+            (fpath[: -len(s)] for s in _SQLITE_SIDE_SUFFIXES if fpath.endswith(s)),
+            None,
+        )
+        if side_of in snapshots:
+            continue
+        result.append((fpath, arcname, size))
+    return result
+
+
+def create_data_plugins_backup(
+    output_filename: str,
+    program_dir: str | None = None,
+    exclude_session: bool = True,
+    compresslevel: int = 5,
+    archive_root: str = "pagermaid_backup",
+    progress_queue=None,
+    cancel_event=None,
+    backup_info: dict | None = None,
+    base_files: dict | None = None,
+    codec: str = "gz",
+    sqlite_snapshot: bool = False,
+    delta_min_mb: int = 0,
+):
+    """
+    只打包 program_dir 下的 data 与 plugins（可选择排除 session 文件）。
+    - output_filename: 完整路径，或可写文件对象（流式上传时）
+    - exclude_session: True 则跳过 *.session / *.session-journal
+    - archive_root: 压缩包内的根目录名（默认 pagermaid_backup）
+    - backup_info: 写入归档的元数据（backup_info.json）
+    - base_files: 上次备份的文件清单；提供时只打包新增/修改的文件（增量），
+      已删除的文件记录在 backup_info["deleted"] 中
+    - codec: 压缩编码（gz / pgz / zst）
+    - sqlite_snapshot: True 则 SQLite 数据库以在线快照的形式打包（见 _snapshot_sqlite）
+    - delta_min_mb: 不小于此大小的文件记录块索引；增量备份时这些文件只打包变化的块
+
+    返回 {"files": 当前完整清单, "archived": 本次打包文件数, "deleted": [...],
+    "delta": 以块级增量打包的文件数}。
+    """
+    program_dir = program_dir or get_program_dir()
+
+    if isinstance(output_filename, str):
+        os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+
+    # 使用 explicit walk 以便精确控制哪些文件会被加入
+    entries = _collect_data_plugins_entries(
+        program_dir, exclude_session=exclude_session, archive_root=archive_root
+    )
+    progress = _ArchiveProgress(None, cancel_event)
+    snapshot_dir = None
+    try:
+        if sqlite_snapshot:
+            snapshot_dir = tempfile.mkdtemp(prefix="bf_sqlite_")
+            entries = _snapshot_sqlite_entries(entries, snapshot_dir, progress)
+        unchanged, deleted = {}, []
+        if base_files is not None:
+            # 快照内容不变时哈希一致，增量备份同样会跳过
+            entries, unchanged, deleted = _diff_entries_against_manifest(
+                entries, base_files, progress
+            )
+        delta_min_size = delta_min_mb * 1024 * 1024 if delta_min_mb else None
+        delta_entries = []
+        if base_files is not None and delta_min_size:
+            # 基准中带块索引的大文件只打包变化的块
+            full_entries = []
+            for fpath, arcname, size in entries:
+                old = base_files.get(arcname)
+                if size >= delta_min_size and old and len(old) > 3:
+                    delta_entries.append((fpath, arcname, size, old[3]))
+                else:
+                    full_entries.append((fpath, arcname, size))
+            entries = full_entries
+        if backup_info is not None:
+            backup_info = dict(backup_info, deleted=deleted)
+        written = _write_tar_entries(
+            output_filename,
+            entries,
+            compresslevel=compresslevel,
+            progress_queue=progress_queue,
+            cancel_event=cancel_event,
+            backup_info=backup_info,
+            codec=codec,
+            delta_min_size=delta_min_size,
+            delta_entries=delta_entries,
+            delta_root=f"{archive_root}/{_DELTA_DIR}" if archive_root else _DELTA_DIR,
+        )
+    finally:
+        if snapshot_dir is not None:
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+    unchanged.update(written)
+    return {
+        "files": unchanged,
+        "archived": len(written),
+        "deleted": deleted,
+        "delta": len(delta_entries),
+    }
+
+
+def create_sessions_archive(
+    output_filename: str,
+    program_dir: str | None = None,
+    progress_queue=None,
+    cancel_event=None,
+):
+    """
+    将 data 下的 session 文件（*.session, *.session-journal）打包为单独的 archive。
+    若不存在 session 文件，返回 None；否则返回 output_filename。
+    """
+    program_dir = program_dir or get_program_dir()
+    data_dir = os.path.join(program_dir, "data")
+    sessions = _gather_session_files(data_dir)
+    if not sessions:
+        return None
+
+    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+    entries = []
+    for fpath in sessions:
+        # arcname 放到 sessions/<relative_path_from_data>
+        rel = os.path.relpath(fpath, data_dir)
+        if rel.startswith(".."):
+            # 防护：不接受 data 目录外的文件
+            continue
+        entries.append((fpath, os.path.join("sessions", rel), _file_size(fpath)))
+    _write_tar_entries(
+        output_filename,
+        entries,
+        compresslevel=9,
+        progress_queue=progress_queue,
+        cancel_event=cancel_event,
+    )
+    return output_filename
+
+
+class _CountingSink:
+    """只统计写入字节数、不落盘的输出（用于压缩基准测试）"""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data) -> int:
+        self.bytes += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def _zstandard_available() -> bool:
+    """zstandard 是否已安装（不触发自动安装）"""
+    if zstandard is not None:
+        return True
+    try:
+        importlib.import_module("zstandard")
+        return True
+    except ImportError:
+        return False
+
+
+def benchmark_codecs(
+    source_dirs,
+    codecs=None,
+    compresslevel=None,
+    progress_queue=None,
+    cancel_event=None,
+):
+    """
+    在真实目录上测试各压缩编码的吞吐与压缩率（输出只计数不落盘）。
+    先以未压缩 tar 跑一遍作为基准（同时预热页缓存），再依次测试各编码。
+    返回 [{"codec", "level", "seconds", "input_bytes", "output_bytes"}, ...]
+    """
+    entries = _collect_tar_gz_entries([d for d in source_dirs if os.path.exists(d)])
+    if codecs is None:
+        codecs = ["gz", "pgz"] + (["zst"] if _zstandard_available() else [])
+    input_bytes = sum(size for _, _, size in entries)
+    results = []
+    for codec in ["tar"] + list(codecs):
+        level = 0 if codec == "tar" else (compresslevel or 5)
+        sink = _CountingSink()
+        started = time.perf_counter()
+        _write_tar_entries(
+            sink,
+            entries,
+            compresslevel=level,
+            progress_queue=progress_queue,
+            cancel_event=cancel_event,
+            codec=codec,
+        )
+        results.append(
+            {
+                "codec": codec,
+                "level": level,
+                "seconds": round(time.perf_counter() - started, 3),
+                "input_bytes": input_bytes,
+                "output_bytes": sink.bytes,
+            }
+        )
+    return results
+
+
+def format_codec_benchmark(results) -> str:
+    """把 benchmark_codecs 的结果整理为消息文本（压缩率相对未压缩 tar）"""
+    if not results:
+        return "没有可测试的数据"
+    tar_size = results[0]["output_bytes"] or 1
+    lines = [
+        f"📊 压缩基准（{results[0]['input_bytes'] / 1024 / 1024:.1f} MB，"
+        f"CPU {os.cpu_count() or 1} 核）\n"
+    ]
+    for r in results:
+        speed = r["input_bytes"] / 1024 / 1024 / r["seconds"] if r["seconds"] else 0
+        name = r["codec"] if r["codec"] == "tar" else f"{r['codec']} L{r['level']}"
+        lines.append(
+            f"• `{name}`: {speed:.1f} MB/s，{r['output_bytes'] / 1024 / 1024:.1f} MB，"
+            f"压缩率 {r['output_bytes'] / tar_size:.1%}"
+        )
+    return "\n".join(lines)
+
+
+# ==================== 基准测试 ====================
+# 生成可调文件数量与大小分布的合成目录（data/ + plugins/），
+# 依次计时 walk / tar / compress / extract / restore 各阶段，结果为可直接比对的 JSON。
+
+BENCH_PROFILES = {
+    "small": "512B-32KB 小文件",
+    "mixed": "80% 小文件 + 17% 64KB-1MB + 3% 4-16MB",
+    "large": "4-32MB 大文件",
+}
+_BENCH_FILES_DEFAULT = 2000
+_BENCH_FILES_MAX = 100000
+_BENCH_TEXT_POOL = 4 * 1024 * 1024
+
+
+def get_bench_history_file():
+    return os.path.join(get_program_dir(), "data", "bf_bench.jsonl")
+
+
+def _bench_file_size(rng, profile: str) -> int:
+    if profile == "small":
+        return rng.randint(512, 32 * 1024)
+    if profile == "large":
+        return rng.randint(4 * 1024 * 1024, 32 * 1024 * 1024)
+    r = rng.random()
+    if r < 0.80:
+        return rng.randint(512, 32 * 1024)
+    if r < 0.97:
+        return rng.randint(64 * 1024, 1024 * 1024)
+    return rng.randint(4 * 1024 * 1024, 16 * 1024 * 1024)
+
+
+def _bench_text_pool(rng) -> bytes:
+    """可压缩的类文本数据（随机单词组成的 JSON 行），供合成文件切片使用"""
+    words = [
+        "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 9)))
+        for _ in range(2000)
+    ]
+    parts = []
+    size = 0
+    while size < _BENCH_TEXT_POOL:
+        line = " ".join(rng.choice(words) for _ in range(12))
+        line = f'{{"id": {rng.randint(0, 10**9)}, "text": "{line}"}}\n'
+        parts.append(line)
+        size += len(line)
+    return "".join(parts).encode()[:_BENCH_TEXT_POOL]
+
+
+def generate_bench_tree(
+    root: str,
+    file_count: int,
+    profile: str = "mixed",
+    compressible: float = 0.6,
+    seed: int = 0,
+):
+    """
+    在 root 下生成合成的 data/ 与 plugins/ 目录，相同参数生成的内容完全相同。
+    compressible 为类文本（可压缩）文件的比例，其余为随机字节。
+    返回 (文件数, 总字节数)
+    """
+    rng = random.Random(seed)
+    pool = _bench_text_pool(rng)
+    total = 0
+    for i in range(file_count):
+        if i % 10 == 0:
+            rel = os.path.join("plugins", f"plugin_{i // 10 % 64}", f"main_{i}.py")
+        else:
+            rel = os.path.join("data", f"d{i % 32:02d}", f"s{i % 7}", f"f{i}.bin")
+        path = os.path.join(root, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = _bench_file_size(rng, profile)
+        with open(path, "wb") as f:
+            if rng.random() < compressible:
+                remaining = size
+                while remaining:
+                    start = rng.randrange(len(pool))
+                    piece = pool[start : start + remaining]
+                    f.write(piece)
+                    remaining -= len(piece)
+            else:
+                f.write(rng.randbytes(size))
+        total += size
+    return file_count, total
+
+
+def benchmark_pipeline(
+    file_count: int = _BENCH_FILES_DEFAULT,
+    profile: str = "mixed",
+    codec: str = "gz",
+    compresslevel=None,
+    compressible: float = 0.6,
+    seed: int = 0,
+    work_dir=None,
+    progress_queue=None,
+    cancel_event=None,
+):
+    """
+    在合成目录上测试备份/恢复的各个阶段：
+    - walk: 遍历目录（_collect_data_plugins_entries）
+    - tar: 未压缩 tar，输出只计数（纯打包开销）
+    - compress: create_data_plugins_backup 按指定编码写出归档
+    - extract: un_tar_gz 完整解压到空目录
+    - restore: restore_backup_archive 恢复到空目录（hf 的写入路径）
+    - restore_unchanged: 再次恢复到同一目录（全部文件未变化被跳过）
+    返回 {"params", "tree", "archive_bytes", "stages": [{"stage", "seconds", "bytes", "mb_s"}], ...}
+    """
+    level = compresslevel or 5
+    root = tempfile.mkdtemp(prefix="bf_bench_", dir=work_dir)
+    try:
+        src = os.path.join(root, "src")
+        started = time.perf_counter()
+        files, total = generate_bench_tree(src, file_count, profile, compressible, seed)
+        generate_seconds = time.perf_counter() - started
+        archive = os.path.join(root, "bench" + _archive_ext(codec))
+        stages = []
+
+        def timed(stage, func, *args, **kwargs):
+            if cancel_event is not None and cancel_event.is_set():
+                raise BackupCancelled("打包已取消")
+            begin = time.perf_counter()
+            result = func(*args, **kwargs)
+            seconds = time.perf_counter() - begin
+            stages.append(
+                {
+                    "stage": stage,
+                    "seconds": round(seconds, 4),
+                    "bytes": total,
+                    "mb_s": round(total / 1024 / 1024 / seconds, 2) if seconds else None,
+                }
+            )
+            return result
+
+        entries = timed("walk", _collect_data_plugins_entries, src)
+        timed(
+            "tar",
+            _write_tar_entries,
+            _CountingSink(),
+            entries,
+            compresslevel=0,
+            progress_queue=progress_queue,
+            cancel_event=cancel_event,
+            codec="tar",
+        )
+        timed(
+            "compress",
+            create_data_plugins_backup,
+            archive,
+            program_dir=src,
+            compresslevel=level,
+            codec=codec,
+            progress_queue=progress_queue,
+            cancel_event=cancel_event,
+        )
+        if not timed("extract", un_tar_gz, archive, os.path.join(root, "extract")):
+            raise Exception("解压失败")
+        restore_dir = os.path.join(root, "restore")
+        os.makedirs(restore_dir)
+        for stage in ("restore", "restore_unchanged"):
+            timed(
+                stage,
+                restore_backup_archive,
+                archive,
+                restore_dir,
+                progress_queue=progress_queue,
+                cancel_event=cancel_event,
+            )
+        return {
+            "version": 1,
+            "created_at": now_bj().strftime("%Y-%m-%d %H:%M:%S"),
+            "cpu_count": os.cpu_count() or 1,
+            "params": {
+                "files": file_count,
+                "profile": profile,
+                "codec": codec,
+                "level": level,
+                "compressible": compressible,
+                "seed": seed,
+            },
+            "tree": {
+                "files": files,
+                "bytes": total,
+                "generate_seconds": round(generate_seconds, 4),
+            },
+            "archive_bytes": os.path.getsize(archive),
+            "stages": stages,
+        }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def format_pipeline_benchmark(result) -> str:
+    """把 benchmark_pipeline 的结果整理为消息文本，末尾附单行 JSON 便于复制比对"""
+    params = result["params"]
+    tree = result["tree"]
+    lines = [
+        f"⏱️ 备份流程基准（{tree['files']} 个文件，{tree['bytes'] / 1024 / 1024:.1f} MB，"
+        f"{params['profile']}，`{params['codec']}` L{params['level']}，"
+        f"CPU {result['cpu_count']} 核）\n"
+    ]
+    for stage in result["stages"]:
+        speed = f"{stage['mb_s']:.1f} MB/s" if stage["mb_s"] else "-"
+        lines.append(f"• `{stage['stage']}`: {stage['seconds']:.3f}s，{speed}")
+    ratio = result["archive_bytes"] / tree["bytes"] if tree["bytes"] else 0
+    lines.append(
+        f"\n归档：{result['archive_bytes'] / 1024 / 1024:.1f} MB（{ratio:.1%}）"
+    )
+    lines.append(
+        f"```\n{json.dumps(result, ensure_ascii=False, separators=(',', ':'))}\n```"
+    )
+    return "\n".join(lines)
+
+
+# 打包子进程池：tar+gzip 属于 CPU/IO 密集操作，放到独立进程中执行，
+# 避免阻塞事件循环导致整个 userbot 失去响应
+_ARCHIVE_POOL = None
+_ARCHIVE_MANAGER = None
+# 运行中的打包任务：job_id -> cancel_event
+_ACTIVE_ARCHIVE_JOBS = {}
+
+
+def _get_mp_context():
+    """优先使用 forkserver，不支持时退回 spawn。
+    主进程是多线程的（asyncio、Telethon、线程池、sqlite），直接 fork 可能继承被其他线程持有的锁而死锁；
+    工作函数都是接收普通参数的模块级函数，子进程导入本模块时跳过 PagerMaid 相关导入（见 _IN_ARCHIVE_WORKER）。"""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _get_archive_pool():
+    global _ARCHIVE_POOL
+    if _ARCHIVE_POOL is None:
+        _ARCHIVE_POOL = ProcessPoolExecutor(max_workers=2, mp_context=_get_mp_context())
+    return _ARCHIVE_POOL
+
+
+def _get_archive_manager():
+    """Manager 提供可跨进程传递的 Queue/Event 代理"""
+    global _ARCHIVE_MANAGER
+    if _ARCHIVE_MANAGER is None:
+        _ARCHIVE_MANAGER = _get_mp_context().Manager()
+    return _ARCHIVE_MANAGER
+
+
+def _reset_archive_pool():
+    global _ARCHIVE_POOL
+    pool, _ARCHIVE_POOL = _ARCHIVE_POOL, None
+    if pool is not None:
+        try:
+            pool.shutdown(wait=False, cancel_futures=True)
+        except Exception:
+            pass
+
+
+def cancel_archive_jobs() -> int:
+    """请求取消所有运行中的打包任务，返回受影响的任务数"""
+    count = 0
+    for cancel_event in list(_ACTIVE_ARCHIVE_JOBS.values()):
+        try:
+            cancel_event.set()
+            count += 1
+        except Exception:
+            pass
+    return count
+
+
+def _format_archive_progress(
+    label, done_files, total_files, done_bytes, total_bytes, extra=""
+):
+    pct = int(done_bytes * 100 / total_bytes) if total_bytes else 100
+    return (
+        f"{label}... {pct}%\n\n"
+        f"• 文件: {done_files}/{total_files}\n"
+        f"• 数据: {done_bytes / 1024 / 1024:.1f}/{total_bytes / 1024 / 1024:.1f} MB\n"
+        f"{extra}\n"
+        "发送 `bf cancel` 可取消"
+    )
+
+
+async def _watch_archive_progress(
+    progress_queue, message, label, interval=3.0, status_fn=None
+):
+    """
+    轮询进度队列，节流编辑进度消息（避免触发 FloodWait）
+    - status_fn: 可选，返回附加在进度后的状态行（如已上传字节数）
+    """
+    last_text = None
+    while True:
+        await asyncio.sleep(interval)
+        latest = None
+        try:
+            while True:
+                latest = progress_queue.get_nowait()
+        except Exception:
+            pass
+        if latest is None:
+            continue
+        extra = status_fn() if status_fn is not None else ""
+        text = _format_archive_progress(label, *latest, extra=extra)
+        if text == last_text:
+            continue
+        last_text = text
+        try:
+            await message.edit(text)
+        except Exception:
+            pass
+
+
+async def run_archive_job(
+    func,
+    *args,
+    message=None,
+    label="📦 正在打包",
+    cancel_event=None,
+    status_fn=None,
+    **kwargs,
+):
+    """
+    在打包进程池中执行 create_tar_gz / create_data_plugins_backup /
+    create_sessions_archive 等函数，期间事件循环保持响应。
+    - message: 若提供，则定期把打包进度编辑到该消息
+    - cancel_event: 可选，由调用方提供的取消事件（需为 manager.Event）
+    - status_fn: 可选，进度消息的附加状态行
+    - 可通过 `bf cancel` 取消，取消时抛出 BackupCancelled
+    """
+    loop = asyncio.get_running_loop()
+    manager = _get_archive_manager()
+    progress_queue = manager.Queue()
+    if cancel_event is None:
+        cancel_event = manager.Event()
+    job_id = secrets.token_hex(4)
+    _ACTIVE_ARCHIVE_JOBS[job_id] = cancel_event
+
+    call = functools.partial(
+        func, *args, progress_queue=progress_queue, cancel_event=cancel_event, **kwargs
+    )
+    watcher = None
+    if message is not None:
+        watcher = asyncio.create_task(
+            _watch_archive_progress(
+                progress_queue, message, label, status_fn=status_fn
+            )
+        )
+    try:
+        return await loop.run_in_executor(_get_archive_pool(), call)
+    except BrokenProcessPool:
+        _reset_archive_pool()
+        raise Exception("打包进程异常退出，请重试")
+    except asyncio.CancelledError:
+        cancel_event.set()
+        raise
+    finally:
+        _ACTIVE_ARCHIVE_JOBS.pop(job_id, None)
+        if watcher is not None:
+            watcher.cancel()
+
+
+# ==================== 流式上传 ====================
+# 打包进程的压缩输出按上传分片大小切块，经有界队列交给主进程，
+# 主进程边收边调用 upload.saveBigFilePart 上传，全程不落盘、内存占用有上限。
+
+_UPLOAD_PART_SIZE = 512 * 1024  # Telegram 允许的最大分片
+_SMALL_FILE_PARTS = 20  # 不超过 10MB 时走普通上传（saveFilePart）
+_STREAM_QUEUE_CHUNKS = 8  # 跨进程队列上限，打包快于上传时自动阻塞
+_UPLOAD_WORKERS = 4  # 并发上传的分片数
+_UPLOAD_RETRIES = 3
+
+
+class _QueueWriter:
+    """打包进程内的输出端：按分片大小切块后放入跨进程队列（队列满时阻塞，形成背压）"""
+
+    def __init__(self, chunk_queue, cancel_event=None, chunk_size=_UPLOAD_PART_SIZE):
+        self.chunk_queue = chunk_queue
+        self.cancel_event = cancel_event
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.bytes = 0
+        self.closed = False
+
+    def _put(self, item):
+        while True:
+            try:
+                self.chunk_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                    raise BackupCancelled()
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.bytes += len(data)
+        while len(self.buffer) >= self.chunk_size:
+            self._put(bytes(self.buffer[: self.chunk_size]))
+            del self.buffer[: self.chunk_size]
+        return len(data)
+
+    def tell(self) -> int:
+        return self.bytes
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """写出剩余数据并放入结束标记"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.buffer:
+            self._put(bytes(self.buffer))
+            self.buffer.clear()
+        self._put(None)
+
+    def abort(self):
+        """失败时尽力放入结束标记，让上传端退出等待"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.chunk_queue.put(None, timeout=1)
+        except Exception:
+            pass
+
+
+def _run_streaming_job(
+    func, chunk_queue, *args, progress_queue=None, cancel_event=None, **kwargs
+):
+    """在打包进程中执行 func，输出写入 _QueueWriter 而不是文件"""
+    writer = _QueueWriter(chunk_queue, cancel_event)
+    try:
+        result = func(
+            *args,
+            output_filename=writer,
+            progress_queue=progress_queue,
+            cancel_event=cancel_event,
+            **kwargs,
+        )
+        writer.close()
+    finally:
+        writer.abort()
+    # create_tar_gz 返回输出目标本身，不需要跨进程传回
+    return None if result is writer else result
+
+
+async def _save_file_part(client, file_id, index, data, total=None):
+    """上传单个分片；total 为 None 时走小文件接口，-1 表示流式上传中的未知总数"""
+    if total is None:
+        request = SaveFilePartRequest(file_id, index, data)
+    else:
+        request = SaveBigFilePartRequest(file_id, index, total, data)
+    for attempt in range(_UPLOAD_RETRIES):
+        try:
+            if await client(request):
+                return
+        except Exception:
+            if attempt == _UPLOAD_RETRIES - 1:
+                raise
+        await asyncio.sleep(1 + attempt)
+    raise Exception(f"分片 {index} 上传失败")
+
+
+async def _upload_chunk_stream(
+    client,
+    chunk_queue,
+    file_name,
+    job,
+    status,
+    should_upload=None,
+    volume_size=None,
+):
+    """
+    从队列读取分片并上传，返回可直接用于 send_file 的 InputFile / InputFileBig。
+    总大小不超过 10MB 时缓存在内存中，结束后按普通文件上传；
+    超过后切换为流式大文件上传：除最后一片外 file_total_parts 均为 -1，
+    最后一片在其余分片完成后带上真实总数发送。
+    指定 volume_size 且数据超过该大小时按分卷上传（每卷是独立的文件），返回分卷列表
+    [{"file": InputFileBig, "name": "<file_name>.001", "size": 字节数, "sha256": ...}, ...]。
+    打包失败时（job 抛出异常）或 should_upload 返回 False 时不会提交最后一片，
+    返回 None，已上传的分片由服务端自动丢弃。
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(_UPLOAD_WORKERS)
+    inflight = set()
+    errors = []  # 分片上传的异常；完成的任务会立即移出 inflight，失败必须在这里记录
+    buffered = []
+    pending = None
+    big = False
+    volume_parts = (
+        max(volume_size // _UPLOAD_PART_SIZE, _SMALL_FILE_PARTS + 1)
+        if volume_size
+        else None
+    )
+    volumes = []
+
+    def new_volume():
+        return {
+            "file_id": secrets.randbits(63),
+            "parts": 0,
+            "size": 0,
+            "hasher": hashlib.sha256(),
+        }
+
+    current = new_volume()
+
+    async def next_chunk():
+        while True:
+            try:
+                return await loop.run_in_executor(
+                    None, functools.partial(chunk_queue.get, timeout=1)
+                )
+            except queue.Empty:
+                if job.done():
+                    return None
+
+    async def upload(file_id, index, data, total):
+        try:
+            await _save_file_part(client, file_id, index, data, total)
+            status["uploaded"] += len(data)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            semaphore.release()
+
+    def raise_if_failed():
+        if errors:
+            raise errors[0]
+
+    async def dispatch(file_id, index, data, total):
+        await semaphore.acquire()
+        if errors:
+            # 提前暴露失败，避免继续读取无用的数据
+            semaphore.release()
+            raise_if_failed()
+        task = asyncio.create_task(upload(file_id, index, data, total))
+        inflight.add(task)
+        task.add_done_callback(inflight.discard)
+
+    async def drain():
+        if inflight:
+            await asyncio.gather(*list(inflight))
+        raise_if_failed()
+
+    async def push(data, last=False):
+        """把一片数据作为当前分卷的下一片上传；last 时在其余分片完成后带上总数提交"""
+        index = current["parts"]
+        current["parts"] += 1
+        current["size"] += len(data)
+        current["hasher"].update(data)
+        if not last:
+            await dispatch(current["file_id"], index, data, -1)
+            return
+        await drain()
+        await semaphore.acquire()
+        await upload(current["file_id"], index, data, index + 1)
+        raise_if_failed()
+        volumes.append(current)
+
+    try:
+        while True:
+            chunk = await next_chunk()
+            if chunk is None:
+                break
+            if pending is not None:
+                if big:
+                    if volume_parts and current["parts"] == volume_parts - 1:
+                        # 当前分卷已满：提交并开始下一卷
+                        await push(pending, last=True)
+                        current = new_volume()
+                    else:
+                        await push(pending)
+                else:
+                    buffered.append(pending)
+                    if len(buffered) >= _SMALL_FILE_PARTS:
+                        big = True
+                        for data in buffered:
+                            await push(data)
+                        buffered = []
+            pending = chunk
+
+        # 打包成功后才提交最后一片
+        result = await job
+        if should_upload is not None and not should_upload(result):
+            return None
+        if pending is None:
+            raise Exception("打包结果为空")
+        if big:
+            await push(pending, last=True)
+            if len(volumes) == 1:
+                return InputFileBig(current["file_id"], current["parts"], file_name)
+            return [
+                {
+                    "file": InputFileBig(
+                        vol["file_id"], vol["parts"], f"{file_name}.{idx:03d}"
+                    ),
+                    "name": f"{file_name}.{idx:03d}",
+                    "size": vol["size"],
+                    "sha256": vol["hasher"].hexdigest(),
+                }
+                for idx, vol in enumerate(volumes, 1)
+            ]
+
+        buffered.append(pending)
+        md5 = hashlib.md5()
+        for index, data in enumerate(buffered):
+            md5.update(data)
+            await dispatch(current["file_id"], index, data, None)
+        await drain()
+        return InputFile(current["file_id"], len(buffered), file_name, md5.hexdigest())
+    finally:
+        for task in inflight:
+            task.cancel()
+
+
+async def stream_archive_upload(
+    client,
+    func,
+    *args,
+    file_name,
+    message=None,
+    label="📦 正在打包并上传",
+    should_upload=None,
+    volume_size=None,
+    **kwargs,
+):
+    """
+    打包与上传同时进行：func（create_tar_gz / create_data_plugins_backup）在打包进程中
+    把压缩数据写入有界队列，主进程边读边上传，不在磁盘上生成完整的备份文件。
+    - file_name: 上传后在 Telegram 中显示的文件名
+    - should_upload: 可选，接收打包结果，返回 False 时放弃本次上传（如无变化的增量备份）
+    - volume_size: 分卷大小（字节），默认取配置 `bf volume`；超过时按分卷上传
+    返回 (打包结果, InputFile / 分卷列表 / None)，可直接交给 send_backup_to_targets。
+    打包或上传任一失败都会取消另一方并抛出异常。
+    """
+    manager = _get_archive_manager()
+    chunk_queue = manager.Queue(maxsize=_STREAM_QUEUE_CHUNKS)
+    cancel_event = manager.Event()
+    status = {"uploaded": 0}
+
+    def status_line():
+        return f"• 已上传: {status['uploaded'] / 1024 / 1024:.1f} MB\n"
+
+    job = asyncio.ensure_future(
+        run_archive_job(
+            _run_streaming_job,
+            func,
+            chunk_queue,
+            *args,
+            message=message,
+            label=label,
+            cancel_event=cancel_event,
+            status_fn=status_line,
+            **kwargs,
+        )
+    )
+    try:
+        input_file = await _upload_chunk_stream(
+            client,
+            chunk_queue,
+            file_name,
+            job,
+            status,
+            should_upload,
+            volume_size or get_volume_size_mb() * 1024 * 1024,
+        )
+    except BaseException:
+        cancel_event.set()
+        if not job.done():
+            with contextlib.suppress(BaseException):
+                await job
+        raise
+    return job.result(), input_file
+
+
+_FANOUT_CONCURRENCY = 5
+_VOLUME_CONCURRENCY = 3
+
+
+def _as_peer(target):
+    """目标ID（字符串）转为 send_file 可用的 peer；"me" 表示收藏夹"""
+    return target if target == "me" else int(target)
+
+
+async def _send_to_destinations(client, file, caption, destinations):
+    """
+    依次尝试目标直到有一个发送成功（即完成上传），之后其余目标并发地
+    使用该消息中的 document 发送，单个目标失败不会触发重新上传。
+    返回 (成功的目标列表, {失败的目标: 错误信息}, {目标: 消息})；全部失败时抛出异常。
+    """
+    delivered, failed = [], {}
+    media = None
+    remaining = []
+    sent_messages = {}
+    for idx, tgt in enumerate(destinations):
+        try:
+            sent = await client.send_file(
+                _as_peer(tgt), file, caption=caption, force_document=True
+            )
+        except Exception as e:
+            failed[tgt] = str(e)
+            continue
+        delivered.append(tgt)
+        sent_messages[tgt] = sent
+        media = sent.media
+        remaining = destinations[idx + 1 :]
+        break
+    if media is None:
+        raise Exception(
+            "上传失败: " + "; ".join(f"{t}: {err}" for t, err in failed.items())
+        )
+
+    semaphore = asyncio.Semaphore(_FANOUT_CONCURRENCY)
+
+    async def send_by_reference(tgt):
+        async with semaphore:
+            return await client.send_file(
+                _as_peer(tgt), media, caption=caption, force_document=True
+            )
+
+    results = await asyncio.gather(
+        *(send_by_reference(tgt) for tgt in remaining), return_exceptions=True
+    )
+    for tgt, res in zip(remaining, results):
+        if isinstance(res, BaseException):
+            failed[tgt] = str(res)
+        else:
+            delivered.append(tgt)
+            sent_messages[tgt] = res
+    # 保持与目标列表一致的顺序
+    delivered.sort(key=destinations.index)
+    return delivered, failed, sent_messages
+
+
+async def _send_volumes(client, volumes, caption, destinations):
+    """
+    发送分卷备份：各分卷（分片已在流式上传时完成）并发提交到所有目标，
+    全部成功的目标再收到带说明文字的分卷索引（<name>.bfvol.json）。
+    返回值同 _send_to_destinations，另附索引内容。
+    """
+    total = len(volumes)
+    semaphore = asyncio.Semaphore(_VOLUME_CONCURRENCY)
+
+    async def send_volume(idx, vol):
+        async with semaphore:
+            return await _send_to_destinations(
+                client,
+                vol["file"],
+                f"📦 分卷 {idx}/{total}: `{vol['name']}`",
+                destinations,
+            )
+
+    results = await asyncio.gather(
+        *(send_volume(idx, vol) for idx, vol in enumerate(volumes, 1))
+    )
+    failed = {}
+    for _, vol_failed, _ in results:
+        for tgt, err in vol_failed.items():
+            failed.setdefault(tgt, err)
+    complete = [t for t in destinations if t not in failed]
+    if not complete:
+        raise Exception(
+            "分卷上传失败: " + "; ".join(f"{t}: {err}" for t, err in failed.items())
+        )
+
+    name = volumes[0]["name"].rsplit(".", 1)[0]
+    # 各目标中分卷消息的 ID（按分卷顺序），恢复时直接按 ID 取回，不必在聊天记录中查找
+    messages = {}
+    for tgt in complete:
+        sent = [vol_sent[tgt] for _, _, vol_sent in results]
+        messages[str(sent[0].chat_id)] = [msg.id for msg in sent]
+    index = {
+        "format": _VOLUME_INDEX_FORMAT,
+        "version": 1,
+        "name": name,
+        "total_size": sum(vol["size"] for vol in volumes),
+        "volumes": [
+            {"name": vol["name"], "size": vol["size"], "sha256": vol["sha256"]}
+            for vol in volumes
+        ],
+        "messages": messages,
+    }
+    index_file = io.BytesIO(json.dumps(index, ensure_ascii=False, indent=2).encode())
+    index_file.name = name + _VOLUME_INDEX_SUFFIX
+    delivered, index_failed, sent_messages = await _send_to_destinations(
+        client, index_file, caption, complete
+    )
+    failed.update(index_failed)
+    return delivered, failed, sent_messages, index
+
+
+async def send_backup_to_targets(
+    client, file, caption, targets=None, catalog_entry=None
+):
+    """
+    所有备份路径共用的发送逻辑：文件只上传一次，再按文件引用发送到其余目标。
+    - file: stream_archive_upload 得到的 InputFile 或分卷列表，或本地文件路径
+    - targets: 目标ID列表，为空时发送到收藏夹
+    - catalog_entry: 若提供（见 _catalog_entry），发送后连同消息位置记入备份目录
+    分卷备份先并发发送各分卷，再发送分卷索引，说明文字附在索引上。
+    返回 (成功的目标列表, {失败的目标: 错误信息})；全部失败时抛出异常。
+    """
+    destinations = list(targets) if targets else ["me"]
+    index = None
+    if isinstance(file, list):
+        delivered, failed, sent_messages, index = await _send_volumes(
+            client, file, caption, destinations
+        )
+    else:
+        delivered, failed, sent_messages = await _send_to_destinations(
+            client, file, caption, destinations
+        )
+    if catalog_entry is not None:
+        if index is not None:
+            size = index["total_size"]
+        else:
+            size = getattr(getattr(sent_messages[delivered[0]], "file", None), "size", None)
+        entry = dict(
+            catalog_entry,
+            size=size,
+            locations=[
+                {"chat": tgt, "message_id": sent_messages[tgt].id} for tgt in delivered
+            ],
+        )
+        if index is not None:
+            entry["volumes"] = index["volumes"]
+        try:
+            record_backup(entry)
+        except Exception as e:
+            print(f"[bf] 写入备份目录失败: {e}")
+    return delivered, failed
+
+
+def _format_delivery(delivered, failed) -> str:
+    """生成完成消息中的发送结果行"""
+    if delivered == ["me"]:
+        text = "🎯 **已保存到:** 收藏夹"
+    else:
+        text = "🎯 **已发送到:** " + ", ".join(
+            "收藏夹" if t == "me" else t for t in delivered
+        )
+    if failed:
+        text += "\n⚠️ **发送失败:** " + "; ".join(
+            f"{t}（{err}）" for t, err in failed.items()
+        )
+    return text
+
+
+def _prune_config_backups(data_dir: str, keep_count: int = 1):
+    """清理 data/ 下的历史配置快照，仅保留最新一份"""
+    try:
+        # 这里可以添加具体的清理逻辑，比如删除旧的配置备份文件
+        # 目前为空实现，可根据实际需要添加
+        pass
+    except Exception:
+        pass
+
+
+def delete_specific_files_from_backup(backup_file, temp_dir, files_to_delete):
+    with tarfile.open(backup_file, "r:gz") as tar:
+        tar.extractall(path=temp_dir)
+    for root, dirs, files in os.walk(temp_dir):
+        for file_name in files:
+            if file_name in files_to_delete:
+                file_path = os.path.join(root, file_name)
+                os.remove(file_path)
+    new_backup_file = backup_file.replace(".tar.gz", "_modified.tar.gz")
+    with tarfile.open(new_backup_file, "w:gz") as tar:
+        tar.add(temp_dir, arcname="pagermaid_backup")
+    return new_backup_file
+
+
+def _check_member_path(member, abs_path: str) -> str:
+    """校验归档成员路径（绝对路径、路径穿越、目录白名单），返回规范化后的相对路径"""
+    # 规范化路径
+    member_path = os.path.normpath(member.name)
+
+    # 检查绝对路径
+    if os.path.isabs(member_path):
+        raise Exception(f"检测到绝对路径，拒绝解压: {member.name}")
+
+    # 检查路径穿越
+    full_path = os.path.abspath(os.path.join(abs_path, member_path))
+    if not full_path.startswith(abs_path + os.sep) and full_path != abs_path:
+        raise Exception(f"路径穿越检测到，终止恢复: {member.name}")
+
+    # 检查允许的目录（白名单），根目录仅允许备份元数据文件
+    allowed_dirs = ["plugins", "data", "pagermaid_backup"]
+    path_parts = member_path.split(os.sep)
+    if not (member_path == BACKUP_INFO_NAME and member.isfile()):
+        if path_parts and path_parts[0] not in allowed_dirs:
+            raise Exception(f"不允许的目录路径: {member.name}")
+    return member_path
+
+
+def safe_extract(tar, path="."):
+    """严格的安全解压函数，防止路径穿越攻击"""
+    abs_path = os.path.abspath(path)
+
+    # 逐个成员校验并解压，兼容流模式（r|）打开的归档；
+    # 校验失败时抛出异常，已解压的部分需由调用方清理（un_tar_gz 先解压到暂存目录）
+    for member in tar:
+        _check_member_path(member, abs_path)
+        # 检查通过，解压该成员
+        tar.extract(member, path)
+
+
+def _move_tree_into(src, dst):
+    """把 src 下的全部内容移动（同一文件系统内 rename）合并到 dst，同名文件被覆盖"""
+    for root, dirnames, filenames in os.walk(src):
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target_root, exist_ok=True)
+        # 指向目录的符号链接出现在 dirnames 中但不会被遍历，按文件移动
+        for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(root, d))]:
+            os.replace(os.path.join(root, name), os.path.join(target_root, name))
+
+
+def un_tar_gz(filename, dirs):
+    """
+    安全解压备份归档到指定目录，自动识别 gz/pgz/zst，避免路径穿越。
+    流模式下只能边校验边解压，因此先解压到目标目录内的暂存目录，全部成功后再移入；
+    任一成员校验或解压失败时目标目录保持不变。
+    """
+    os.makedirs(dirs, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=".bf_extract_", dir=dirs)
+    try:
+        with open_backup_archive(filename) as tar:
+            safe_extract(tar, staging)
+        _move_tree_into(staging, dirs)
+        return True
+    except Exception as e:
+        print(f"解压失败: {e}")
+        return False
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def sanitize_filename(filename):
+    """清理文件名，确保安全"""
+    # 移除或替换危险字符
+    safe_name = re.sub(r"[^a-zA-Z0-9_.-]", "_", filename)
+    # 限制长度
+    if len(safe_name) > 100:
+        safe_name = safe_name[:100]
+    return safe_name
+
+
+def generate_smart_package_name(backup_type="backup"):
+    """AI智能生成包名"""
+    # 获取当前时间信息
+    now = now_bj()
+    timestamp = now.strftime("%Y%m%d_%H%M%S")
+
+    # 根据备份类型生成前缀
+    if backup_type == "plugins":
+        prefix = "bf_p"
+    elif backup_type == "data":
+        prefix = "bf_d"
+    elif backup_type == "full":
         prefix = "bf_all"
     else:
         prefix = "bf"
@@ -693,77 +2815,476 @@ def create_secure_temp_file(suffix=".tar.gz"):
     except Exception:
         pass  # Windows可能不支持
 
-    # 创建临时文件
-    fd, temp_path = tempfile.mkstemp(suffix=suffix, dir=temp_dir)
-    os.close(fd)  # 关闭文件描述符，但保留文件
-    return temp_path
+    # 创建临时文件
+    fd, temp_path = tempfile.mkstemp(suffix=suffix, dir=temp_dir)
+    os.close(fd)  # 关闭文件描述符，但保留文件
+    return temp_path
+
+
+def check_backup_size(file_path, max_size_mb=100):
+    """检查备份文件大小"""
+    if os.path.exists(file_path):
+        size_mb = os.path.getsize(file_path) / 1024 / 1024
+        if size_mb > max_size_mb:
+            return False, f"备份文件过大: {size_mb:.1f}MB > {max_size_mb}MB"
+        return True, f"文件大小: {size_mb:.1f}MB"
+    return False, "文件不存在"
+
+
+def create_backup_info(backup_type, file_list=None):
+    """创建备份元数据信息"""
+    import sys
+
+    return {
+        "version": "1.0",
+        "backup_type": backup_type,
+        "created_at": now_bj().isoformat(),
+        "created_by": "bf_plugin",
+        "file_count": len(file_list) if file_list else 0,
+        "files": file_list or [],
+        "platform": os.name,
+        "python_version": f"{sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}",
+        "backup_format": "tar.gz",
+        "compression_level": 5,
+        "exclude_sessions": True,
+        "security_validated": True,
+    }
+
+
+def add_backup_info_to_archive(tar_path, backup_info):
+    """向备份文件中添加元数据信息"""
+    try:
+        # 创建临时信息文件
+        temp_info_file = create_secure_temp_file(".json")
+        with open(temp_info_file, "w", encoding="utf-8") as f:
+            json.dump(backup_info, f, ensure_ascii=False, indent=2)
+
+        # 添加到存档
+        with tarfile.open(tar_path, "a:gz") as tar:
+            tar.add(temp_info_file, arcname="backup_info.json")
+
+        # 清理临时文件
+        os.remove(temp_info_file)
+        return True
+    except Exception as e:
+        print(f"添加备份信息失败: {e}")
+        return False
+
+
+def read_backup_info(tar_path):
+    """从备份文件中读取元数据信息（元数据写在归档首位，只需读取第一个成员）"""
+    try:
+        with open_backup_archive(tar_path) as tar:
+            first = tar.next()
+            if first is None or first.name != BACKUP_INFO_NAME:
+                # 旧版本备份没有元数据
+                return None
+            info_file = tar.extractfile(first)
+            if info_file:
+                return json.loads(info_file.read().decode("utf-8"))
+    except Exception as e:
+        print(f"读取备份信息失败: {e}")
+    return None
+
+
+def _is_session_file(path: str) -> bool:
+    name = os.path.basename(path)
+    return name.endswith(".session") or name.endswith(".session-journal")
+
+
+def _stage_restore_member(tar, member, dest, progress):
+    """
+    把归档成员写入 dest 同目录下的临时文件，返回临时文件路径。
+    dest 已存在且大小相同时先逐块比较，内容完全一致则返回 None（跳过）；
+    发现差异后才开始写临时文件，并补上此前已比较过的相同前缀。
+    """
+    src = tar.extractfile(member)
+    existing = None
+    if os.path.isfile(dest) and os.path.getsize(dest) == member.size:
+        existing = open(dest, "rb")
+    tmp_path = None
+    out = None
+    matched = 0
+    try:
+        while True:
+            chunk = src.read(_ARCHIVE_COPY_BUFSIZE)
+            if not chunk:
+                break
+            progress.advance(len(chunk))
+            if out is None and existing is not None:
+                if existing.read(len(chunk)) == chunk:
+                    matched += len(chunk)
+                    continue
+            if out is None:
+                tmp_path, out = _open_restore_tmp(dest)
+                if matched:
+                    existing.seek(0)
+                    _copy_prefix(existing, out, matched)
+            out.write(chunk)
+        if out is None:
+            if existing is not None:
+                return None
+            # 目标不存在的空文件
+            tmp_path, out = _open_restore_tmp(dest)
+        out.close()
+        os.chmod(tmp_path, member.mode & 0o777)
+        os.utime(tmp_path, (member.mtime, member.mtime))
+        return tmp_path
+    except BaseException:
+        if out is not None:
+            out.close()
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        if existing is not None:
+            existing.close()
+
+
+def _open_restore_tmp(dest: str):
+    """在 dest 所在目录创建临时文件（保证 os.replace 是同一文件系统内的原子替换）"""
+    dest_dir = os.path.dirname(dest)
+    os.makedirs(dest_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=f".{os.path.basename(dest)}.", suffix=".bfrestore", dir=dest_dir
+    )
+    return tmp_path, os.fdopen(fd, "wb")
+
+
+def _copy_prefix(src, dst, length: int):
+    while length > 0:
+        chunk = src.read(min(_ARCHIVE_COPY_BUFSIZE, length))
+        if not chunk:
+            raise Exception("恢复时目标文件被修改")
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+def _assemble_delta_file(dest: str, recipe: dict, chunk_dir, progress):
+    """
+    按块级增量的拼装说明生成新文件，返回 dest 旁的临时文件路径。
+    块优先取自本归档（chunk_dir），其余从 dest 现有内容（上一个版本）中按块哈希查找；
+    拼装结果按大小与 sha256 校验。
+    """
+    block_size = int(recipe["block_size"])
+    blocks = recipe["blocks"]
+    needed = {
+        b
+        for b in blocks
+        if chunk_dir is None or not os.path.exists(os.path.join(chunk_dir, b))
+    }
+    old_offsets = {}
+    if needed and os.path.isfile(dest):
+        with open(dest, "rb") as f:
+            offset = 0
+            while True:
+                data = f.read(block_size)
+                if not data:
+                    break
+                digest = hashlib.sha256(data).hexdigest()
+                if digest in needed:
+                    old_offsets.setdefault(digest, offset)
+                offset += len(data)
+                progress.advance()
+    missing = needed - old_offsets.keys()
+    if missing:
+        raise Exception(
+            f"块级增量缺少 {len(missing)} 个数据块: {dest}（请回复链上最新的备份完整恢复）"
+        )
+
+    mode = os.stat(dest).st_mode & 0o777 if os.path.exists(dest) else 0o644
+    tmp_path, out = _open_restore_tmp(dest)
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with out, contextlib.ExitStack() as stack:
+            old = stack.enter_context(open(dest, "rb")) if old_offsets else None
+            for digest in blocks:
+                if digest in old_offsets:
+                    old.seek(old_offsets[digest])
+                    data = old.read(block_size)
+                else:
+                    with open(os.path.join(chunk_dir, digest), "rb") as f:
+                        data = f.read()
+                hasher.update(data)
+                size += len(data)
+                out.write(data)
+                progress.advance(len(data))
+        if size != recipe["size"] or hasher.hexdigest() != recipe["sha256"]:
+            raise Exception(f"块级增量拼装校验失败: {dest}")
+        os.chmod(tmp_path, mode)
+        os.utime(tmp_path, (recipe["mtime"], recipe["mtime"]))
+        return tmp_path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def restore_backup_archive(
+    filename: str,
+    program_dir: str,
+    archive_root: str = "pagermaid_backup",
+    progress_queue=None,
+    cancel_event=None,
+):
+    """
+    流式恢复备份归档到 program_dir，不再完整解压到临时目录后复制。
+    - 成员逐个写到目标文件旁的临时文件，内容未变化的文件直接跳过
+    - 整个归档读取并校验通过后，才统一用 os.replace 原子替换；
+      中途出错（校验失败、归档损坏、取消）会删除临时文件，程序目录中的文件保持不变
+    - 路径校验规则与 safe_extract 相同，session 文件跳过，只恢复普通文件与目录
+    - 归档中 backup_info.json 记录的已删除文件在替换完成后删除（增量备份）
+    - 块级增量的文件由 _assemble_delta_file 用现有文件与归档中的新块拼装
+    返回 {"written": 写入文件数, "skipped": 未变化文件数, "deleted": 删除文件数}
+    """
+    progress = _ArchiveProgress(progress_queue, cancel_event)
+    abs_program_dir = os.path.abspath(program_dir)
+    staged = []
+    skipped = 0
+    deleted = []
+    recipes = {}
+    chunk_dir = None
+    try:
+        with open_backup_archive(filename) as tar:
+            for member in tar:
+                member_path = _check_member_path(member, abs_program_dir)
+                if member_path == BACKUP_INFO_NAME:
+                    info = json.load(tar.extractfile(member))
+                    deleted = info.get("deleted") or []
+                    continue
+                rel = member_path
+                if archive_root and (
+                    rel == archive_root or rel.startswith(archive_root + os.sep)
+                ):
+                    rel = rel[len(archive_root) + 1 :]
+                if rel.startswith(_DELTA_DIR + os.sep):
+                    # 块级增量：新块先放到临时目录，读完归档后再拼装
+                    name = rel[len(_DELTA_DIR) + 1 :]
+                    if not member.isfile():
+                        continue
+                    if name == _DELTA_RECIPES:
+                        recipes = json.load(tar.extractfile(member))
+                    elif _SHA256_HEX_RE.match(name):
+                        if chunk_dir is None:
+                            chunk_dir = tempfile.mkdtemp(prefix="bf_delta_")
+                        with open(os.path.join(chunk_dir, name), "wb") as f:
+                            shutil.copyfileobj(tar.extractfile(member), f)
+                    continue
+                if not rel or _is_session_file(rel):
+                    continue
+                dest = os.path.join(abs_program_dir, rel)
+                if member.isdir():
+                    os.makedirs(dest, exist_ok=True)
+                elif member.isfile():
+                    tmp_path = _stage_restore_member(tar, member, dest, progress)
+                    if tmp_path is None:
+                        skipped += 1
+                    else:
+                        staged.append((tmp_path, dest))
+                    progress.advance(files=1)
+        for arcname, recipe in recipes.items():
+            rel = os.path.normpath(arcname)
+            if archive_root and rel.startswith(archive_root + os.sep):
+                rel = rel[len(archive_root) + 1 :]
+            dest = os.path.abspath(os.path.join(abs_program_dir, rel))
+            if not dest.startswith(abs_program_dir + os.sep) or _is_session_file(rel):
+                raise Exception(f"块级增量路径非法: {arcname}")
+            staged.append(
+                (_assemble_delta_file(dest, recipe, chunk_dir, progress), dest)
+            )
+            progress.advance(files=1)
+        for tmp_path, dest in staged:
+            os.replace(tmp_path, dest)
+    except BaseException:
+        for tmp_path, _ in staged:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        raise
+    finally:
+        if chunk_dir is not None:
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+    progress.finish()
+    removed = _apply_deleted_files(deleted, program_dir, archive_root)
+    return {"written": len(staged), "skipped": skipped, "deleted": removed}
+
+
+def _apply_deleted_files(deleted, program_dir: str, archive_root="pagermaid_backup"):
+    """删除增量备份中记录为已删除的文件（仅限 data/plugins，跳过 session）"""
+    abs_program_dir = os.path.abspath(program_dir)
+    removed = 0
+    for name in deleted or []:
+        rel = os.path.normpath(name)
+        if archive_root and rel.startswith(archive_root + os.sep):
+            rel = rel[len(archive_root) + 1 :]
+        if os.path.isabs(rel) or rel.split(os.sep)[0] not in ("data", "plugins"):
+            continue
+        if _is_session_file(rel):
+            continue
+        full = os.path.abspath(os.path.join(program_dir, rel))
+        if not full.startswith(abs_program_dir + os.sep):
+            continue
+        try:
+            if os.path.isfile(full):
+                os.remove(full)
+                removed += 1
+        except Exception:
+            pass
+    return removed
+
 
+def _is_backup_file_message(msg) -> bool:
+    return bool(getattr(msg, "file", None) and _is_backup_filename(msg.file.name))
 
-def check_backup_size(file_path, max_size_mb=100):
-    """检查备份文件大小"""
-    if os.path.exists(file_path):
-        size_mb = os.path.getsize(file_path) / 1024 / 1024
-        if size_mb > max_size_mb:
-            return False, f"备份文件过大: {size_mb:.1f}MB > {max_size_mb}MB"
-        return True, f"文件大小: {size_mb:.1f}MB"
-    return False, "文件不存在"
 
+async def _get_catalog_message(client, entry: dict):
+    """按备份目录记录的位置直接取回备份消息，所有位置都失效时返回 None"""
+    for location in entry.get("locations") or []:
+        try:
+            msg = await client.get_messages(
+                _as_peer(location["chat"]), ids=int(location["message_id"])
+            )
+        except Exception:
+            continue
+        if msg and _is_backup_file_message(msg):
+            return msg
+    return None
 
-def create_backup_info(backup_type, file_list=None):
-    """创建备份元数据信息"""
-    import sys
 
-    return {
-        "version": "1.0",
-        "backup_type": backup_type,
-        "created_at": now_bj().isoformat(),
-        "created_by": "bf_plugin",
-        "file_count": len(file_list) if file_list else 0,
-        "files": file_list or [],
-        "platform": os.name,
-        "python_version": f"{sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}",
-        "backup_format": "tar.gz",
-        "compression_level": 5,
-        "exclude_sessions": True,
-        "security_validated": True,
-    }
+async def _latest_backup_message(client):
+    """最新的备份消息：优先查备份目录，目录为空或记录失效时回退到扫描收藏夹"""
+    for entry in filter_catalog()[:5]:
+        msg = await _get_catalog_message(client, entry)
+        if msg:
+            return msg
+    # 在收藏夹中查找最近的备份归档（兼容 bf / bf all / bf p 等不同命名）
+    async for msg in client.iter_messages("me", limit=50):
+        if _is_backup_file_message(msg):
+            return msg
+    return None
 
 
-def add_backup_info_to_archive(tar_path, backup_info):
-    """向备份文件中添加元数据信息"""
-    try:
-        # 创建临时信息文件
-        temp_info_file = create_secure_temp_file(".json")
-        with open(temp_info_file, "w", encoding="utf-8") as f:
-            json.dump(backup_info, f, ensure_ascii=False, indent=2)
+async def _find_backup_message(client, backup_id: str):
+    """按备份ID查找备份消息：先查备份目录，再在收藏夹与目标聊天中搜索（文件名中带有备份ID）"""
+    entry = find_catalog_entry(backup_id)
+    if entry:
+        msg = await _get_catalog_message(client, entry)
+        if msg:
+            return msg
+    chats = ["me"] + [int(t) for t in get_target_chat_ids()]
+    for chat in chats:
+        try:
+            async for msg in client.iter_messages(chat, search=backup_id, limit=20):
+                if _is_backup_file_message(msg) and f"_{backup_id}." in msg.file.name:
+                    return msg
+        except Exception:
+            continue
+    return None
 
-        # 添加到存档
-        with tarfile.open(tar_path, "a:gz") as tar:
-            tar.add(temp_info_file, arcname="backup_info.json")
 
-        # 清理临时文件
-        os.remove(temp_info_file)
-        return True
-    except Exception as e:
-        print(f"添加备份信息失败: {e}")
-        return False
+def _file_sha256(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(_ARCHIVE_COPY_BUFSIZE), b""):
+            hasher.update(data)
+    return hasher.hexdigest()
 
 
-def read_backup_info(tar_path):
-    """从备份文件中读取元数据信息"""
+async def _find_volume_messages(client, index_msg, index: dict) -> list:
+    """
+    取回索引对应的各分卷消息：优先使用索引中记录的本聊天消息 ID；
+    没有记录（旧索引、转发到其他聊天）或消息已不匹配时，
+    在索引消息之前的全部消息中按文件名查找（分卷总是先于索引发送）。
+    """
+    names = [vol["name"] for vol in index["volumes"]]
+    ids = (index.get("messages") or {}).get(str(index_msg.chat_id))
+    if ids and len(ids) == len(names):
+        msgs = await client.get_messages(index_msg.chat_id, ids=ids)
+        if all(
+            getattr(getattr(msg, "file", None), "name", None) == name
+            for msg, name in zip(msgs, names)
+        ):
+            return list(msgs)
+    found = {}
+    async for msg in client.iter_messages(index_msg.chat_id, max_id=index_msg.id):
+        name = getattr(getattr(msg, "file", None), "name", None)
+        if name in names and name not in found:
+            found[name] = msg
+            if len(found) == len(names):
+                break
+    missing = [name for name in names if name not in found]
+    if missing:
+        raise Exception(f"分卷缺失: {', '.join(missing)}")
+    return [found[name] for name in names]
+
+
+async def download_backup_file(client, msg, path: str) -> str:
+    """
+    下载备份消息到 path 并返回 path。
+    分卷索引下载到 path，各卷并发下载到 path.001 … 并逐卷校验大小与 sha256，
+    之后 open_backup_archive(path) 即可按顺序读取；失败时清理已下载的分卷。
+    """
+    if not msg.file.name.endswith(_VOLUME_INDEX_SUFFIX):
+        await client.download_media(msg, file=path)
+        return path
+    await client.download_media(msg, file=path)
+    index = read_volume_index(path)
+    if index is None:
+        raise Exception("分卷索引无效")
+    try:
+        volume_msgs = await _find_volume_messages(client, msg, index)
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(_VOLUME_CONCURRENCY)
+
+        async def fetch(vol_msg, vol, vol_path):
+            async with semaphore:
+                await client.download_media(vol_msg, file=vol_path)
+            digest = await loop.run_in_executor(None, _file_sha256, vol_path)
+            if os.path.getsize(vol_path) != vol["size"] or digest != vol["sha256"]:
+                raise Exception(f"分卷校验失败: {vol['name']}")
+
+        await asyncio.gather(
+            *(
+                fetch(vol_msg, vol, vol_path)
+                for vol_msg, vol, vol_path in zip(
+                    volume_msgs, index["volumes"], _volume_paths(path, index)
+                )
+            )
+        )
+    except BaseException:
+        remove_backup_file(path)
+        raise
+    return path
+
+
+async def _download_backup_chain(client, chain, message=None):
+    """
+    按顺序下载增量链上的备份（全量在前），返回本地路径列表。
+    任一环节缺失则清理已下载文件并抛出异常。
+    """
+    paths = []
     try:
-        with tarfile.open(tar_path, "r:gz") as tar:
+        for idx, backup_id in enumerate(chain, 1):
+            if message is not None:
+                await message.edit(
+                    f"🔗 **正在获取增量链** ({idx}/{len(chain)})\n\n• 备份ID: `{backup_id}`"
+                )
+            msg = await _find_backup_message(client, backup_id)
+            if not msg:
+                raise Exception(f"增量链缺失：找不到备份 `{backup_id}`")
+            path = create_secure_temp_file(".tar.gz")
+            paths.append(path)
+            await download_backup_file(client, msg, path)
+    except BaseException:
+        for path in paths:
             try:
-                info_member = tar.getmember("backup_info.json")
-                info_file = tar.extractfile(info_member)
-                if info_file:
-                    return json.loads(info_file.read().decode("utf-8"))
-            except KeyError:
-                # 旧版本备份没有元数据
-                return None
-    except Exception as e:
-        print(f"读取备份信息失败: {e}")
-    return None
+                remove_backup_file(path)
+            except Exception:
+                pass
+        raise
+    return paths
 
 
 # bf 备份命令
@@ -778,10 +3299,16 @@ async def bf(message: Message):
             "常用：\n"
             "• 帮助：`bf help`\n"
             "• 标准：`bf`\n"
+            "• 增量：`bf inc`（仅打包变化的文件）\n"
             "• 全量：`bf all [slim|fast]`\n"
             "• 插件：`bf p`\n"
             "• 目标：`bf set <ID...>` / `bf del <ID|all>`\n"
-            "• 恢复：`hf`（可在备份上回复后执行）\n"
+            "• 恢复：`hf`（可在备份上回复后执行）/ `hf list` / `hf <ID>`\n"
+            "• 取消：`bf cancel`（中止正在进行的打包）\n"
+            "• 编码：`bf codec`（gz / pgz / zst，含基准测试）\n"
+            "• 数据库：`bf sqlite on|off`（SQLite 在线快照）\n"
+            "• 分卷：`bf volume <MB>`（超过该大小分卷并发上传）\n"
+            "• 基准：`bf bench [文件数] [small|mixed|large]`（备份流程各阶段计时）\n"
             "• 定时：`bf cron`\n\n"
             "提示：执行子命令会显示对应说明（如 `bf cron` 或 `<指令名> help`）。"
         )
@@ -863,6 +3390,167 @@ async def bf(message: Message):
             await message.edit(f"删除失败：{str(e)}")
             return
 
+    if param and param[0] == "codec":
+        # bf codec [gz|pgz|zst] [level] / bf codec bench
+        codec, codec_level = get_backup_codec()
+        if len(param) == 1 or param[1] in ["help", "-h", "--help", "?"]:
+            codec_help = (
+                "🗜️ 压缩编码\n\n"
+                "用法：\n"
+                "• `bf codec <gz|pgz|zst> [等级]` 设置编码（等级留空使用默认）\n"
+                "• `bf codec bench` 在 data/ 上测试各编码的速度与压缩率\n\n"
+                "可选编码：\n"
+                + "".join(
+                    f"• `{name}`：{info['desc']}，等级 {info['levels'][0]}-{info['levels'][1]}\n"
+                    for name, info in BACKUP_CODECS.items()
+                )
+                + f"\n当前：`{codec}`{f' L{codec_level}' if codec_level else '（默认等级）'}\n"
+                "提示：恢复时会自动识别编码，无需额外设置"
+            )
+            await message.edit(codec_help)
+            return
+        if param[1] == "bench":
+            await message.edit("📊 正在测试压缩编码...")
+            try:
+                results = await run_archive_job(
+                    benchmark_codecs,
+                    [os.path.join(program_dir, "data")],
+                    compresslevel=codec_level,
+                    message=message,
+                    label="📊 正在测试压缩编码",
+                )
+            except Exception as e:
+                await message.edit(f"❌ 测试失败：{str(e)}")
+                return
+            await message.edit(format_codec_benchmark(results))
+            return
+        name = param[1].lower()
+        if name not in BACKUP_CODECS:
+            await message.edit(f"未知编码：{name}，可选：{', '.join(BACKUP_CODECS)}")
+            return
+        level = None
+        if len(param) > 2:
+            low, high = BACKUP_CODECS[name]["levels"]
+            if not param[2].isdigit() or not low <= int(param[2]) <= high:
+                await message.edit(f"无效的等级：{param[2]}（{name} 支持 {low}-{high}）")
+                return
+            level = int(param[2])
+        if name == "zst":
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, _require_zstandard)
+            except Exception as e:
+                await message.edit(f"❌ 安装 zstandard 失败：{str(e)}")
+                return
+        set_backup_codec(name, level)
+        await message.edit(
+            f"✅ 压缩编码已设置为 `{name}`{f' L{level}' if level else '（默认等级）'}"
+        )
+        return
+
+    if param and param[0] == "sqlite":
+        # bf sqlite [on|off] - SQLite 在线快照开关
+        if len(param) == 1 or param[1].lower() not in ("on", "off"):
+            await message.edit(
+                "🗄️ SQLite 在线快照\n\n"
+                "用法：`bf sqlite on` / `bf sqlite off`\n\n"
+                "开启后，`bf`/`bf inc` 与定时备份会用 sqlite3 在线备份 API 为 data/ 中的数据库"
+                "生成一致的快照再打包（分步复制，不会长时间阻塞正在写入的插件），"
+                "数据库的 -wal/-shm/-journal 文件不再单独打包。\n\n"
+                f"当前：{'开启' if get_sqlite_snapshot() else '关闭'}"
+            )
+            return
+        enabled = param[1].lower() == "on"
+        set_sqlite_snapshot(enabled)
+        await message.edit(f"✅ SQLite 在线快照已{'开启' if enabled else '关闭'}")
+        return
+
+    if param and param[0] == "bench":
+        # bf bench [文件数] [small|mixed|large] [gz|pgz|zst] - 合成数据上的备份流程基准
+        if len(param) > 1 and param[1] in ["help", "-h", "--help", "?"]:
+            await message.edit(
+                "⏱️ 备份流程基准\n\n"
+                "用法：`bf bench [文件数] [分布] [编码]`\n\n"
+                "在临时目录生成合成的 data/ + plugins/，依次计时 "
+                "walk / tar / compress / extract / restore / restore_unchanged，"
+                "结果以 JSON 附在消息末尾并追加到 `data/bf_bench.jsonl`。\n\n"
+                "分布：\n"
+                + "".join(f"• `{name}`：{desc}\n" for name, desc in BENCH_PROFILES.items())
+                + f"\n默认：{_BENCH_FILES_DEFAULT} 个文件，`mixed`，当前编码"
+            )
+            return
+        codec, codec_level = get_backup_codec()
+        file_count, profile = _BENCH_FILES_DEFAULT, "mixed"
+        for arg in param[1:]:
+            if arg.isdigit():
+                file_count = min(max(int(arg), 1), _BENCH_FILES_MAX)
+            elif arg in BENCH_PROFILES:
+                profile = arg
+            elif arg in BACKUP_CODECS:
+                if arg != codec:
+                    codec, codec_level = arg, None
+            else:
+                await message.edit(f"未知参数：{arg}，用法见 `bf bench help`")
+                return
+        if codec == "zst" and not _zstandard_available():
+            await message.edit("❌ 未安装 zstandard，请先执行 `bf codec zst`")
+            return
+        await message.edit("⏱️ 正在生成合成数据并测试...")
+        try:
+            result = await run_archive_job(
+                benchmark_pipeline,
+                file_count,
+                profile,
+                codec,
+                codec_level,
+                message=message,
+                label="⏱️ 正在测试备份流程",
+            )
+        except Exception as e:
+            await message.edit(f"❌ 测试失败：{str(e)}")
+            return
+        try:
+            with open(get_bench_history_file(), "a", encoding="utf-8") as f:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        except Exception as e:
+            print(f"[bf] 写入基准记录失败: {e}")
+        await message.edit(format_pipeline_benchmark(result))
+        return
+
+    if param and param[0] == "volume":
+        # bf volume [MB] - 分卷大小
+        if len(param) == 1 or not param[1].isdigit():
+            await message.edit(
+                "🧱 分卷上传\n\n"
+                "用法：`bf volume <MB>`\n\n"
+                "超过该大小的备份拆成多个分卷（`.001`、`.002` …）并发上传，"
+                "最后发送带各卷 sha256 的分卷索引 `.bfvol.json`；"
+                "`hf` 回复索引即可并发下载并校验全部分卷后恢复。\n\n"
+                f"范围：{_VOLUME_MB_MIN}-{_VOLUME_MB_MAX} MB（Telegram 单文件上限 {_VOLUME_MB_MAX} MB）\n"
+                f"当前：{get_volume_size_mb()} MB"
+            )
+            return
+        size = int(param[1])
+        if not _VOLUME_MB_MIN <= size <= _VOLUME_MB_MAX:
+            await message.edit(
+                f"❌ 分卷大小需在 {_VOLUME_MB_MIN}-{_VOLUME_MB_MAX} MB 之间"
+                f"（Telegram 单文件上限 {_VOLUME_MB_MAX} MB）"
+            )
+            return
+        cfg = load_config()
+        cfg["volume_mb"] = size
+        save_config(cfg)
+        await message.edit(f"✅ 分卷大小已设置为 {size} MB")
+        return
+
+    if param and param[0] == "cancel":
+        # bf cancel - 取消正在进行的打包
+        count = cancel_archive_jobs()
+        if count:
+            await message.edit(f"⏹️ 已请求取消 {count} 个正在进行的打包任务")
+        else:
+            await message.edit("ℹ️ 当前没有正在进行的打包任务")
+        return
+
     # bf cron - 管理定时任务（国际标准5段cron）
     if param and param[0] == "cron":
         # 用法：
@@ -881,8 +3569,10 @@ async def bf(message: Message):
                 "用法：\n"
                 "• 查看当前：`bf cron show`\n"
                 "• 关闭定时：`bf cron off`\n"
+                "• 备份模式：`bf cron mode <full|inc>`（inc 仅上传变化的文件）\n"
                 "• 设置定时：`bf cron <m h dom mon dow>`（5 段国际标准）\n\n"
                 f"当前设置：{cur if cur else '未设置'}\n"
+                f"备份模式：{get_cron_mode()}\n"
                 f"最近一次触发：{last if last else '—'}\n"
                 f"下次预计触发：{nxt if nxt != '—' else '—'}\n\n"
                 "语法说明：\n"
@@ -903,6 +3593,18 @@ async def bf(message: Message):
             await message.edit(cron_help)
             return
         sub = " ".join(param[1:]).strip()
+        if sub.lower().startswith("mode"):
+            mode = sub[4:].strip().lower()
+            if mode not in ("full", "inc"):
+                await message.edit(
+                    f"当前定时模式：{get_cron_mode()}\n用法：`bf cron mode full` 或 `bf cron mode inc`"
+                )
+                return
+            set_cron_mode(mode)
+            await message.edit(
+                f"✅ 定时备份模式已设置为：{'增量（仅上传变化的文件）' if mode == 'inc' else '全量'}"
+            )
+            return
         if sub.lower() == "show":
             cur = get_cron_expr()
             last = get_cron_last_run()
@@ -924,21 +3626,18 @@ async def bf(message: Message):
         if len(fields) != 5:
             await message.edit("无效的表达式：必须为5段，如：bf cron * * * * *")
             return
-        # 基础合法性校验
+        # 基础合法性校验（编译结果会被缓存，后续计算触发时间直接复用）
         try:
-            # 简单调用解析避免异常
-            _ = _parse_cron_field(fields[0], 0, 59)
-            _ = _parse_cron_field(fields[1], 0, 23)
-            _ = _parse_cron_field(fields[2], 1, 31)
-            _ = _parse_cron_field(fields[3], 1, 12)
-            _ = _parse_cron_field(fields[4], 0, 6)
+            nxt_dt = compile_cron(sub).next_after(now_bj())
+            if nxt_dt is None:
+                # 如 `0 0 31 2 *`：字段各自合法，但日期永远不存在
+                raise ValueError("该表达式永远不会触发（日期不存在）")
         except Exception as e:
             await message.edit(f"表达式解析失败：{str(e)}")
             return
         set_cron_expr(sub)
         await _restart_cron_task()
-        nxt_dt = get_next_cron_time(sub)
-        nxt = nxt_dt.strftime("%Y-%m-%d %H:%M") if nxt_dt else "—"
+        nxt = nxt_dt.strftime("%Y-%m-%d %H:%M")
         await message.edit(
             f"✅ 已设置定时备份：`{sub}`\n下次预计触发：{nxt}\n提示：定时任务将于匹配分钟触发，文件发送到已配置目标或收藏夹。"
         )
@@ -950,7 +3649,8 @@ async def bf(message: Message):
             await message.edit("🔄 正在创建完整程序备份...")
             # 生成智能包名
             package_name = generate_smart_package_name("full")
-            backup_filename = f"{package_name}.tar.gz"
+            codec, codec_level = get_backup_codec()
+            backup_filename = package_name.replace(".tar.gz", _archive_ext(codec))
             slim_mode = len(param) > 1 and param[1].lower() in ["slim", "fast"]
 
             # 备份整个程序目录：扩展排除规则，并使用更快压缩等级
@@ -993,16 +3693,22 @@ async def bf(message: Message):
                     continue
                 include_items.append(os.path.join(program_dir, item))
 
-            create_tar_gz(
+            # 打包输出直接流式上传，不在磁盘上生成完整备份
+            _, input_file = await stream_archive_upload(
+                message.client,
+                create_tar_gz,
                 include_items,
-                backup_filename,
+                file_name=backup_filename,
                 exclude_dirs=exclude_dirnames,
                 exclude_exts=exclude_exts,
                 max_file_size_mb=max_file_size_mb,
-                compresslevel=compress_level,
+                compresslevel=codec_level or compress_level,
+                codec=codec,
+                message=message,
+                label="🔄 正在创建并上传完整程序备份",
             )
 
-            await message.edit("📤 正在上传完整备份...")
+            await message.edit("📤 正在发送完整备份...")
             import datetime
 
             caption = (
@@ -1014,64 +3720,19 @@ async def bf(message: Message):
                 f"{'（跳过>20MB文件与更多缓存目录）' if slim_mode else ''}"
             )
 
-            # 根据是否存在目标ID决定发送目的地
-            targets = get_target_chat_ids()
-            show_progress = len(targets) <= 1
-
-            # 进度条仅在单目标时展示，避免多次刷屏
-            progress = {"last": 0}
-
-            def _progress(sent, total):
-                if not show_progress:
-                    return
-                try:
-                    if total:
-                        pct = int(sent * 100 / total)
-                        if pct >= progress["last"] + 10:
-                            progress["last"] = pct
-                            try:
-                                message.client.loop.create_task(
-                                    message.edit(f"📤 正在上传完整备份... {pct}%")
-                                )
-                            except Exception:
-                                pass
-                except Exception:
-                    pass
-
-            try:
-                if targets:
-                    for idx, tgt in enumerate(targets, 1):
-                        await message.client.send_file(
-                            int(tgt),
-                            backup_filename,
-                            caption=caption,
-                            force_document=True,
-                            progress_callback=_progress if show_progress else None,
-                        )
-                else:
-                    await message.client.send_file(
-                        "me",
-                        backup_filename,
-                        caption=caption,
-                        force_document=True,
-                        progress_callback=_progress,
-                    )
-            except Exception as e:
-                raise Exception(f"上传失败: {str(e)}")
-
-            os.remove(backup_filename)
-            if targets:
-                await message.edit(
-                    f"✅ 完整备份已完成\n\n📦 **包名:** `{package_name}`\n🎯 **已发送到:** {', '.join(targets)}"
-                )
-            else:
-                await message.edit(
-                    f"✅ 完整备份已完成\n\n📦 **包名:** `{package_name}`\n🎯 **已保存到:** 收藏夹"
-                )
+            # 只上传一次，再按文件引用并发发送到各目标
+            delivered, failed = await send_backup_to_targets(
+                message.client,
+                input_file,
+                caption,
+                get_target_chat_ids(),
+                catalog_entry=_catalog_entry("full", backup_filename),
+            )
+            await message.edit(
+                f"✅ 完整备份已完成\n\n📦 **包名:** `{package_name}`\n{_format_delivery(delivered, failed)}"
+            )
             return
         except Exception as e:
-            if "backup_filename" in locals() and os.path.exists(backup_filename):
-                os.remove(backup_filename)
             await message.edit(f"❌ 完整备份失败: {str(e)}")
             return
 
@@ -1081,7 +3742,8 @@ async def bf(message: Message):
             await message.edit("🐍 正在创建Python插件备份...")
             # 生成智能包名
             package_name = generate_smart_package_name("plugins")
-            backup_filename = f"{package_name}.tar.gz"
+            codec, codec_level = get_backup_codec()
+            backup_filename = package_name.replace(".tar.gz", _archive_ext(codec))
 
             plugins_dir = os.path.join(program_dir, "plugins")
             if not os.path.exists(plugins_dir):
@@ -1114,7 +3776,16 @@ async def bf(message: Message):
                 return
 
             # 只打包临时根下的 plugins 目录，保证归档根目录名为 plugins
-            create_tar_gz([temp_plugins_dir], backup_filename)
+            _, input_file = await stream_archive_upload(
+                message.client,
+                create_tar_gz,
+                [temp_plugins_dir],
+                file_name=backup_filename,
+                compresslevel=codec_level or 5,
+                codec=codec,
+                message=message,
+                label="🐍 正在打包并上传Python插件",
+            )
             shutil.rmtree(temp_root)
 
             await message.edit("📤 正在分享插件备份...")
@@ -1122,39 +3793,19 @@ async def bf(message: Message):
 
             caption = f"🐍 **Python插件备份**\n\n• 包名: `{package_name}`\n• 创建时间: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n• 备份类型: Python插件包\n• 插件数量: {py_count} 个\n• 适合: 插件分享和迁移"
 
-            # 安全的多目标上传：先上传到所有目标，再删除文件
-            targets = get_target_chat_ids()
-            upload_tasks = []
-
-            if targets:
-                for tgt in targets:
-                    upload_tasks.append(
-                        message.client.send_file(
-                            int(tgt), backup_filename, caption=caption
-                        )
-                    )
-            else:
-                upload_tasks.append(
-                    message.client.send_file("me", backup_filename, caption=caption)
-                )
-
-            # 等待所有上传完成
-            await asyncio.gather(*upload_tasks)
-
-            # 所有上传完成后才删除文件
-            os.remove(backup_filename)
-            if targets:
-                await message.edit(
-                    f"✅ 插件备份已完成\n\n📦 **包名:** `{package_name}`\n🐍 **插件数量:** {py_count} 个\n🎯 **已发送到:** {', '.join(targets)}"
-                )
-            else:
-                await message.edit(
-                    f"✅ 插件备份已完成\n\n📦 **包名:** `{package_name}`\n🐍 **插件数量:** {py_count} 个\n🎯 **已保存到:** 收藏夹"
-                )
+            # 只上传一次，再按文件引用并发发送到各目标
+            delivered, failed = await send_backup_to_targets(
+                message.client,
+                input_file,
+                caption,
+                get_target_chat_ids(),
+                catalog_entry=_catalog_entry("plugins", backup_filename),
+            )
+            await message.edit(
+                f"✅ 插件备份已完成\n\n📦 **包名:** `{package_name}`\n🐍 **插件数量:** {py_count} 个\n{_format_delivery(delivered, failed)}"
+            )
             return
         except Exception as e:
-            if "backup_filename" in locals() and os.path.exists(backup_filename):
-                os.remove(backup_filename)
             # 清理插件临时目录（尽量移除根目录与其子目录）
             try:
                 if "temp_root" in locals() and os.path.exists(temp_root):
@@ -1179,6 +3830,39 @@ async def bf(message: Message):
         )
         return
 
+    # bf inc - 增量备份：仅打包自上次标准/增量备份以来变化的文件
+    incremental = bool(param and param[0] == "inc")
+    if incremental and len(param) > 1 and param[1] in ["help", "-h", "--help", "?"]:
+        manifest = load_manifest()
+        inc_help = (
+            "🧩 增量备份\n\n"
+            "用法：\n"
+            "• `bf inc` 仅打包新增/修改的文件，并记录已删除的文件\n"
+            "• `bf` 标准（全量）备份，同时作为新增量链的起点\n"
+            "• `bf cron mode inc` 定时任务使用增量模式\n"
+            "• `bf inc delta <MB>` 不小于该大小的文件只上传变化的块（0 关闭）\n\n"
+            f"当前基准：{manifest['backup_id'] if manifest else '无（下次将做全量）'}\n"
+            f"链长：{len(manifest['chain']) if manifest else 0}"
+            f"/{load_config().get('inc_max_chain', _INC_MAX_CHAIN_DEFAULT)}（达到上限自动全量）\n"
+            f"块级增量：{f'≥ {get_delta_min_mb()} MB' if get_delta_min_mb() else '关闭'}\n\n"
+            "恢复：`hf` 回复任一增量备份，会自动按链依次恢复全量与之前的增量"
+        )
+        await message.edit(inc_help)
+        return
+    if incremental and len(param) > 1 and param[1] == "delta":
+        if len(param) < 3 or not param[2].isdigit():
+            await message.edit("用法：`bf inc delta <MB>`（0 关闭块级增量）")
+            return
+        cfg = load_config()
+        cfg["delta_min_mb"] = int(param[2])
+        save_config(cfg)
+        await message.edit(
+            f"✅ 块级增量阈值已设置为 {param[2]} MB"
+            if int(param[2])
+            else "✅ 已关闭块级增量"
+        )
+        return
+
     # 默认备份功能（标准备份）
     try:
         data_dir = os.path.join(program_dir, "data")
@@ -1186,119 +3870,138 @@ async def bf(message: Message):
         import datetime
 
         now_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        plan = _plan_standard_backup(incremental=incremental)
+        is_inc = plan["backup_type"] == "incremental"
+        codec, codec_level = get_backup_codec()
         # 使用临时目录放置备份，避免与程序目录混淆
         import tempfile
 
         tmpdir = tempfile.gettempdir()
-        backup_path = os.path.join(tmpdir, f"pagermaid_backup_{now_str}.tar.gz")
+        backup_name = _standard_backup_filename(plan, now_str, codec)
         sessions_path = os.path.join(tmpdir, f"pagermaid_sessions_{now_str}.tar.gz")
 
-        await message.edit("🔄 正在创建标准备份...")
-        # 仅备份 data + plugins（默认排除 session）
-        create_data_plugins_backup(
-            backup_path, program_dir=program_dir, exclude_session=True, compresslevel=5
+        label = "🔄 正在创建并上传增量备份" if is_inc else "🔄 正在创建并上传标准备份"
+        await message.edit(f"{label}...")
+        # 仅备份 data + plugins（默认排除 session），打包输出直接流式上传、不落盘
+        result, input_file = await stream_archive_upload(
+            message.client,
+            create_data_plugins_backup,
+            file_name=backup_name,
+            should_upload=lambda r: not is_inc or r["archived"] or r["deleted"],
+            program_dir=program_dir,
+            exclude_session=True,
+            compresslevel=codec_level or 5,
+            codec=codec,
+            backup_info=plan["backup_info"],
+            base_files=plan["base_files"],
+            sqlite_snapshot=get_sqlite_snapshot(),
+            delta_min_mb=get_delta_min_mb(),
+            message=message,
+            label=label,
         )
+        if input_file is None:
+            await message.edit(
+                f"✅ 自上次备份（`{plan['chain'][-1]}`）以来没有文件变化，无需上传"
+            )
+            return
 
         # sessions 是否需要打包/上传由配置控制（upload_sessions: True/False）
         cfg = load_config()
         upload_sessions = bool(cfg.get("upload_sessions", False))
         sessions_created = None
         if upload_sessions:
-            sessions_created = create_sessions_archive(
-                sessions_path, program_dir=program_dir
+            sessions_created = await run_archive_job(
+                create_sessions_archive, sessions_path, program_dir=program_dir
             )
 
-        await message.edit("📤 正在上传备份...")
-        caption = f"📦 **Pagermaid标准备份**\n\n• 创建时间: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n• 包含: data (不含 session) + plugins\n• 备份类型: 标准配置备份"
+        await message.edit("📤 正在发送备份...")
+        caption = (
+            f"📦 **Pagermaid{'增量' if is_inc else '标准'}备份**\n\n"
+            f"• 创建时间: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+            f"• 包含: data (不含 session) + plugins\n"
+            f"{_standard_backup_caption_lines(plan, result)}"
+            f"• 备份类型: {'增量备份' if is_inc else '标准配置备份'}"
+        )
+        # 只上传一次，再按文件引用并发发送到各目标
         targets = get_target_chat_ids()
-        if targets:
-            # 多目标优化：先上传到收藏夹再转发（避免重复上传）
-            if len(targets) == 1:
-                await message.client.send_file(
-                    int(targets[0]), backup_path, caption=caption, force_document=True
-                )
-                if sessions_created:
-                    await message.client.send_file(
-                        int(targets[0]),
-                        sessions_created,
-                        caption="🔐 会话（session）备份 — 请妥善保管（敏感）",
-                        force_document=True,
-                    )
-            else:
-                sent_msg = await message.client.send_file(
-                    "me", backup_path, caption=caption, force_document=True
-                )
-                for tgt in targets:
-                    try:
-                        await message.client.forward_messages(int(tgt), sent_msg, "me")
-                    except Exception:
-                        await message.client.send_file(
-                            int(tgt), backup_path, caption=caption, force_document=True
-                        )
-                if sessions_created:
-                    sent_s = await message.client.send_file(
-                        "me",
-                        sessions_created,
-                        caption="🔐 会话（session）备份 — 请妥善保管（敏感）",
-                        force_document=True,
-                    )
-                    for tgt in targets:
-                        try:
-                            await message.client.forward_messages(
-                                int(tgt), sent_s, "me"
-                            )
-                        except Exception:
-                            await message.client.send_file(
-                                int(tgt),
-                                sessions_created,
-                                caption="🔐 会话（session）备份 — 请妥善保管（敏感）",
-                                force_document=True,
-                            )
-        else:
-            await message.client.send_file(
-                "me", backup_path, caption=caption, force_document=True
+        delivered, failed = await send_backup_to_targets(
+            message.client,
+            input_file,
+            caption,
+            targets,
+            catalog_entry=_catalog_entry(
+                plan["backup_type"], backup_name, plan, result["files"]
+            ),
+        )
+        if sessions_created:
+            await send_backup_to_targets(
+                message.client,
+                sessions_created,
+                "🔐 会话（session）备份 — 请妥善保管（敏感）",
+                targets,
             )
-            if sessions_created:
-                await message.client.send_file(
-                    "me",
-                    sessions_created,
-                    caption="🔐 会话（session）备份 — 请妥善保管（敏感）",
-                    force_document=True,
-                )
+        # 上传成功后才更新清单，保证增量链中的每个备份都已送达
+        save_manifest(plan["backup_id"], plan["chain"], result["files"])
 
         # 清理临时文件
-        try:
-            if os.path.exists(backup_path):
-                os.remove(backup_path)
-        except Exception:
-            pass
         try:
             if os.path.exists(sessions_path):
                 os.remove(sessions_path)
         except Exception:
             pass
 
-        if targets:
-            await message.edit(
-                f"✅ 标准备份已完成\n\n🎯 **已发送到:** {', '.join(targets)}\n📦 **包含:** 配置文件 + 插件（session 已单独处理）"
-            )
-        else:
-            await message.edit(
-                "✅ 标准备份已完成\n\n🎯 **已保存到:** 收藏夹\n📦 **包含:** 配置文件 + 插件（session 已单独处理）"
-            )
+        kind = "增量备份" if is_inc else "标准备份"
+        await message.edit(
+            f"✅ {kind}已完成\n\n{_format_delivery(delivered, failed)}\n📦 **包含:** 配置文件 + 插件（session 已单独处理）\n🆔 **备份ID:** `{plan['backup_id']}`"
+        )
     except Exception as e:
-        if "backup_path" in locals() and os.path.exists(backup_path):
-            os.remove(backup_path)
         if "sessions_path" in locals() and os.path.exists(sessions_path):
             os.remove(sessions_path)
         await message.edit(f"❌ 备份失败: {str(e)}")
 
 
 # hf 恢复命令
-@listener(command="hf", description="恢复备份命令，支持确认模式")
+@listener(
+    command="hf",
+    description="恢复备份命令，支持确认模式",
+    parameters="[list [类型] [日期] | <备份ID> | confirm]",
+)
 async def hf(message: Message):
     param = message.parameter
 
+    if param and param[0] == "list":
+        # hf list [类型] [YYYY-MM-DD|YYYY-MM|YYYY]
+        backup_type, date_prefix = None, None
+        for arg in param[1:]:
+            arg = arg.lower()
+            if arg in CATALOG_TYPES or arg in _CATALOG_TYPE_ALIASES:
+                backup_type = _CATALOG_TYPE_ALIASES.get(arg, arg)
+            elif re.fullmatch(r"\d{4}(-\d{2}){0,2}", arg):
+                date_prefix = arg
+            else:
+                await message.edit(
+                    "用法：`hf list [类型] [日期]`\n\n"
+                    f"• 类型：{' / '.join(CATALOG_TYPES)}（或 std / inc / all / p / pre）\n"
+                    "• 日期：`2024`、`2024-05` 或 `2024-05-01`\n"
+                    "• 恢复指定备份：`hf <ID>`"
+                )
+                return
+        entries = filter_catalog(backup_type, date_prefix)
+        if not entries:
+            await message.edit("📭 备份目录中没有符合条件的备份（目录只记录启用后上传的备份）")
+            return
+        lines = [f"🗂️ **备份目录**（共 {len(entries)} 个，显示最近 20 个）\n"]
+        for entry in entries[:20]:
+            size = entry.get("size")
+            size_text = f"{size / 1024 / 1024:.1f} MB" if size else "—"
+            lines.append(
+                f"• `{entry['key']}` {str(entry.get('created_at', ''))[:16].replace('T', ' ')} "
+                f"{CATALOG_TYPES.get(entry.get('type'), entry.get('type'))} {size_text}"
+            )
+        lines.append("\n恢复指定备份：`hf <ID>`")
+        await message.edit("\n".join(lines))
+        return
+
     # 检查是否有确认参数
     if not param or param[0] != "confirm":
         # 显示安全警告和确认信息
@@ -1314,6 +4017,7 @@ async def hf(message: Message):
 • 确认当前没有重要未保存的配置
 • 确认要恢复的备份是正确的版本
 • 系统会在确认后自动创建一次“防丢失全备份”并上传到收藏夹（无需手动运行 `bf`）
+• 增量备份（`bf inc`）会自动获取并依次恢复其所在的备份链
 
 🎯 **将要恢复的备份：**"""
 
@@ -1327,13 +4031,22 @@ async def hf(message: Message):
             except Exception:
                 replied_msg = None
 
-            # 优先使用用户回复的任何 .tar.gz 备份
-            if (
-                replied_msg
-                and getattr(replied_msg, "file", None)
-                and replied_msg.file.name
-                and replied_msg.file.name.endswith(".tar.gz")
-            ):
+            downloaded = False
+            if param and not (replied_msg and _is_backup_file_message(replied_msg)):
+                # hf <ID>：按备份目录直接定位消息
+                entry = find_catalog_entry(param[0])
+                if not entry:
+                    await message.edit(
+                        f"❌ 备份目录中没有 `{param[0]}`，可用 `hf list` 查看"
+                    )
+                    return
+                replied_msg = await _get_catalog_message(message.client, entry)
+                if not replied_msg:
+                    await message.edit(f"❌ 备份 `{param[0]}` 的消息已被删除或不可访问")
+                    return
+
+            # 优先使用用户回复（或按ID选择）的任何备份归档（.tar.gz / .tar.zst）
+            if replied_msg and _is_backup_file_message(replied_msg):
                 # 当对着备份文件恢复时：先自动下载文件用于后续确认恢复
                 program_dir = get_program_dir()
                 temp_dir = os.path.join(program_dir, "data")
@@ -1343,24 +4056,18 @@ async def hf(message: Message):
                 )
                 try:
                     if os.path.exists(selected_temp_path):
-                        os.remove(selected_temp_path)
+                        remove_backup_file(selected_temp_path)
                 except Exception:
                     pass
                 await message.edit("📥 正在下载你回复的备份文件...")
-                await message.client.download_media(
-                    replied_msg, file=selected_temp_path
+                await download_backup_file(
+                    message.client, replied_msg, selected_temp_path
                 )
                 backup_msg = replied_msg
+                downloaded = True
             else:
-                # 在收藏夹中查找最近的 .tar.gz 备份（兼容 bf / bf all / bf p 等不同命名）
-                async for msg in message.client.iter_messages("me", limit=50):
-                    if (
-                        getattr(msg, "file", None)
-                        and msg.file.name
-                        and msg.file.name.endswith(".tar.gz")
-                    ):
-                        backup_msg = msg
-                        break
+                # 最新的备份：优先查备份目录，必要时回退扫描收藏夹
+                backup_msg = await _latest_backup_message(message.client)
 
             if not backup_msg:
                 await message.edit(
@@ -1371,15 +4078,19 @@ async def hf(message: Message):
             # 解析备份文件信息
             file_name = backup_msg.file.name
             file_size = round(backup_msg.file.size / 1024 / 1024, 2)  # MB
+            volume_index = read_volume_index(selected_temp_path) if downloaded else None
+            if volume_index:
+                file_size = (
+                    f"{round(volume_index['total_size'] / 1024 / 1024, 2)} MB"
+                    f"（{len(volume_index['volumes'])} 卷，已校验）"
+                )
+            else:
+                file_size = f"{file_size} MB"
             backup_date = backup_msg.date.strftime("%Y-%m-%d %H:%M:%S")
 
-            warning_text += f"\n• **文件名:** `{file_name}`\n• **文件大小:** {file_size} MB\n• **创建时间:** {backup_date}\n\n"
-            # 若来自回复，已在上方自动下载，无需再次下载
-            if (
-                replied_msg
-                and backup_msg
-                and (backup_msg.id == getattr(replied_msg, "id", None))
-            ):
+            warning_text += f"\n• **文件名:** `{file_name}`\n• **文件大小:** {file_size}\n• **创建时间:** {backup_date}\n\n"
+            # 若来自回复或按ID选择，已在上方自动下载，无需再次下载
+            if downloaded:
                 warning_text += """已自动下载该备份文件。
 ✅ **确认恢复请输入:**
 `hf confirm`
@@ -1406,7 +4117,6 @@ async def hf(message: Message):
             program_dir, "data", "_hf_selected_backup.tar.gz"
         )
         pgm_backup_zip_name = None
-        temp_extract_dir = None
 
         if os.path.exists(selected_temp_path):
             await message.edit(
@@ -1425,72 +4135,31 @@ async def hf(message: Message):
             except Exception:
                 replied_msg = None
 
-            # 再次优先使用用户回复的任何 .tar.gz 备份
-            if (
-                replied_msg
-                and getattr(replied_msg, "file", None)
-                and replied_msg.file.name
-                and replied_msg.file.name.endswith(".tar.gz")
-            ):
+            # 再次优先使用用户回复的任何备份归档
+            if replied_msg and _is_backup_file_message(replied_msg):
                 backup_msg = replied_msg
             else:
-                async for msg in message.client.iter_messages("me", limit=50):
-                    if (
-                        getattr(msg, "file", None)
-                        and msg.file.name
-                        and msg.file.name.endswith(".tar.gz")
-                    ):
-                        backup_msg = msg
-                        break
+                backup_msg = await _latest_backup_message(message.client)
 
             if not backup_msg:
                 await message.edit("❌ **恢复失败**\n\n• 未找到任何备份文件")
                 return
 
             await message.edit("📥 **正在下载备份文件...**")
-            pgm_backup_zip_name = await message.client.download_media(
-                backup_msg, file="pagermaid_backup.tar.gz"
+            pgm_backup_zip_name = await download_backup_file(
+                message.client, backup_msg, "pagermaid_backup.tar.gz"
             )
 
-        await message.edit("🗃️ **正在解压备份文件...**")
         program_dir = get_program_dir()
 
-        # 使用临时目录解压，避免直接解压到根目录导致混乱
-        temp_extract_dir = os.path.join(program_dir, "_tmp_restore")
-        try:
-            if os.path.exists(temp_extract_dir):
-                shutil.rmtree(temp_extract_dir)
-            os.makedirs(temp_extract_dir, exist_ok=True)
-        except Exception:
-            pass
-
-        if not un_tar_gz(pgm_backup_zip_name, temp_extract_dir):
-            os.remove(pgm_backup_zip_name)
-            if os.path.exists(temp_extract_dir):
-                shutil.rmtree(temp_extract_dir)
-            await message.edit(
-                "❌ **解压失败**\n\n• 备份文件可能损坏\n• 请重新下载备份"
+        # 增量备份：先按链下载全量及之前的增量，恢复时依次应用
+        chain_paths = []
+        backup_info = read_backup_info(pgm_backup_zip_name)
+        if backup_info and backup_info.get("backup_type") == "incremental":
+            chain_paths = await _download_backup_chain(
+                message.client, backup_info.get("chain", []), message
             )
-            return
-
-        # 删除压缩包
-        os.remove(pgm_backup_zip_name)
-
-        # 尝试识别备份根目录
-        final_backup_folder = os.path.join(temp_extract_dir, "pagermaid_backup")
-        if not os.path.exists(final_backup_folder):
-            # 兼容旧包结构：取临时目录下的唯一顶级目录，或直接使用临时目录
-            top_items = [
-                os.path.join(temp_extract_dir, x) for x in os.listdir(temp_extract_dir)
-            ]
-            dirs = [p for p in top_items if os.path.isdir(p)]
-            files = [p for p in top_items if os.path.isfile(p)]
-            if len(dirs) == 1 and not files:
-                final_backup_folder = dirs[0]
-            elif {"data", "plugins"} & {os.path.basename(d) for d in dirs}:
-                final_backup_folder = temp_extract_dir
-            else:
-                raise Exception("备份包结构异常：缺少 data/plugins 目录")
+        archives = chain_paths + [pgm_backup_zip_name]
 
         # 恢复前自动创建一次当前状态的标准全备份（data+plugins）到收藏夹
         try:
@@ -1499,74 +4168,66 @@ async def hf(message: Message):
             import datetime
 
             now_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            safe_backup_filename = f"pre_restore_backup_{now_str}.tar.gz"
-            create_tar_gz([data_dir, plugins_dir], safe_backup_filename)
+            codec, codec_level = get_backup_codec()
+            safe_backup_filename = f"pre_restore_backup_{now_str}{_archive_ext(codec)}"
+            _, input_file = await stream_archive_upload(
+                message.client,
+                create_tar_gz,
+                [data_dir, plugins_dir],
+                file_name=safe_backup_filename,
+                compresslevel=codec_level or 5,
+                codec=codec,
+                message=message,
+                label="🛟 正在创建恢复前备份",
+            )
             caption = f"🛟 恢复前自动全备份\n\n• 创建时间: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n• 包含: data + plugins"
-            await message.client.send_file("me", safe_backup_filename, caption=caption)
-            os.remove(safe_backup_filename)
+            await send_backup_to_targets(
+                message.client,
+                input_file,
+                caption,
+                catalog_entry=_catalog_entry("pre_restore", safe_backup_filename),
+            )
         except Exception:
             # 备份失败不阻塞恢复流程，仅忽略
             pass
 
-        await message.edit("🔄 **正在恢复文件...**")
-
-        # 将解压出的内容释放到程序根目录，跳过 session 文件（避免覆盖会话登陆状态）
-        def _is_session_file(path: str) -> bool:
-            name = os.path.basename(path)
-            return name.endswith(".session") or name.endswith(".session-journal")
-
-        for item in os.listdir(final_backup_folder):
-            src_path = os.path.join(final_backup_folder, item)
-            dest_path = os.path.join(program_dir, item)
-            if os.path.isdir(src_path):
-                # 目录复制：逐文件遍历以跳过 session 文件
-                for root, dirs, files in os.walk(src_path):
-                    rel_root = os.path.relpath(root, src_path)
-                    target_root = (
-                        os.path.join(dest_path, rel_root)
-                        if rel_root != "."
-                        else dest_path
-                    )
-                    os.makedirs(target_root, exist_ok=True)
-                    for fname in files:
-                        s = os.path.join(root, fname)
-                        if _is_session_file(s):
-                            continue
-                        d = os.path.join(target_root, fname)
-                        os.makedirs(os.path.dirname(d), exist_ok=True)
-                        shutil.copy2(s, d)
-            else:
-                if _is_session_file(src_path):
-                    continue
-                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                shutil.copy2(src_path, dest_path)
+        # 流式恢复：成员直接写到最终位置旁的临时文件，校验通过后原子替换，未变化的文件跳过
+        totals = {"written": 0, "skipped": 0, "deleted": 0}
+        for idx, archive in enumerate(archives, 1):
+            step = f" ({idx}/{len(archives)})" if len(archives) > 1 else ""
+            await message.edit(f"🔄 **正在恢复文件{step}...**")
+            try:
+                stats = await run_archive_job(
+                    restore_backup_archive, archive, program_dir
+                )
+            except Exception as e:
+                print(f"恢复失败: {e}")
+                for path in chain_paths + [pgm_backup_zip_name]:
+                    remove_backup_file(path)
+                await message.edit(
+                    f"❌ **解压失败{step}**\n\n• 备份文件可能损坏\n• 请重新下载备份"
+                )
+                return
+            for key in totals:
+                totals[key] += stats[key]
 
-        # 清理临时目录
-        shutil.rmtree(temp_extract_dir, ignore_errors=True)
-        # 如使用了预下载的临时文件，恢复完成后删除
-        try:
-            if pgm_backup_zip_name == selected_temp_path and os.path.exists(
-                selected_temp_path
-            ):
-                os.remove(selected_temp_path)
-        except Exception:
-            pass
+            # 清理已应用的链上备份
+            if archive in chain_paths:
+                remove_backup_file(archive)
+
+        # 删除压缩包（分卷备份连同各卷）
+        remove_backup_file(pgm_backup_zip_name)
 
+        summary = f"• 已更新 {totals['written']} 个文件，{totals['skipped']} 个未变化已跳过"
+        if totals["deleted"]:
+            summary += f"，删除 {totals['deleted']} 个"
         await message.edit(
-            "✅ **备份恢复完成**\n\n• 所有文件已恢复\n• 已在收藏夹保存恢复前的全备份\n• 请输入 `-restart` 重启生效"
+            f"✅ **备份恢复完成**\n\n{summary}\n"
+            "• 已在收藏夹保存恢复前的全备份\n• 请输入 `-restart` 重启生效"
         )
 
     except Exception as e:
         # 失败时尽量清理临时资源
-        try:
-            if (
-                "temp_extract_dir" in locals()
-                and temp_extract_dir
-                and os.path.exists(temp_extract_dir)
-            ):
-                shutil.rmtree(temp_extract_dir, ignore_errors=True)
-        except Exception:
-            pass
         try:
             if (
                 "pgm_backup_zip_name" in locals()
@@ -1577,7 +4238,12 @@ async def hf(message: Message):
                 if pgm_backup_zip_name.endswith(
                     "pagermaid_backup.tar.gz"
                 ) or pgm_backup_zip_name.endswith("_hf_selected_backup.tar.gz"):
-                    os.remove(pgm_backup_zip_name)
+                    remove_backup_file(pgm_backup_zip_name)
+        except Exception:
+            pass
+        try:
+            for path in locals().get("chain_paths") or []:
+                remove_backup_file(path)
         except Exception:
             pass
         await message.edit(
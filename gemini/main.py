@@ -1,11 +1,18 @@
 import traceback
+import hashlib
 import html
+import json
 import io
 import httpx
 import re
 import importlib
 import os
 import asyncio
+import random
+import sqlite3
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from pagermaid.enums import Message
 from pagermaid.listener import listener
@@ -15,8 +22,11 @@ from pagermaid.utils import alias_command, pip_install
 from PIL import Image
 from telethon.errors import MessageTooLongError, MessageEmptyError
 from telethon.extensions import html as tg_html
+from telethon.helpers import generate_random_long
+from telethon.tl.functions.upload import SaveFilePartRequest
 from telethon.tl.types import (
-    MessageEntityBlockquote, MessageEntityItalic, MessageEntityBold
+    MessageEntityBlockquote, MessageEntityItalic, MessageEntityBold, MessageEntityCode,
+    MessageEntityPre, MessageEntityStrike, MessageEntityTextUrl, DocumentAttributeAudio, InputFile
 )
 
 # Dependencies
@@ -38,8 +48,9 @@ import markdown
 import emoji
 from google import genai
 from google.genai import types
-from telegraph import Telegraph
-from bs4 import BeautifulSoup
+from telegraph.exceptions import RetryAfterError, TelegraphException
+from telegraph.utils import html_to_nodes
+from bs4 import BeautifulSoup, SoupStrainer
 
 
 class Config:
@@ -66,6 +77,12 @@ class Config:
     TELEGRAPH_POSTS = f"{PREFIX}telegraph_posts"
     COLLAPSIBLE_QUOTE_ENABLED = f"{PREFIX}collapsible_quote_enabled"
     BASE_URL = f"{PREFIX}base_url"
+    STREAM_ENABLED = f"{PREFIX}stream_enabled"
+    CONTEXT_TOKEN_BUDGET = f"{PREFIX}context_token_budget"
+    CACHE_ENABLED = f"{PREFIX}cache_enabled"
+    CACHE_TTL = f"{PREFIX}cache_ttl"
+    RATE_LIMIT = f"{PREFIX}rate_limit"
+    TOKEN_CALIBRATION = f"{PREFIX}token_calibration"
 
     # Defaults
     DEFAULT_CHAT_MODEL = "gemini-2.0-flash"
@@ -73,6 +90,37 @@ class Config:
     DEFAULT_IMAGE_MODEL = "gemini-2.0-flash-preview-image-generation"
     DEFAULT_TTS_MODEL = "gemini-2.5-flash-preview-tts"
     DEFAULT_TTS_VOICE = "Laomedeia"
+    STREAM_EDIT_INTERVAL = 1.5  # seconds between progressive edits
+    TELEGRAM_MAX_LENGTH = 4096
+    DEFAULT_CONTEXT_TOKEN_BUDGET = 8000
+    HISTORY_DB_PATH = "data/gemini/history.db"
+    HISTORY_CACHE_CHATS = 64  # chats kept in memory
+    HISTORY_IDLE_SECONDS = 1800  # idle chats are evicted from memory after this
+    CACHE_DB_PATH = "data/gemini/cache.db"
+    CACHE_MAX_ENTRIES = 500
+    DEFAULT_CACHE_TTL_HOURS = 24
+    FILES_API_THRESHOLD = 1024 * 1024  # media at least this large goes through the Files API
+    FILES_API_MAX_SIZE = 2000 * 1024 * 1024
+    INLINE_MAX_SIZE = 19.5 * 1024 * 1024
+    FILES_EXPIRY_MARGIN = 3600  # do not reuse uploads that expire within this many seconds
+    MEDIA_TOKEN_ESTIMATE = 258
+    TELEGRAPH_CONCURRENCY = 8  # parallel page edits for `telegraph del all`
+    TELEGRAPH_CACHE_ENTRIES = 128  # fetched articles kept in memory
+    TELEGRAPH_CACHE_TTL = 600  # seconds before a cached article is revalidated
+    TTS_UPLOAD_PART_SIZE = 64 * 1024  # must divide 512KB
+    TTS_UPLOAD_CONCURRENCY = 4
+    TTS_TOKEN_LIMIT = 1500  # per TTS request
+    BATCH_CONCURRENCY = 4
+    BATCH_MAX_ITEMS = 100
+    BATCH_MAX_FILE_SIZE = 1024 * 1024
+    TTS_MAX_SEGMENTS = 4  # longer text is spoken in up to this many requests
+    TOKEN_CALIBRATION_SAMPLES = 50
+    TOKEN_MARGIN_MIN = 0.1  # safety margin on top of the calibrated estimate
+    TOKEN_MARGIN_MAX = 0.5
+    TOKEN_EXACT_CACHE = 512  # exact counts remembered by text hash
+    SCHEDULER_WORKERS = 4  # concurrent Gemini calls
+    MAX_RETRIES = 4  # retries after a 429
+    RETRY_BASE_DELAY = 2.0  # seconds, doubled on each retry
 
     # Model Lists
     SEARCH_MODELS = ["gemini-2.5-flash", "gemini-2.5-flash-lite", "gemini-2.0-flash"]
@@ -82,58 +130,448 @@ class Config:
 
 # --- Telegraph Setup ---
 
+_HTTP_CLIENT: httpx.AsyncClient | None = None
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Shared HTTP client so Telegraph calls reuse pooled keep-alive connections."""
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None or _HTTP_CLIENT.is_closed:
+        _HTTP_CLIENT = httpx.AsyncClient(
+            timeout=30, limits=httpx.Limits(max_connections=20, max_keepalive_connections=10))
+    return _HTTP_CLIENT
+
+
+class _TelegraphClient:
+    """Minimal async Telegraph API client on the shared HTTP connection pool."""
+
+    def __init__(self, access_token: str | None = None):
+        self.access_token = access_token
+
+    async def method(self, name: str, values: dict | None = None, path: str = "") -> dict:
+        values = dict(values or {})
+        if self.access_token:
+            values.setdefault("access_token", self.access_token)
+        response = await _get_http_client().post(f"https://api.telegra.ph/{name}/{path}", data=values)
+        result = response.json()
+        if result.get("ok"):
+            return result["result"]
+        error = result.get("error")
+        if isinstance(error, str) and error.startswith("FLOOD_WAIT_"):
+            raise RetryAfterError(int(error.rsplit("_", 1)[-1]))
+        raise TelegraphException(error)
+
+    async def create_account(self, short_name: str) -> dict:
+        result = await self.method("createAccount", {"short_name": short_name})
+        self.access_token = result["access_token"]
+        return result
+
+    async def create_page(self, title: str, content: list) -> dict:
+        return await self.method("createPage", {
+            "title": title, "content": json.dumps(content, ensure_ascii=False), "return_content": "false"})
+
+    async def edit_page(self, path: str, title: str, content: list) -> dict:
+        return await self.method("editPage", {
+            "title": title, "content": json.dumps(content, ensure_ascii=False), "return_content": "false"},
+            path=path)
+
+
+class _TelegraphPageCache:
+    """LRU of extracted article text by URL; stale entries are revalidated with ETag/Last-Modified."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+
+    @staticmethod
+    def key(url: str) -> str:
+        return url.split("#", 1)[0].split("?", 1)[0].rstrip("/")
+
+    def get(self, url: str) -> dict | None:
+        entry = self._entries.get(self.key(url))
+        if entry is not None:
+            self._entries.move_to_end(self.key(url))
+        return entry
+
+    def fresh(self, url: str) -> str | None:
+        entry = self.get(url)
+        return entry["text"] if entry and time.monotonic() - entry["checked_at"] < self.ttl else None
+
+    def put(self, url: str, text: str, etag: str | None = None, last_modified: str | None = None):
+        self._entries[self.key(url)] = {"text": text, "etag": etag, "last_modified": last_modified,
+                                        "checked_at": time.monotonic()}
+        self._entries.move_to_end(self.key(url))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, url: str):
+        self._entries.pop(self.key(url), None)
+
+
+_TELEGRAPH_PAGES = _TelegraphPageCache(Config.TELEGRAPH_CACHE_ENTRIES, Config.TELEGRAPH_CACHE_TTL)
+
+
 async def _get_telegraph_content(url: str) -> str | None:
-    """Fetches and parses content from a Telegraph URL."""
+    """Fetches and parses content from a Telegraph URL, served from the page cache when possible."""
+    if (text := _TELEGRAPH_PAGES.fresh(url)) is not None:
+        return text
+    cached = _TELEGRAPH_PAGES.get(url)
+    headers = {}
+    if cached and cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached["last_modified"]:
+        headers["If-Modified-Since"] = cached["last_modified"]
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'html.parser')
-            article = soup.find('article')
-            return article.get_text(separator='\n', strip=True) if article else None
+        response = await _get_http_client().get(url, headers=headers, follow_redirects=True)
+        if response.status_code == 304 and cached:
+            _TELEGRAPH_PAGES.put(url, cached["text"], cached["etag"], cached["last_modified"])
+            return cached["text"]
+        response.raise_for_status()
+        # Only the <article> element is parsed; the rest of the page is skipped.
+        soup = BeautifulSoup(response.text, 'html.parser', parse_only=SoupStrainer('article'))
+        article = soup.find('article')
+        if not article:
+            return None
+        text = article.get_text(separator='\n', strip=True)
+        _TELEGRAPH_PAGES.put(url, text, response.headers.get("etag"), response.headers.get("last-modified"))
+        return text
     except (httpx.HTTPStatusError, httpx.RequestError):
         return None
     except Exception:
         return None
 
 
-def _format_text_for_telegram(text: str) -> str:
-    """Formats markdown text to HTML suitable for Telegram."""
+def _telegraph_nodes_text(nodes: list) -> str:
+    """Plain text of Telegraph nodes, laid out like the text extracted from a fetched article."""
+    lines = []
+
+    def walk(node, line: list):
+        if isinstance(node, str):
+            line.append(node)
+            return
+        if node.get("tag") in ("br", "hr"):
+            lines.append("".join(line))
+            line.clear()
+            return
+        for child in node.get("children", []):
+            walk(child, line)
+
+    for block in nodes:
+        if isinstance(block, dict) and block.get("tag") in ("ul", "ol", "blockquote"):
+            for child in block.get("children", []):
+                line = []
+                walk(child, line)
+                lines.append("".join(line))
+        else:
+            line = []
+            walk(block, line)
+            lines.append("".join(line))
+    return "\n".join(line.strip() for line in lines if line.strip())
+
+
+# --- Markdown Rendering ---
+# Model output is parsed once into a small block/inline tree, which is then rendered either to
+# plain text + Telegram entities (UTF-16 offsets tracked while writing) or to Telegraph nodes.
+# Blocks: ("p", inlines), ("h", level, inlines), ("pre", lang, text), ("hr",),
+#         ("quote", blocks), ("list", ordered, start, [blocks, ...]).
+# Inlines: str, ("code", text), ("b" | "i" | "s", inlines), ("a", inlines, url).
+
+_MD_FENCE_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})\s*([\w+#.-]*)")
+_MD_HEADING_RE = re.compile(r"^ {0,3}(#{1,6})\s+(.*?)(?:\s+#+)?\s*$")
+_MD_HR_RE = re.compile(r"^ {0,3}([-*_])(?:\s*\1){2,}\s*$")
+_MD_QUOTE_RE = re.compile(r"^ {0,3}>\s?(.*)$")
+_MD_LIST_RE = re.compile(r"^( *)([-*+]|\d{1,9}[.)])\s+(.*)$")
+_MD_INLINE_RE = re.compile(
+    r"\\(?P<escaped>[\\`*_{}\[\]()#+\-.!~>|])"
+    r"|(?P<code>`+)(?P<code_text>.+?)(?P=code)"
+    r"|\[(?P<link_text>[^\]\n]+)\]\((?P<link_url>[^)\s]+)(?:\s+\"[^\"]*\")?\)"
+    r"|<(?P<autolink>https?://[^>\s]+)>"
+    r"|(?P<bold>\*\*|__)(?=\S)(?P<bold_text>.+?)(?<=\S)(?P=bold)(?![*_])"
+    r"|~~(?=\S)(?P<strike_text>.+?)(?<=\S)~~"
+    r"|\*(?=[^\s*])(?P<em_star>.+?)(?<=[^\s*])\*"
+    r"|(?<!\w)_(?=[^\s_])(?P<em_under>.+?)(?<=[^\s_])_(?!\w)"
+)
+
+
+def _parse_inline(text: str) -> list:
+    nodes, pos = [], 0
+    for m in _MD_INLINE_RE.finditer(text):
+        if m.start() > pos:
+            nodes.append(text[pos:m.start()])
+        pos = m.end()
+        if m.group("escaped") is not None:
+            nodes.append(m.group("escaped"))
+        elif m.group("code") is not None:
+            nodes.append(("code", m.group("code_text").strip()))
+        elif m.group("link_text") is not None:
+            nodes.append(("a", _parse_inline(m.group("link_text")), m.group("link_url")))
+        elif m.group("autolink") is not None:
+            nodes.append(("a", [m.group("autolink")], m.group("autolink")))
+        elif m.group("bold") is not None:
+            nodes.append(("b", _parse_inline(m.group("bold_text"))))
+        elif m.group("strike_text") is not None:
+            nodes.append(("s", _parse_inline(m.group("strike_text"))))
+        else:
+            nodes.append(("i", _parse_inline(m.group("em_star") or m.group("em_under"))))
+    if pos < len(text):
+        nodes.append(text[pos:])
+    return nodes
+
+
+def _leading_spaces(line: str) -> int:
+    return len(line) - len(line.lstrip(" "))
+
+
+def _parse_list(lines: list[str], i: int) -> tuple[tuple, int]:
+    first = _MD_LIST_RE.match(lines[i])
+    indent, ordered = len(first.group(1)), first.group(2)[0].isdigit()
+    start = int(first.group(2)[:-1]) if ordered else 1
+
+    def is_sibling(line: str) -> bool:
+        m = _MD_LIST_RE.match(line)
+        return bool(m) and abs(len(m.group(1)) - indent) <= 1 and m.group(2)[0].isdigit() == ordered
+
+    items, n = [], len(lines)
+    while i < n and is_sibling(lines[i]):
+        m = _MD_LIST_RE.match(lines[i])
+        content_col = len(m.group(1)) + len(m.group(2)) + 1
+        body = [m.group(3)]
+        i += 1
+        while i < n:
+            line = lines[i]
+            if not line.strip():
+                # A blank line keeps the list going only if indented content or a sibling item follows.
+                j = i
+                while j < n and not lines[j].strip():
+                    j += 1
+                if j < n and is_sibling(lines[j]):
+                    i = j
+                    break
+                if j < n and _leading_spaces(lines[j]) > indent:
+                    body.extend([""] * (j - i))
+                    i = j
+                    continue
+                break
+            lead = _leading_spaces(line)
+            if lead <= indent + 1 and (_MD_LIST_RE.match(line) or lead <= indent):
+                break
+            body.append(line[min(lead, content_col):])
+            i += 1
+        items.append(_parse_blocks(body))
+    return ("list", ordered, start, items), i
+
+
+def _parse_blocks(lines: list[str]) -> list:
+    blocks, paragraph, i, n = [], [], 0, len(lines)
+
+    def flush():
+        if paragraph:
+            blocks.append(("p", _parse_inline("\n".join(paragraph))))
+            paragraph.clear()
+
+    while i < n:
+        line = lines[i]
+        if not line.strip():
+            flush()
+            i += 1
+            continue
+        if m := _MD_FENCE_RE.match(line):
+            flush()
+            fence, body = m.group(1), []
+            closing = re.compile(rf"^ {{0,3}}{re.escape(fence[0])}{{{len(fence)},}}\s*$")
+            i += 1
+            # An unterminated fence (e.g. a partial streamed reply) runs to the end of the text.
+            while i < n and not closing.match(lines[i]):
+                body.append(lines[i])
+                i += 1
+            blocks.append(("pre", m.group(2), "\n".join(body)))
+            i += 1
+        elif m := _MD_HEADING_RE.match(line):
+            flush()
+            blocks.append(("h", len(m.group(1)), _parse_inline(m.group(2))))
+            i += 1
+        elif _MD_HR_RE.match(line):
+            flush()
+            blocks.append(("hr",))
+            i += 1
+        elif _MD_QUOTE_RE.match(line):
+            flush()
+            quoted = []
+            while i < n and (m := _MD_QUOTE_RE.match(lines[i])):
+                quoted.append(m.group(1))
+                i += 1
+            blocks.append(("quote", _parse_blocks(quoted)))
+        elif _MD_LIST_RE.match(line):
+            flush()
+            block, i = _parse_list(lines, i)
+            blocks.append(block)
+        else:
+            paragraph.append(line.strip())
+            i += 1
+    flush()
+    return blocks
+
+
+def _parse_markdown(text: str) -> list:
+    """Parses model markdown into the block tree shared by the Telegram and Telegraph renderers."""
+    return _parse_blocks(text.replace("\r\n", "\n").expandtabs(4).split("\n"))
+
+
+_ENTITY_TYPES = {"b": MessageEntityBold, "i": MessageEntityItalic, "s": MessageEntityStrike}
+
+
+class _EntityRenderer:
+    """Writes a markdown tree as plain text, recording entities at their UTF-16 offsets."""
+
+    def __init__(self):
+        self.parts = []
+        self.pos = 0
+        self.entities = []
+
+    def write(self, text: str):
+        if text:
+            self.parts.append(text)
+            self.pos += _get_utf16_length(text)
+
+    def wrap(self, entity_type, start: int, **kwargs):
+        if self.pos > start:
+            self.entities.append(entity_type(offset=start, length=self.pos - start, **kwargs))
+
+    def inline(self, nodes: list):
+        for node in nodes:
+            if isinstance(node, str):
+                self.write(node)
+                continue
+            start = self.pos
+            if node[0] == "code":
+                self.write(node[1])
+                self.wrap(MessageEntityCode, start)
+                continue
+            self.inline(node[1])
+            if node[0] == "a":
+                self.wrap(MessageEntityTextUrl, start, url=node[2])
+            else:
+                self.wrap(_ENTITY_TYPES[node[0]], start)
+
+    def blocks(self, blocks: list, indent: str = "", separator: str = "\n\n"):
+        for index, block in enumerate(blocks):
+            if index:
+                self.write(separator)
+            start, kind = self.pos, block[0]
+            if kind == "p":
+                self.inline(block[1])
+            elif kind == "h":
+                self.inline(block[2])
+                self.wrap(MessageEntityBold, start)
+            elif kind == "pre":
+                self.write(block[2] or " ")
+                self.wrap(MessageEntityPre, start, language=block[1])
+            elif kind == "hr":
+                self.write("──────────")
+            elif kind == "quote":
+                # The whole reply already sits in a blockquote, and Telegram does not nest them.
+                self.blocks(block[1], indent, "\n")
+                self.wrap(MessageEntityItalic, start)
+            elif kind == "list":
+                _, ordered, first, items = block
+                for number, item in enumerate(items, first):
+                    if number > first:
+                        self.write("\n")
+                    self.write(f"{indent}{number}. " if ordered else f"{indent}• ")
+                    self.blocks(item, indent + "    ", "\n")
+
+    def result(self) -> tuple[str, list]:
+        self.entities.sort(key=lambda e: (e.offset, -e.length))
+        return "".join(self.parts), self.entities
+
+
+def _render_entities(tree: list) -> tuple[str, list]:
+    """Renders a parsed markdown tree to text and Telegram message entities."""
+    renderer = _EntityRenderer()
+    renderer.blocks(tree)
+    return renderer.result()
+
+
+_TELEGRAPH_INLINE_TAGS = {"b": "strong", "i": "em", "s": "s"}
+
+
+def _inline_to_telegraph(nodes: list) -> list:
+    result = []
+    for node in nodes:
+        if isinstance(node, str):
+            for index, line in enumerate(node.split("\n")):
+                if index:
+                    result.append({"tag": "br"})
+                if line:
+                    result.append(line)
+        elif node[0] == "code":
+            result.append({"tag": "code", "children": [node[1]]})
+        elif node[0] == "a":
+            result.append({"tag": "a", "attrs": {"href": node[2]}, "children": _inline_to_telegraph(node[1])})
+        else:
+            result.append({"tag": _TELEGRAPH_INLINE_TAGS[node[0]], "children": _inline_to_telegraph(node[1])})
+    return result
+
+
+def _render_telegraph_nodes(tree: list) -> list:
+    """Renders a parsed markdown tree to Telegraph node JSON (only tags Telegraph accepts)."""
+    result = []
+    for block in tree:
+        kind = block[0]
+        if kind == "p":
+            result.append({"tag": "p", "children": _inline_to_telegraph(block[1])})
+        elif kind == "h":
+            result.append({"tag": "h3" if block[1] <= 2 else "h4", "children": _inline_to_telegraph(block[2])})
+        elif kind == "pre":
+            result.append({"tag": "pre", "children": [block[2]]})
+        elif kind == "hr":
+            result.append({"tag": "hr"})
+        elif kind == "quote":
+            result.append({"tag": "blockquote", "children": _render_telegraph_nodes(block[1])})
+        elif kind == "list":
+            items = []
+            for item in block[3]:
+                # Tight items (a single paragraph) go straight into the <li>.
+                children = _inline_to_telegraph(item[0][1]) if len(item) == 1 and item[0][0] == "p" \
+                    else _render_telegraph_nodes(item)
+                items.append({"tag": "li", "children": children})
+            result.append({"tag": "ol" if block[1] else "ul", "children": items})
+    return result
+
+
+def _legacy_render(text: str) -> tuple[tuple[str, list], list]:
+    """The previous markdown → HTML → BeautifulSoup → HTML-parser path, kept as the `gemini bench` baseline."""
     html_output = markdown.markdown(text, extensions=['fenced_code'])
     soup = BeautifulSoup(html_output, "html.parser")
     for tag in soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6']):
         tag.name = 'b'
         tag.insert_after(BeautifulSoup("<br>", "html.parser"))
-    return str(soup)
+    html_output = str(soup)
+    parsed = tg_html.parse(html_output)
+    _get_utf16_length(parsed[0])
+    allowed = {'a', 'aside', 'b', 'blockquote', 'br', 'code', 'em', 'figcaption', 'figure', 'h3', 'h4',
+               'hr', 'i', 'iframe', 'img', 'li', 'ol', 'p', 'pre', 's', 'strong', 'u', 'ul', 'video'}
+    soup = BeautifulSoup(html_output, 'html.parser')
+    for tag in soup.find_all(True):
+        if tag.name not in allowed:
+            tag.unwrap()
+    return parsed, html_to_nodes(str(soup))
 
 
-def _get_telegraph_client():
+async def _get_telegraph_client() -> _TelegraphClient:
     """Creates or retrieves a Telegraph client."""
     token = db.get(Config.TELEGRAPH_TOKEN)
     if not token:
-        telegraph = Telegraph()
-        telegraph.create_account(short_name='PagerMaid-Gemini')
-        token = telegraph.get_access_token()
+        telegraph = _TelegraphClient()
+        await telegraph.create_account(short_name='PagerMaid-Gemini')
+        token = telegraph.access_token
         db[Config.TELEGRAPH_TOKEN] = token
-    return Telegraph(access_token=token)
+    return _TelegraphClient(access_token=token)
 
 
 # --- Helper Functions ---
 
-def _sanitize_html_for_telegraph(html_content: str) -> str:
-    """Sanitizes HTML to prevent invalid tag errors from Telegraph."""
-    ALLOWED_TAGS = {
-        'a', 'aside', 'b', 'blockquote', 'br', 'code', 'em', 'figcaption',
-        'figure', 'h3', 'h4', 'hr', 'i', 'iframe', 'img', 'li', 'ol', 'p',
-        'pre', 's', 'strong', 'u', 'ul', 'video'
-    }
-    soup = BeautifulSoup(html_content, 'html.parser')
-    for tag in soup.find_all(True):
-        if tag.name not in ALLOWED_TAGS:
-            tag.unwrap()
-    return str(soup)
-
-
 async def _send_usage(message: Message, command: str, usage: str):
     """Sends a formatted usage message."""
     await message.edit(f"<b>用法:</b> <code>,{alias_command('gemini')} {command} {usage}</code>", parse_mode='html')
@@ -179,6 +617,8 @@ async def _get_text_from_potential_telegraph(text: str, message_for_edit: Messag
     if not text:
         return ""
     if match := re.search(r'https://telegra\.ph/([\w/-]+)', text):
+        if (content := _TELEGRAPH_PAGES.fresh(match.group(0))) is not None:
+            return content
         await message_for_edit.edit("正在提取 Telegraph 链接内容...", parse_mode='html')
         content = await _get_telegraph_content(match.group(0))
         await message_for_edit.edit("💬 思考中...", parse_mode='html')
@@ -199,24 +639,30 @@ async def _get_full_content(message: Message, args: str) -> list | None:
         message_with_media = reply
 
     if message_with_media:
-        if db.get(Config.CONTEXT_ENABLED):
-            await _show_error(message, "启用对话历史记录时不支持文件上下文。")
-            return None
-
         if message_with_media.file and message_with_media.file.size:
-            if message_with_media.file.size > 19.5 * 1024 * 1024:
+            size = message_with_media.file.size
+            # History can only keep references, so context mode always uses the Files API.
+            if db.get(Config.CONTEXT_ENABLED) or size >= Config.FILES_API_THRESHOLD:
+                if size > Config.FILES_API_MAX_SIZE:
+                    await _show_error(message, "文件大小超过 2000MB 限制。")
+                    return None
+                part = await _get_gemini_file_part(message, message_with_media)
+                if part is None:
+                    return None
+                content_parts.append(part)
+            elif size > Config.INLINE_MAX_SIZE:
                 await _show_error(message, "文件大小超过 19.5MB 限制。")
                 return None
+            else:
+                media_bytes = await message_with_media.download_media(bytes)
+                mime_type = message_with_media.file.mime_type
 
-            media_bytes = await message_with_media.download_media(bytes)
-            mime_type = message_with_media.file.mime_type
-
-            if message_with_media.photo or (
-                    hasattr(message_with_media, 'sticker') and message_with_media.sticker and mime_type and mime_type.startswith(
-                "image/")):
-                content_parts.append(Image.open(io.BytesIO(media_bytes)))
-            elif mime_type:
-                content_parts.append(types.Part(inline_data=types.Blob(mime_type=mime_type, data=media_bytes)))
+                if message_with_media.photo or (
+                        hasattr(message_with_media, 'sticker') and message_with_media.sticker and mime_type and mime_type.startswith(
+                    "image/")):
+                    content_parts.append(Image.open(io.BytesIO(media_bytes)))
+                elif mime_type:
+                    content_parts.append(types.Part(inline_data=types.Blob(mime_type=mime_type, data=media_bytes)))
 
     if reply and not reply.sticker and reply.text:
         replied_text = _remove_gemini_footer(reply.text)
@@ -233,28 +679,613 @@ async def _get_full_content(message: Message, args: str) -> list | None:
 async def _handle_gemini_exception(message: Message, e: Exception, api_name: str = "Gemini API"):
     """Handles common exceptions from the Gemini API."""
     error_str = str(e)
-    if "429" in error_str and "ResourceExhausted" in error_str:
-        await message.edit(f"<b>调用 {api_name} 已达到速率限制。</b>\n<pre><code>{html.escape(error_str)}</code></pre>", parse_mode='html')
+    if _is_rate_limited(e):
+        await message.edit(f"<b>调用 {api_name} 已达到速率限制 (已自动重试 {Config.MAX_RETRIES} 次)。</b>\n<pre><code>{html.escape(error_str)}</code></pre>", parse_mode='html')
     else:
         await message.edit(f"调用 {api_name} 时出错:\n<pre><code>{html.escape(error_str)}</code></pre>", parse_mode='html')
 
 
+# --- Client Pool ---
+# genai.Client owns an HTTP session; reusing it keeps connections (and TLS sessions) warm.
+_CLIENT_POOL: dict[tuple[str, str | None], genai.Client] = {}
+_CLIENT_POOL_STATS = {"created": 0, "reused": 0}
+
+
+def _pooled_client(api_key: str, base_url: str | None) -> genai.Client:
+    """Returns the shared client for (api_key, base_url), creating it on first use."""
+    key = (api_key, base_url)
+    client = _CLIENT_POOL.get(key)
+    if client is not None:
+        _CLIENT_POOL_STATS["reused"] += 1
+        return client
+    headers = {"x-goog-api-key": api_key} if base_url else None
+    http_options = types.HttpOptions(base_url=base_url, headers=headers)
+    client = genai.Client(api_key=api_key, vertexai=False, http_options=http_options)
+    _CLIENT_POOL[key] = client
+    _CLIENT_POOL_STATS["created"] += 1
+    return client
+
+
+def _invalidate_client_pool():
+    """Closes and drops all pooled clients, e.g. after the API key or base URL changed."""
+    clients = list(_CLIENT_POOL.values())
+    _CLIENT_POOL.clear()
+    for client in clients:
+        try:
+            client.close()
+        except Exception:
+            pass
+
+
+def _client_pool_summary() -> str:
+    created, reused = _CLIENT_POOL_STATS["created"], _CLIENT_POOL_STATS["reused"]
+    total = created + reused
+    rate = f"{reused / total:.0%}" if total else "-"
+    return f"{len(_CLIENT_POOL)} 个活动, 新建 {created} 次, 复用 {reused} 次 (复用率 {rate})"
+
+
 async def _get_gemini_client(message: Message) -> genai.Client | None:
-    """Initializes and returns a Gemini client, handling API key and base URL."""
+    """Returns a pooled Gemini client for the configured API key and base URL."""
     api_key = db.get(Config.API_KEY)
     if not api_key:
         await message.edit(
             f"<b>未设置 Gemini API 密钥。</b> 请使用 <code>,{alias_command('gemini')} set_api_key [your_api_key]</code> 进行设置。",
             parse_mode='html')
         return None
-    base_url = db.get(Config.BASE_URL)
-    headers = {"x-goog-api-key": api_key} if base_url else None
-    http_options = types.HttpOptions(base_url=base_url, headers=headers)
-    return genai.Client(api_key=api_key, vertexai=False, http_options=http_options)
+    return _pooled_client(api_key, db.get(Config.BASE_URL))
+
 
+# --- Request Scheduler ---
 
-async def _call_gemini_api(message: Message, contents: list, use_search: bool) -> str | None:
-    """Calls the Gemini API in a non-blocking way and returns the response text, or None on error."""
+def _is_rate_limited(e: Exception) -> bool:
+    """Whether an API error is a 429 / ResourceExhausted."""
+    error_str = str(e)
+    return getattr(e, "code", None) == 429 or "RESOURCE_EXHAUSTED" in error_str or "ResourceExhausted" in error_str
+
+
+async def _safe_edit(message: Message, text: str):
+    try:
+        await message.edit(text, parse_mode='html')
+    except Exception:
+        pass
+
+
+class _GeminiScheduler:
+    """Runs every blocking Gemini call: bounded workers, FIFO queue, per-key rate limit and 429 backoff."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gemini")
+        self.active = 0
+        self.waiting = deque()
+        self.recent: dict[str, deque] = {}  # api_key -> start times within the last minute
+        self.blocked_until: dict[str, float] = {}  # api_key -> loop time when 429 backoff ends
+        self._cond = None
+
+    @property
+    def cond(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def run(self, func, *args, message: Message | None = None, can_retry=None):
+        """Runs `func(*args)` in the worker pool; retries on 429 while `can_retry()` allows it."""
+        api_key = db.get(Config.API_KEY) or ""
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            if await self._acquire(message):
+                await _safe_edit(message, "⚙️ 正在处理...")
+            try:
+                await self._wait_rate_limit(api_key, message)
+                return await loop.run_in_executor(self.executor, func, *args)
+            except Exception as e:
+                if not _is_rate_limited(e) or attempt >= Config.MAX_RETRIES or (can_retry and not can_retry()):
+                    raise
+                attempt += 1
+                delay = Config.RETRY_BASE_DELAY * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                # Every request on this key backs off, not just the one that hit the limit.
+                self.blocked_until[api_key] = max(self.blocked_until.get(api_key, 0), loop.time() + delay)
+            finally:
+                await self._release()
+            if message is not None:
+                await _safe_edit(message, f"⏳ 已达到速率限制，{delay:.1f} 秒后重试 ({attempt}/{Config.MAX_RETRIES})...")
+
+    async def _acquire(self, message: Message | None) -> bool:
+        """Waits for a worker slot in FIFO order; returns True if a queue position was shown."""
+        ticket = object()
+        self.waiting.append(ticket)
+        shown = None
+        try:
+            while True:
+                async with self.cond:
+                    if self.active < self.workers and self.waiting[0] is ticket:
+                        self.active += 1
+                        return shown is not None
+                    position = self.waiting.index(ticket) + 1
+                    if message is None or position == shown:
+                        await self.cond.wait()
+                        continue
+                shown = position
+                await _safe_edit(message, f"⏳ 排队中 (第 {position} 位)...")
+        finally:
+            self.waiting.remove(ticket)
+            async with self.cond:
+                self.cond.notify_all()
+
+    async def _release(self):
+        async with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    async def _wait_rate_limit(self, api_key: str, message: Message | None):
+        loop = asyncio.get_running_loop()
+        recent = self.recent.setdefault(api_key, deque())
+        notified = False
+        while True:
+            now = loop.time()
+            while recent and now - recent[0] >= 60:
+                recent.popleft()
+            wait = self.blocked_until.get(api_key, 0) - now
+            rpm = db.get(Config.RATE_LIMIT, 0)
+            if rpm > 0 and len(recent) >= rpm:
+                wait = max(wait, recent[0] + 60 - now)
+            if wait <= 0:
+                recent.append(now)
+                return
+            if message is not None and not notified and wait > 1:
+                notified = True
+                await _safe_edit(message, f"⏳ 等待速率限制，约 {wait:.0f} 秒...")
+            await asyncio.sleep(wait)
+
+    def summary(self) -> str:
+        return f"运行 {self.active}/{self.workers}, 排队 {len(self.waiting)}"
+
+
+_SCHEDULER = _GeminiScheduler(Config.SCHEDULER_WORKERS)
+
+
+# --- Token Estimation ---
+
+_TOKEN_PIECE_RE = re.compile(r'[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uf900-\ufaff]|[A-Za-z]+|[^\sA-Za-z]')
+
+
+class _TokenEstimator:
+    """Local token counts without a count_tokens round-trip.
+
+    A character-class approximation of the tokenizer is scaled by a ratio calibrated against exact
+    counts (from count_tokens and response usage metadata); `upper_bound` adds a safety margin derived
+    from how far those samples spread. Exact counts are also remembered by text hash.
+    """
+
+    def __init__(self):
+        self.samples = deque(db.get(Config.TOKEN_CALIBRATION) or [], maxlen=Config.TOKEN_CALIBRATION_SAMPLES)
+        self.exact: OrderedDict[str, int] = OrderedDict()
+        self._calibrate()
+
+    @staticmethod
+    def approximate(text: str) -> int:
+        # CJK characters, digits and symbols are about one token each; most words are a single token.
+        return sum(1 + len(piece) // 8 if piece[0].isascii() and piece[0].isalpha() else 1
+                   for piece in _TOKEN_PIECE_RE.findall(text))
+
+    def _calibrate(self):
+        if not self.samples:
+            self.ratio, self.margin = 1.0, Config.TOKEN_MARGIN_MAX
+            return
+        ordered = sorted(self.samples)
+        self.ratio = ordered[len(ordered) // 2]
+        spread = ordered[int(len(ordered) * 0.9)] / self.ratio - 1
+        self.margin = min(max(spread, Config.TOKEN_MARGIN_MIN), Config.TOKEN_MARGIN_MAX)
+
+    def _exact(self, text: str) -> int | None:
+        key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        count = self.exact.get(key)
+        if count is not None:
+            self.exact.move_to_end(key)
+        return count
+
+    def estimate(self, text: str) -> int:
+        """Best guess, used for context budgets."""
+        if not text:
+            return 0
+        exact = self._exact(text)
+        return exact if exact is not None else int(-(-self.approximate(text) * self.ratio // 1))
+
+    def upper_bound(self, text: str) -> int:
+        """Estimate plus the calibrated margin, used for hard limits."""
+        if not text:
+            return 0
+        exact = self._exact(text)
+        return exact if exact is not None else int(-(-self.approximate(text) * self.ratio * (1 + self.margin) // 1))
+
+    def record(self, text: str, count: int | None):
+        """Remembers an exact count and uses it to recalibrate the estimate."""
+        if not text or not count:
+            return
+        self.exact[hashlib.sha1(text.encode("utf-8")).hexdigest()] = count
+        while len(self.exact) > Config.TOKEN_EXACT_CACHE:
+            self.exact.popitem(last=False)
+        approximate = self.approximate(text)
+        # Very short texts say little about the ratio.
+        if approximate >= 20:
+            self.samples.append(round(count / approximate, 4))
+            self._calibrate()
+            db[Config.TOKEN_CALIBRATION] = list(self.samples)
+
+    def summary(self) -> str:
+        return f"比例 {self.ratio:.2f}, 余量 {self.margin:.0%}, 样本 {len(self.samples)}"
+
+
+_TOKENS = _TokenEstimator()
+
+
+# --- Conversation Memory ---
+
+
+class _ChatMemory:
+    """One chat's conversation: a rolling summary plus the turns recorded after it."""
+
+    def __init__(self, summary: str, summary_tokens: int, turns: list):
+        self.summary = summary
+        self.summary_tokens = summary_tokens
+        self.turns = turns  # [(row_id, role, text, tokens, media), ...]
+        self.last_used = time.monotonic()
+        self.compacting = False
+
+    @property
+    def tokens(self) -> int:
+        return self.summary_tokens + sum(turn[3] for turn in self.turns)
+
+    def as_contents(self, budget: int | None = None) -> list:
+        """Turns as API contents; with a `budget`, only the newest turns that fit in it are included."""
+        turns = self.turns
+        if budget is not None:
+            keep, used = len(turns), 0
+            while keep > 0 and used + turns[keep - 1][3] <= budget:
+                keep -= 1
+                used += turns[keep][3]
+            turns = turns[keep:]
+        contents = []
+        now = time.time()
+        for _, role, text, _, media in turns:
+            # Uploaded files expire after about two days; expired references are left out.
+            parts = [types.Part(file_data=types.FileData(file_uri=item["uri"], mime_type=item["mime_type"]))
+                     for item in media if item["expires_at"] > now]
+            contents.append(types.Content(role=role, parts=parts + [types.Part(text=text)]))
+        return contents
+
+
+class _HistoryStore:
+    """Per-chat conversation history in an append-only sqlite table, with an LRU of loaded chats."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = None
+        self._cache: OrderedDict[int, _ChatMemory] = OrderedDict()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path)
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS turns (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL,
+                    role TEXT NOT NULL, text TEXT NOT NULL, tokens INTEGER NOT NULL, created_at REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS turns_chat ON turns (chat_id, id);
+                CREATE TABLE IF NOT EXISTS summaries (
+                    chat_id INTEGER PRIMARY KEY, text TEXT NOT NULL, tokens INTEGER NOT NULL);
+            """)
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(turns)")]
+            if "media" not in columns:
+                self._db.execute("ALTER TABLE turns ADD COLUMN media TEXT")
+            # The old single-blob history is not associated with any chat.
+            if db.get(Config.CHAT_HISTORY) is not None:
+                del db[Config.CHAT_HISTORY]
+        return self._db
+
+    def get(self, chat_id: int) -> _ChatMemory:
+        memory = self._cache.get(chat_id)
+        if memory is None:
+            row = self.conn.execute("SELECT text, tokens FROM summaries WHERE chat_id = ?", (chat_id,)).fetchone()
+            turns = [
+                (row_id, role, text, tokens, json.loads(media) if media else [])
+                for row_id, role, text, tokens, media in self.conn.execute(
+                    "SELECT id, role, text, tokens, media FROM turns WHERE chat_id = ? ORDER BY id", (chat_id,))
+            ]
+            memory = _ChatMemory(row[0] if row else "", row[1] if row else 0, turns)
+            self._cache[chat_id] = memory
+        self._cache.move_to_end(chat_id)
+        memory.last_used = time.monotonic()
+        self._evict()
+        return memory
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._cache:
+            chat_id, memory = next(iter(self._cache.items()))
+            if len(self._cache) <= Config.HISTORY_CACHE_CHATS and now - memory.last_used < Config.HISTORY_IDLE_SECONDS:
+                break
+            if memory.compacting:
+                break
+            del self._cache[chat_id]
+
+    def append(self, chat_id: int, role: str, text: str, media: list | None = None):
+        """Appends a turn; `media` holds Files API references ({"uri", "mime_type", "expires_at"})."""
+        media = media or []
+        tokens = _TOKENS.estimate(text) + Config.MEDIA_TOKEN_ESTIMATE * len(media)
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO turns (chat_id, role, text, tokens, created_at, media) VALUES (?, ?, ?, ?, ?, ?)",
+                (chat_id, role, text, tokens, time.time(), json.dumps(media) if media else None))
+        self.get(chat_id).turns.append((cursor.lastrowid, role, text, tokens, media))
+
+    def set_summary(self, chat_id: int, summary: str, upto_id: int):
+        """Replaces all turns up to `upto_id` with `summary`."""
+        tokens = _TOKENS.estimate(summary)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO summaries (chat_id, text, tokens) VALUES (?, ?, ?)",
+                              (chat_id, summary, tokens))
+            self.conn.execute("DELETE FROM turns WHERE chat_id = ? AND id <= ?", (chat_id, upto_id))
+        memory = self.get(chat_id)
+        memory.summary, memory.summary_tokens = summary, tokens
+        memory.turns = [turn for turn in memory.turns if turn[0] > upto_id]
+
+    def clear(self, chat_id: int | None = None):
+        with self.conn:
+            if chat_id is None:
+                self.conn.execute("DELETE FROM turns")
+                self.conn.execute("DELETE FROM summaries")
+                self._cache.clear()
+            else:
+                self.conn.execute("DELETE FROM turns WHERE chat_id = ?", (chat_id,))
+                self.conn.execute("DELETE FROM summaries WHERE chat_id = ?", (chat_id,))
+                self._cache.pop(chat_id, None)
+
+
+_HISTORY = _HistoryStore(Config.HISTORY_DB_PATH)
+# The event loop only keeps weak references to tasks; hold compactions here until they finish.
+_COMPACTION_TASKS: set[asyncio.Task] = set()
+
+
+def _on_compaction_done(task: asyncio.Task):
+    _COMPACTION_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        traceback.print_exception(task.exception())
+
+
+async def _compact_history(client: genai.Client, model_name: str, chat_id: int):
+    """Folds the oldest turns into a model-written summary once the chat exceeds its token budget."""
+    memory = _HISTORY.get(chat_id)
+    budget = db.get(Config.CONTEXT_TOKEN_BUDGET, Config.DEFAULT_CONTEXT_TOKEN_BUDGET)
+    if memory.compacting or memory.tokens <= budget:
+        return
+    # Keep the newest turns within half of the budget; everything older goes into the summary.
+    keep, kept_tokens = len(memory.turns), memory.summary_tokens
+    while keep > 0 and kept_tokens + memory.turns[keep - 1][3] <= budget // 2:
+        keep -= 1
+        kept_tokens += memory.turns[keep][3]
+    old_turns = memory.turns[:keep]
+    if not old_turns:
+        return
+    transcript = "\n".join(f"{'用户' if role == 'user' else '模型'}: {text}" for _, role, text, _, _ in old_turns)
+    prompt = (
+        f"请把下面的对话压缩成一段简洁的摘要，保留事实、结论、用户的偏好和尚未解决的问题，"
+        f"不超过 {budget // 4} 个 token，只输出摘要本身。\n\n"
+        + (f"已有摘要:\n{memory.summary}\n\n" if memory.summary else "")
+        + f"对话:\n{transcript}"
+    )
+    memory.compacting = True
+    try:
+        response = await _SCHEDULER.run(
+            lambda: client.models.generate_content(model=f"models/{model_name}", contents=prompt))
+        summary = response.text or memory.summary
+    except Exception:
+        # Summarizing failed; still drop the oldest turns so requests stay within budget.
+        summary = memory.summary
+    finally:
+        memory.compacting = False
+    _HISTORY.set_summary(chat_id, summary, old_turns[-1][0])
+
+
+# --- Response Cache ---
+
+def _content_digest(item) -> bytes:
+    """Stable bytes identifying one content item (text, image or media part)."""
+    if isinstance(item, str):
+        return b"text:" + item.encode("utf-8")
+    if isinstance(item, Image.Image):
+        return b"image:" + f"{item.mode}:{item.size}:".encode() + hashlib.sha256(item.tobytes()).digest()
+    if isinstance(item, types.Part):
+        if item.inline_data:
+            return (b"blob:" + (item.inline_data.mime_type or "").encode() + b":"
+                    + hashlib.sha256(item.inline_data.data or b"").digest())
+        if item.file_data:
+            return b"file:" + (item.file_data.file_uri or "").encode()
+        if item.text is not None:
+            return b"text:" + item.text.encode("utf-8")
+    return repr(item).encode("utf-8")
+
+
+def _response_cache_key(model_name: str, system_prompt: str, contents: list, use_search: bool,
+                        max_tokens: int) -> str:
+    hasher = hashlib.sha256()
+    for field in (model_name, system_prompt, str(use_search), str(max_tokens)):
+        hasher.update(field.encode("utf-8") + b"\0")
+    for item in contents:
+        hasher.update(hashlib.sha256(_content_digest(item)).digest())
+    return hasher.hexdigest()
+
+
+class _ResponseCache:
+    """Persistent response cache with a TTL and LRU eviction beyond a fixed number of entries."""
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY, text TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)
+            """)
+        return self._db
+
+    @staticmethod
+    def ttl_seconds() -> float:
+        return db.get(Config.CACHE_TTL, Config.DEFAULT_CACHE_TTL_HOURS) * 3600
+
+    def get(self, key: str) -> str | None:
+        row = self.conn.execute("SELECT text, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row and now - row[1] < self.ttl_seconds():
+            with self.conn:
+                self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+        self.misses += 1
+        return None
+
+    def put(self, key: str, text: str):
+        now = time.time()
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, text, created_at, last_used) VALUES (?, ?, ?, ?)",
+                              (key, text, now, now))
+            self.conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds(),))
+            self.conn.execute(
+                "DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,))
+
+    def stats(self) -> dict:
+        count, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(text)), 0) FROM responses").fetchone()
+        return {"entries": count, "chars": size, "hits": self.hits, "misses": self.misses}
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM responses")
+        self.hits = self.misses = 0
+
+
+_RESPONSE_CACHE = _ResponseCache(Config.CACHE_DB_PATH, Config.CACHE_MAX_ENTRIES)
+
+
+# --- Files API ---
+
+def _telegram_file_key(media_message: Message) -> str:
+    """Stable identifier of the Telegram file behind a message."""
+    if media_message.photo:
+        return f"photo:{media_message.photo.id}"
+    if media_message.document:
+        return f"document:{media_message.document.id}"
+    return f"file:{media_message.file.id}"
+
+
+class _GeminiFileCache:
+    """Maps Telegram files to files already uploaded through the Gemini Files API (per API key)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    tg_key TEXT NOT NULL, key_hash TEXT NOT NULL, name TEXT NOT NULL, uri TEXT NOT NULL,
+                    mime_type TEXT NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (tg_key, key_hash))
+            """)
+        return self._db
+
+    @staticmethod
+    def _key_hash(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+    def get(self, tg_key: str, api_key: str) -> dict | None:
+        row = self.conn.execute(
+            "SELECT uri, mime_type, expires_at FROM files WHERE tg_key = ? AND key_hash = ?",
+            (tg_key, self._key_hash(api_key))).fetchone()
+        if row and row[2] - time.time() > Config.FILES_EXPIRY_MARGIN:
+            return {"uri": row[0], "mime_type": row[1], "expires_at": row[2]}
+        return None
+
+    def put(self, tg_key: str, api_key: str, name: str, uri: str, mime_type: str, expires_at: float):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                              (tg_key, self._key_hash(api_key), name, uri, mime_type, expires_at))
+            self.conn.execute("DELETE FROM files WHERE expires_at < ?", (time.time(),))
+
+    def describe(self, part: types.Part) -> dict:
+        """History reference for a file part, including when the upload expires."""
+        row = self.conn.execute("SELECT expires_at FROM files WHERE uri = ?", (part.file_data.file_uri,)).fetchone()
+        return {"uri": part.file_data.file_uri, "mime_type": part.file_data.mime_type,
+                "expires_at": row[0] if row else time.time() + Config.FILES_EXPIRY_MARGIN}
+
+    def count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM files WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+
+
+_FILE_CACHE = _GeminiFileCache(Config.CACHE_DB_PATH)
+
+
+async def _get_gemini_file_part(message: Message, media_message: Message) -> types.Part | None:
+    """Returns a file_data part for the message's media, uploading it via the Files API only if needed."""
+    client = await _get_gemini_client(message)
+    if not client:
+        return None
+    api_key = db.get(Config.API_KEY)
+    tg_key = _telegram_file_key(media_message)
+    mime_type = media_message.file.mime_type or "application/octet-stream"
+    cached = _FILE_CACHE.get(tg_key, api_key)
+    if cached:
+        return types.Part(file_data=types.FileData(file_uri=cached["uri"], mime_type=cached["mime_type"]))
+
+    await message.edit("📤 正在上传文件到 Gemini...", parse_mode='html')
+    os.makedirs("data/gemini", exist_ok=True)
+    path = await media_message.download_media(file=f"data/gemini/upload_{media_message.chat_id}_{media_message.id}")
+    try:
+        upload_config = types.UploadFileConfig(mime_type=mime_type)
+        gemini_file = await _SCHEDULER.run(lambda: client.files.upload(file=path, config=upload_config),
+                                           message=message)
+        # Videos and large documents are processed asynchronously before they can be used.
+        while gemini_file.state == types.FileState.PROCESSING:
+            await asyncio.sleep(2)
+            name = gemini_file.name
+            gemini_file = await _SCHEDULER.run(lambda: client.files.get(name=name))
+        if gemini_file.state == types.FileState.FAILED:
+            await _show_error(message, "Gemini 处理上传的文件失败。")
+            return None
+    except Exception as e:
+        await _handle_gemini_exception(message, e, api_name="Gemini Files API")
+        return None
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+    expires_at = (gemini_file.expiration_time.timestamp() if gemini_file.expiration_time
+                  else time.time() + 47 * 3600)
+    _FILE_CACHE.put(tg_key, api_key, gemini_file.name, gemini_file.uri, mime_type, expires_at)
+    await message.edit("✅ 文件已上传，正在处理...", parse_mode='html')
+    return types.Part(file_data=types.FileData(file_uri=gemini_file.uri, mime_type=mime_type))
+
+
+async def _call_gemini_api(message: Message, contents: list, use_search: bool, on_partial=None,
+                           use_context: bool = True, quiet: bool = False) -> str | None:
+    """Calls the Gemini API in a non-blocking way and returns the response text, or None on error.
+
+    If `on_partial` is given, the response is streamed and `on_partial(text_so_far)` is awaited for each chunk.
+    With `use_context=False` the request neither reads nor extends the chat's conversation history.
+    With `quiet=True` no queue/rate-limit status or error is written to `message`; API errors are raised instead.
+    """
     client = await _get_gemini_client(message)
     if not client:
         return None
@@ -265,32 +1296,89 @@ async def _call_gemini_api(message: Message, contents: list, use_search: bool) -
     system_prompt_name = db.get(active_prompt_key)
     prompts = db.get(Config.PROMPTS, {})
     system_prompt = prompts.get(system_prompt_name, "你是一个乐于助人的人工智能助手。") if system_prompt_name else "你是一个乐于助人的人工智能助手。"
-    api_contents = db.get(Config.CHAT_HISTORY, []) + contents if db.get(Config.CONTEXT_ENABLED) and not use_search else contents
+    use_context = use_context and db.get(Config.CONTEXT_ENABLED) and not use_search
+    api_contents = contents
+    if use_context:
+        memory = _HISTORY.get(message.chat_id)
+        if memory.summary:
+            system_prompt += f"\n\n此前对话的摘要:\n{memory.summary}"
+        user_parts = [types.Part(text=c) if isinstance(c, str) else c for c in contents]
+        # Pre-flight budget check: if compaction has not caught up, leave out the oldest turns.
+        prompt_tokens = sum(_TOKENS.estimate(c) if isinstance(c, str) else Config.MEDIA_TOKEN_ESTIMATE for c in contents)
+        budget = db.get(Config.CONTEXT_TOKEN_BUDGET, Config.DEFAULT_CONTEXT_TOKEN_BUDGET)
+        history = memory.as_contents(max(budget - memory.summary_tokens - prompt_tokens, 0))
+        api_contents = history + [types.Content(role="user", parts=user_parts)]
+    max_tokens = db.get(Config.MAX_TOKENS, 0)
+
+    # Cached answers would ignore the conversation, so the cache is bypassed in context mode.
+    cache_key = None
+    if db.get(Config.CACHE_ENABLED) and not use_context:
+        cache_key = _response_cache_key(model_name, system_prompt, contents, use_search, max_tokens)
+        if (cached := _RESPONSE_CACHE.get(cache_key)) is not None:
+            return cached
 
     def blocking_api_call():
         safety_settings = [types.SafetySetting(category=c, threshold='BLOCK_NONE') for c in
                            ['HARM_CATEGORY_HATE_SPEECH', 'HARM_CATEGORY_DANGEROUS_CONTENT',
                             'HARM_CATEGORY_HARASSMENT', 'HARM_CATEGORY_SEXUALLY_EXPLICIT',
                             'HARM_CATEGORY_CIVIC_INTEGRITY']]
-        max_tokens = db.get(Config.MAX_TOKENS, 0)
         config = types.GenerateContentConfig(
             system_instruction=system_prompt,
             safety_settings=safety_settings,
             max_output_tokens=max_tokens if max_tokens > 0 else None,
             tools=[types.Tool(google_search=types.GoogleSearch())] if use_search else None
         )
-        return client.models.generate_content(model=f"models/{model_name}", contents=api_contents, config=config)
+        if on_partial is None:
+            response = client.models.generate_content(model=f"models/{model_name}", contents=api_contents, config=config)
+            usage["output"] = response.usage_metadata and response.usage_metadata.candidates_token_count
+            return response.text
+        for chunk in client.models.generate_content_stream(model=f"models/{model_name}", contents=api_contents, config=config):
+            if chunk.usage_metadata and chunk.usage_metadata.candidates_token_count:
+                usage["output"] = chunk.usage_metadata.candidates_token_count
+            if chunk.text:
+                push(chunk.text)
+        return None
 
+    # Exact output token counts come back for free and keep the local estimator calibrated.
+    usage = {}
+    status_message = None if quiet else message
     try:
         loop = asyncio.get_running_loop()
-        response = await loop.run_in_executor(None, blocking_api_call)
-
-        if db.get(Config.CONTEXT_ENABLED) and not use_search:
-            history = db.get(Config.CHAT_HISTORY, [])
-            history.extend([contents[0], response.text])
-            db[Config.CHAT_HISTORY] = history
-        return response.text
+        if on_partial is None:
+            response_text = await _SCHEDULER.run(blocking_api_call, message=status_message)
+        else:
+            # Chunks are handed from the worker thread to the event loop as they arrive.
+            chunks = asyncio.Queue()
+            pieces = []
+
+            def push(piece: str):
+                loop.call_soon_threadsafe(chunks.put_nowait, piece)
+
+            # A 429 is only retried before any text was shown.
+            future = asyncio.ensure_future(
+                _SCHEDULER.run(blocking_api_call, message=status_message, can_retry=lambda: not pieces))
+            future.add_done_callback(lambda _: chunks.put_nowait(None))
+            while (piece := await chunks.get()) is not None:
+                pieces.append(piece)
+                await on_partial("".join(pieces))
+            await future
+            response_text = "".join(pieces)
+        _TOKENS.record(response_text, usage.get("output"))
+
+        if use_context:
+            media = [_FILE_CACHE.describe(c) for c in contents if isinstance(c, types.Part) and c.file_data]
+            _HISTORY.append(message.chat_id, "user", "\n".join(c for c in contents if isinstance(c, str)), media)
+            _HISTORY.append(message.chat_id, "model", response_text or "")
+            # Compaction calls the model again; do not hold up the reply for it.
+            task = asyncio.create_task(_compact_history(client, model_name, message.chat_id))
+            _COMPACTION_TASKS.add(task)
+            task.add_done_callback(_on_compaction_done)
+        if cache_key and response_text:
+            _RESPONSE_CACHE.put(cache_key, response_text)
+        return response_text
     except Exception as e:
+        if quiet:
+            raise
         await _handle_gemini_exception(message, e)
         return None
 
@@ -303,7 +1391,9 @@ async def _call_gemini_image_api(message: Message, contents: list) -> tuple[str
     model_name = db.get(Config.IMAGE_MODEL, Config.DEFAULT_IMAGE_MODEL)
     try:
         config = types.GenerateContentConfig(response_modalities=["TEXT", "IMAGE"])
-        response = client.models.generate_content(model=f"models/{model_name}", contents=contents, config=config)
+        response = await _SCHEDULER.run(
+            lambda: client.models.generate_content(model=f"models/{model_name}", contents=contents, config=config),
+            message=message)
         text_response, image_response = None, None
         for part in response.candidates[0].content.parts:
             if part.text:
@@ -334,31 +1424,43 @@ def parse_audio_mime_type(mime_type: str) -> dict[str, int]:
     return params
 
 
-async def _call_gemini_tts_api(message: Message, text: str) -> tuple[str | None, str | None]:
-    """Calls the Gemini TTS API and returns the path to the raw audio file and its mime type."""
+def _split_tts_text(text: str, limit: int) -> list[str]:
+    """Splits text at sentence ends into pieces whose estimated token count stays within `limit`."""
+    if _TOKENS.upper_bound(text) <= limit:
+        return [text]
+    segments, current, current_tokens = [], "", 0
+    for sentence in re.findall(r'[^。！？!?；;.]*(?:[。！？!?；;.]+\s*|$)', text):
+        tokens = _TOKENS.upper_bound(sentence)
+        if tokens > limit:
+            # A single run-on sentence: cut it by length.
+            step = max(1, len(sentence) * limit // tokens)
+            pieces = [sentence[i:i + step] for i in range(0, len(sentence), step)]
+        else:
+            pieces = [sentence]
+        for piece in pieces:
+            tokens = _TOKENS.upper_bound(piece)
+            if current and current_tokens + tokens > limit:
+                segments.append(current.strip())
+                current, current_tokens = "", 0
+            current += piece
+            current_tokens += tokens
+    if current.strip():
+        segments.append(current.strip())
+    return segments
+
+
+async def _call_gemini_tts_api(message: Message, text: str, on_audio) -> bool | None:
+    """Streams Gemini TTS audio, awaiting `on_audio(pcm_bytes, mime_type)` for each chunk as it arrives.
+
+    Returns True once audio was received, or None on error (already reported to the user).
+    """
     client = await _get_gemini_client(message)
     if not client:
-        return None, None
-
-    def blocking_tts_call():
-        # Sanitize input text by stripping markdown and whitespace
-        # Convert markdown to HTML, then extract plain text to feed to the TTS engine.
-        html_content = markdown.markdown(text)
-        soup = BeautifulSoup(html_content, 'html.parser')
-        clean_text = soup.get_text()
-
-        # Filter out emoji characters by replacing them with a space
-        clean_text = emoji.replace_emoji(clean_text, replace=' ')
-        clean_text = re.sub(r'\s+', ' ', clean_text).strip()
-
-        if not clean_text:
-            raise ValueError("要转换为语音的文本为空。")
+        return None
 
-        model_name = db.get(Config.TTS_MODEL, Config.DEFAULT_TTS_MODEL)
-        token_count_response = client.models.count_tokens(model=f"models/{model_name}", contents=[clean_text])
-        if token_count_response.total_tokens > 1500:
-            raise ValueError(f"TOKEN_LIMIT_EXCEEDED:{token_count_response.total_tokens}")
+    model_name = db.get(Config.TTS_MODEL, Config.DEFAULT_TTS_MODEL)
 
+    def blocking_tts_call(segment: str):
         voice_name = db.get(Config.TTS_VOICE, Config.DEFAULT_TTS_VOICE)
         config = types.GenerateContentConfig(
             response_modalities=["audio"],
@@ -368,41 +1470,154 @@ async def _call_gemini_tts_api(message: Message, text: str) -> tuple[str | None,
         )
         stream = client.models.generate_content_stream(
             model=f"models/{model_name}",
-            contents=[clean_text],
+            contents=[segment],
             config=config
         )
-        audio_data, audio_mime_type = bytearray(), None
         for chunk in stream:
             if chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts and \
                     chunk.candidates[0].content.parts[0].inline_data and chunk.candidates[0].content.parts[0].inline_data.data:
                 inline_data = chunk.candidates[0].content.parts[0].inline_data
-                if not audio_mime_type:
-                    audio_mime_type = inline_data.mime_type
-                audio_data.extend(inline_data.data)
-        return audio_data, audio_mime_type
+                push((inline_data.data, inline_data.mime_type))
 
     try:
-        # We run the text cleaning and the API call inside the same executor
-        # to ensure any errors during text processing are caught.
-        loop = asyncio.get_running_loop()
-        audio_data, audio_mime_type = await loop.run_in_executor(None, blocking_tts_call)
+        # Sanitize input text by stripping markdown and whitespace
+        clean_text = _render_entities(_parse_markdown(text))[0]
 
-        if not audio_data:
-            await message.edit("模型未返回任何音频数据。", parse_mode='html')
-            return None, None
+        # Filter out emoji characters by replacing them with a space
+        clean_text = emoji.replace_emoji(clean_text, replace=' ')
+        clean_text = re.sub(r'\s+', ' ', clean_text).strip()
+
+        if not clean_text:
+            raise ValueError("要转换为语音的文本为空。")
+
+        limit = Config.TTS_TOKEN_LIMIT
+        if _TOKENS.estimate(clean_text) <= limit < _TOKENS.upper_bound(clean_text):
+            # Too close to call locally; one exact count settles it and is remembered.
+            token_count_response = await _SCHEDULER.run(
+                lambda: client.models.count_tokens(model=f"models/{model_name}", contents=[clean_text]), message=message)
+            _TOKENS.record(clean_text, token_count_response.total_tokens)
+        segments = _split_tts_text(clean_text, limit)
+        if len(segments) > Config.TTS_MAX_SEGMENTS:
+            raise ValueError(f"TOKEN_LIMIT_EXCEEDED:{_TOKENS.estimate(clean_text)}")
 
-        output_file_path = f"gemini_tts_{message.id}.raw"
-        with open(output_file_path, "wb") as f:
-            f.write(audio_data)
-        return output_file_path, audio_mime_type
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        audio_mime_type = None
+
+        def push(item: tuple[bytes, str]):
+            loop.call_soon_threadsafe(chunks.put_nowait, item)
+
+        # Segments are spoken in order into the same encoder, so they end up in one voice note.
+        for segment in segments:
+            received = []
+            # A 429 is only retried before any audio of the segment was handed to the encoder.
+            future = asyncio.ensure_future(
+                _SCHEDULER.run(blocking_tts_call, segment, message=message, can_retry=lambda: not received))
+            future.add_done_callback(lambda _: chunks.put_nowait(None))
+            while (item := await chunks.get()) is not None:
+                received.append(True)
+                audio_mime_type = audio_mime_type or item[1]
+                await on_audio(item[0], audio_mime_type)
+            await future
+
+        if not audio_mime_type:
+            await message.edit("模型未返回任何音频数据。", parse_mode='html')
+            return None
+        return True
     except ValueError as e:
         if str(e).startswith("TOKEN_LIMIT_EXCEEDED"):
             raise e
         await message.edit(f"输入文本处理失败: {e}", parse_mode='html')
-        return None, None
+        return None
     except Exception as e:
         await _handle_gemini_exception(message, e, api_name="Gemini TTS API")
-        return None, None
+        return None
+
+
+class _OpusVoiceEncoder:
+    """Pipes streamed PCM into ffmpeg and uploads the Opus output in parts while it is still being encoded."""
+
+    def __init__(self, client):
+        self.client = client
+        self.process = None
+        self.reader = None
+        self.error = ""
+        self.pcm_bytes = 0
+        self.bytes_per_second = 0
+        self.file_id = generate_random_long()
+        self.buffer = bytearray()
+        self.parts = 0
+        self.uploads = []
+        self.semaphore = asyncio.Semaphore(Config.TTS_UPLOAD_CONCURRENCY)
+
+    async def feed(self, pcm: bytes, mime_type: str):
+        if self.error:
+            return
+        if self.process is None:
+            params = parse_audio_mime_type(mime_type)
+            self.bytes_per_second = params["rate"] * params["bits_per_sample"] // 8
+            try:
+                self.process = await asyncio.create_subprocess_exec(
+                    "ffmpeg", "-f", f"s{params['bits_per_sample']}le", "-ar", str(params['rate']), "-ac", "1",
+                    "-i", "pipe:0", "-c:a", "libopus", "-f", "ogg", "pipe:1",
+                    stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            except FileNotFoundError:
+                self.error = "未找到 ffmpeg，请先安装。"
+                return
+            self.reader = asyncio.gather(self._read_output(), self._read_errors())
+        self.pcm_bytes += len(pcm)
+        try:
+            self.process.stdin.write(pcm)
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg exited early; finish() reports its output
+
+    async def _read_output(self):
+        part_size = Config.TTS_UPLOAD_PART_SIZE
+        while data := await self.process.stdout.read(part_size):
+            self.buffer += data
+            while len(self.buffer) >= part_size:
+                self._upload_part(bytes(self.buffer[:part_size]))
+                del self.buffer[:part_size]
+
+    async def _read_errors(self):
+        stderr = await self.process.stderr.read()
+        self.error = stderr.decode(errors='ignore').strip()
+
+    def _upload_part(self, data: bytes):
+        self.uploads.append(asyncio.ensure_future(self._save_part(self.parts, data)))
+        self.parts += 1
+
+    async def _save_part(self, index: int, data: bytes):
+        async with self.semaphore:
+            await self.client(SaveFilePartRequest(file_id=self.file_id, file_part=index, bytes=data))
+
+    @property
+    def duration(self) -> int:
+        return self.pcm_bytes // self.bytes_per_second if self.bytes_per_second else 0
+
+    async def finish(self) -> tuple[InputFile | None, str]:
+        """Closes ffmpeg's input and waits for the remaining parts; returns the uploaded file or the error."""
+        if self.process is None:
+            return None, self.error or "没有可编码的音频数据。"
+        self.process.stdin.close()
+        await self.reader
+        if await self.process.wait() != 0:
+            return None, self.error
+        if self.buffer or not self.parts:
+            self._upload_part(bytes(self.buffer))
+            self.buffer.clear()
+        await asyncio.gather(*self.uploads)
+        return InputFile(id=self.file_id, parts=self.parts, name="gemini_tts.ogg", md5_checksum=""), ""
+
+    def close(self):
+        """Stops ffmpeg and any pending part uploads."""
+        for task in self.uploads:
+            task.cancel()
+        if self.reader:
+            self.reader.cancel()
+        if self.process and self.process.returncode is None:
+            self.process.kill()
 
 
 # --- Sub-command Handlers ---
@@ -412,10 +1627,12 @@ async def _handle_set_api_key(message: Message, args: str):
         await _send_usage(message, "set_api_key", "[your_api_key]")
         return
     db[Config.API_KEY] = args
+    _invalidate_client_pool()
     await message.edit("<b>Gemini API 密钥已设置。</b>", parse_mode='html')
 
 
 async def _handle_set_base_url(message: Message, args: str):
+    _invalidate_client_pool()
     if not args:
         db[Config.BASE_URL] = None
         await message.edit("<b>Gemini 基础 URL 已清除。</b>", parse_mode='html')
@@ -437,9 +1654,16 @@ async def _handle_settings(message: Message, _):
         "当前 TTS 提示": db.get(Config.TTS_ACTIVE_PROMPT, "默认"),
         "生成 Token 最大数量": f"{db.get(Config.MAX_TOKENS, 0) if db.get(Config.MAX_TOKENS, 0) > 0 else '无限制'}",
         "上下文已启用": db.get(Config.CONTEXT_ENABLED, False),
+        "上下文 token 预算": db.get(Config.CONTEXT_TOKEN_BUDGET, Config.DEFAULT_CONTEXT_TOKEN_BUDGET),
+        "Token 估算": _TOKENS.summary(),
         "Telegraph 已启用": db.get(Config.TELEGRAPH_ENABLED, False),
         "Telegraph 限制": f"{db.get(Config.TELEGRAPH_LIMIT, 0) if db.get(Config.TELEGRAPH_LIMIT, 0) > 0 else '无限制'}",
         "折叠引用": db.get(Config.COLLAPSIBLE_QUOTE_ENABLED, False),
+        "流式输出": db.get(Config.STREAM_ENABLED, True),
+        "回复缓存": db.get(Config.CACHE_ENABLED, False),
+        "客户端连接池": _client_pool_summary(),
+        "速率限制": f"{db.get(Config.RATE_LIMIT, 0) if db.get(Config.RATE_LIMIT, 0) > 0 else '无限制'} 次/分钟",
+        "请求调度": _SCHEDULER.summary(),
     }
     settings_text = "<b>Gemini 设置:</b>\n\n" + "\n".join(f"<b>· {k}:</b> <code>{v}</code>" for k, v in settings.items())
     await message.edit(settings_text, parse_mode='html')
@@ -489,7 +1713,8 @@ async def _model_list(message: Message, _):
         return
     await message.edit("🔍 正在搜索可用模型...", parse_mode='html')
     try:
-        all_models = [m.name.replace("models/", "") for m in client.models.list()]
+        all_models = await _SCHEDULER.run(
+            lambda: [m.name.replace("models/", "") for m in client.models.list()], message=message)
         text = (
             f"<b>可用图片模型:</b>\n<code>{', '.join(Config.IMAGE_MODELS)}</code>\n\n"
             f"<b>可用搜索模型:</b>\n<code>{', '.join(Config.SEARCH_MODELS)}</code>\n\n"
@@ -512,6 +1737,22 @@ async def _handle_model(message: Message, args: str):
         await _send_usage(message, "model", "[set|list]")
 
 
+async def _handle_rate_limit(message: Message, args: str):
+    if not args:
+        await _send_usage(message, "rate_limit", "[requests per minute] (0 for unlimited)")
+        return
+    try:
+        rpm = int(args)
+        if rpm < 0:
+            await _show_error(message, "速率限制必须为非负整数。")
+        else:
+            db[Config.RATE_LIMIT] = rpm
+            await message.edit(f"<b>每个 API 密钥的速率限制已{'清除' if rpm == 0 else f'设置为每分钟 {rpm} 次'}。</b>",
+                               parse_mode='html')
+    except ValueError:
+        await _show_error(message, "无效的速率限制。")
+
+
 async def _handle_tts_voice(message: Message, args: str):
     if not args:
         await _send_usage(message, "tts_voice", "[voice_name]")
@@ -589,44 +1830,74 @@ async def _context_toggle(message: Message, args: str):
     await message.edit(f"<b>对话上下文已{'启用' if is_on else '禁用'}。</b>", parse_mode='html')
 
 
-async def _context_clear(message: Message, _):
-    db[Config.CHAT_HISTORY] = []
-    await message.edit("<b>对话历史已清除。</b>", parse_mode='html')
+async def _context_clear(message: Message, args: str):
+    if args == "all":
+        _HISTORY.clear()
+        await message.edit("<b>所有对话的历史均已清除。</b>", parse_mode='html')
+    else:
+        _HISTORY.clear(message.chat_id)
+        await message.edit("<b>当前对话的历史已清除。</b>", parse_mode='html')
 
 
 async def _context_show(message: Message, _):
-    history = db.get(Config.CHAT_HISTORY, [])
-    if not history:
+    memory = _HISTORY.get(message.chat_id)
+    if not memory.summary and not memory.turns:
         await message.edit("<b>对话历史为空。</b>", parse_mode='html')
         return
-    text = "<b>对话历史:</b>\n\n" + "\n".join(
-        f"<b>{'用户' if i % 2 == 0 else '模型'}:</b>\n<pre><code>{html.escape(str(item))}</code></pre>"
-        for i, item in enumerate(history))
+    budget = db.get(Config.CONTEXT_TOKEN_BUDGET, Config.DEFAULT_CONTEXT_TOKEN_BUDGET)
+    text = f"<b>对话历史</b> (约 {memory.tokens}/{budget} tokens):\n\n"
+    if memory.summary:
+        text += f"<b>摘要:</b>\n<pre><code>{html.escape(memory.summary)}</code></pre>\n"
+    text += "\n".join(
+        f"<b>{'用户' if role == 'user' else '模型'}:</b>\n<pre><code>{html.escape(item)}</code></pre>"
+        for _, role, item, _, _ in memory.turns)
     try:
         await message.edit(text, parse_mode='html')
     except MessageTooLongError:
         await _show_error(message, "历史记录太长，无法显示。")
 
 
+async def _context_budget(message: Message, args: str):
+    if not args:
+        await _send_usage(message, "context budget", "[tokens]")
+        return
+    try:
+        budget = int(args)
+        if budget < 500:
+            await _show_error(message, "token 预算不能小于 500。")
+        else:
+            db[Config.CONTEXT_TOKEN_BUDGET] = budget
+            await message.edit(f"<b>每个对话的上下文 token 预算已设置为 {budget}。</b>", parse_mode='html')
+    except ValueError:
+        await _show_error(message, "无效的 token 数。")
+
+
 async def _handle_context(message: Message, args: str):
-    actions = {"on": _context_toggle, "off": _context_toggle, "clear": _context_clear, "show": _context_show}
-    if args in actions:
-        await actions[args](message, args)
+    parts = args.split(maxsplit=1)
+    action = parts[0] if parts else None
+    action_args = parts[1] if len(parts) > 1 else ""
+    actions = {"clear": _context_clear, "show": _context_show, "budget": _context_budget}
+    if action in ("on", "off"):
+        await _context_toggle(message, action)
+    elif action in actions:
+        await actions[action](message, action_args)
     else:
-        await _send_usage(message, "context", "[on|off|clear|show]")
+        await _send_usage(message, "context", "[on|off|clear|show|budget]")
 
 
-async def _send_to_telegraph(title: str, content: str) -> tuple[str | None, str | None]:
-    """Creates a Telegraph page and returns its URL and a potential error message."""
+async def _send_to_telegraph(title: str, content: list) -> tuple[str | None, str | None]:
+    """Creates a Telegraph page from node JSON and returns its URL and a potential error message."""
     try:
-        if len(content.encode('utf-8')) > 64 * 1024:
+        if len(json.dumps(content, ensure_ascii=False).encode('utf-8')) > 64 * 1024:
             return None, "内容超过 Telegraph 64KB 大小限制"
-        client = _get_telegraph_client()
-        page = client.create_page(title=title, html_content=content)
+        client = await _get_telegraph_client()
+        page = await client.create_page(title=title, content=content)
         posts = db.get(Config.TELEGRAPH_POSTS, {})
         post_id = str(max(map(int, posts.keys()), default=0) + 1)
         posts[post_id] = {"path": page['path'], "title": title}
         db[Config.TELEGRAPH_POSTS] = posts
+        # Our own answers are the pages most often quoted back; no need to download them again.
+        _TELEGRAPH_PAGES.put(page['url'], _telegraph_nodes_text(content))
         return page['url'], None
     except Exception as e:
         return None, str(e)
@@ -682,26 +1953,47 @@ async def _telegraph_del_all(message: Message):
     posts = db.get(Config.TELEGRAPH_POSTS, {})
     if not posts:
         db[Config.TELEGRAPH_TOKEN] = None
-        _get_telegraph_client()
+        await _get_telegraph_client()
         await message.edit("<b>没有可删除的 Telegraph 文章。已创建新的 Telegraph 身份。</b>", parse_mode='html')
         return
-    client = _get_telegraph_client()
-    errors = sum(1 for post in posts.values() if not _try_delete_telegraph_page(client, post['path']))
+    client = await _get_telegraph_client()
+    semaphore = asyncio.Semaphore(Config.TELEGRAPH_CONCURRENCY)
+    progress = {"done": 0, "shown": 0.0}
+    loop = asyncio.get_running_loop()
+
+    async def delete(path: str) -> bool:
+        async with semaphore:
+            ok = await _try_delete_telegraph_page(client, path)
+        progress["done"] += 1
+        if loop.time() - progress["shown"] >= 2:
+            progress["shown"] = loop.time()
+            await _safe_edit(message, f"🗑️ 正在删除 Telegraph 文章 ({progress['done']}/{len(posts)})...")
+        return ok
+
+    results = await asyncio.gather(*(delete(post['path']) for post in posts.values()))
+    errors = results.count(False)
     db[Config.TELEGRAPH_POSTS] = {}
     db[Config.TELEGRAPH_TOKEN] = None
-    _get_telegraph_client()
+    await _get_telegraph_client()
     msg = "<b>列表中的所有 Telegraph 文章均已清除。已创建新的 Telegraph 身份。</b>"
     if errors > 0:
         msg += f"\n({errors} 篇文章无法从 telegra.ph 删除)"
     await message.edit(msg, parse_mode='html')
 
 
-def _try_delete_telegraph_page(client: Telegraph, path: str) -> bool:
-    try:
-        client.edit_page(path=path, title="[已删除]", html_content="<p>本文已被删除。</p>")
-        return True
-    except Exception:
-        return False
+async def _try_delete_telegraph_page(client: _TelegraphClient, path: str) -> bool:
+    for _ in range(3):
+        try:
+            await client.edit_page(path=path, title="[已删除]", content=[{"tag": "p", "children": ["本文已被删除。"]}])
+            _TELEGRAPH_PAGES.invalidate(f"https://telegra.ph/{path}")
+            return True
+        except RetryAfterError as e:
+            if e.retry_after > 60:
+                return False
+            await asyncio.sleep(e.retry_after)
+        except Exception:
+            return False
+    return False
 
 
 async def _telegraph_del(message: Message, args: str):
@@ -723,7 +2015,7 @@ async def _telegraph_del(message: Message, args: str):
         return
     posts = db.get(Config.TELEGRAPH_POSTS, {})
     if id_to_delete in posts:
-        if _try_delete_telegraph_page(_get_telegraph_client(), posts[id_to_delete]['path']):
+        if await _try_delete_telegraph_page(await _get_telegraph_client(), posts[id_to_delete]['path']):
             del posts[id_to_delete]
             db[Config.TELEGRAPH_POSTS] = posts
             await message.edit(f"<b>Telegraph 文章 <code>{id_to_delete}</code> 已删除。</b>", parse_mode='html')
@@ -750,6 +2042,138 @@ async def _handle_telegraph(message: Message, args: str):
         await _send_usage(message, "telegraph", "[on|off|limit|list|del|clear]")
 
 
+async def _handle_stream(message: Message, args: str):
+    if args in ["on", "off"]:
+        is_on = args == "on"
+        db[Config.STREAM_ENABLED] = is_on
+        await message.edit(f"<b>流式输出已{'启用' if is_on else '禁用'}。</b>", parse_mode='html')
+    else:
+        await _send_usage(message, "stream", "[on|off]")
+
+
+def _bench_markdown(size_kb: int) -> str:
+    """Builds a synthetic model reply of roughly `size_kb` KB mixing the constructs Gemini emits."""
+    section = (
+        "## 第 {n} 节: Overview\n\n"
+        "This is **bold**, *italic*, `inline code` and a [link](https://example.com/{n}). "
+        "中文段落包含 **加粗文本** 与 _斜体_，以及 ~~删除线~~ 和 emoji 🚀✨。\n"
+        "A second line in the same paragraph with `x = {n}`.\n\n"
+        "- First point with **emphasis**\n"
+        "- Second point\n"
+        "    - Nested item {n}\n"
+        "- Third point with a [reference](https://example.org)\n\n"
+        "1. Step one\n2. Step two\n3. Step three\n\n"
+        "```python\ndef f_{n}(x):\n    return x * {n}  # 注释\n```\n\n"
+        "> Quoted remark number {n} with *style*.\n\n"
+        "---\n\n"
+    )
+    parts, size, n = [], 0, 0
+    while size < size_kb * 1024:
+        n += 1
+        chunk = section.format(n=n)
+        parts.append(chunk)
+        size += len(chunk.encode("utf-8"))
+    return "".join(parts)
+
+
+def _run_render_benchmark(size_kb: int, iterations: int) -> dict:
+    text = _bench_markdown(size_kb)
+    timings = {"legacy": 0.0, "parse": 0.0, "entities": 0.0, "telegraph": 0.0}
+    for _ in range(iterations):
+        started = time.perf_counter()
+        _legacy_render(text)
+        timings["legacy"] += time.perf_counter() - started
+
+        started = time.perf_counter()
+        tree = _parse_markdown(text)
+        parsed = time.perf_counter()
+        _render_entities(tree)
+        rendered = time.perf_counter()
+        _render_telegraph_nodes(tree)
+        timings["parse"] += parsed - started
+        timings["entities"] += rendered - parsed
+        timings["telegraph"] += time.perf_counter() - rendered
+    result = {name: value * 1000 / iterations for name, value in timings.items()}
+    result["entity_count"] = len(_render_entities(_parse_markdown(text))[1])
+    return result
+
+
+async def _handle_bench(message: Message, args: str):
+    """Benchmarks the single-pass renderer against the previous markdown/BeautifulSoup path."""
+    if args and not args.isdigit():
+        await _send_usage(message, "bench", "[KB]")
+        return
+    size_kb = max(1, min(int(args or 32), 512))
+    iterations = max(3, 256 // size_kb)
+    await message.edit(f"⏱️ 正在测试 {size_kb} KB 回复的渲染性能...", parse_mode='html')
+    result = await asyncio.get_running_loop().run_in_executor(None, _run_render_benchmark, size_kb, iterations)
+    single_pass = result["parse"] + result["entities"] + result["telegraph"]
+    await message.edit(
+        f"<b>渲染基准测试</b> ({size_kb} KB, {iterations} 次平均)\n\n"
+        f"<b>旧路径</b> (markdown → BeautifulSoup → HTML 解析): <code>{result['legacy']:.2f} ms</code>\n"
+        f"<b>单遍渲染</b>: <code>{single_pass:.2f} ms</code>\n"
+        f"  · 解析: <code>{result['parse']:.2f} ms</code>\n"
+        f"  · Telegram 实体: <code>{result['entities']:.2f} ms</code> ({result['entity_count']} 个)\n"
+        f"  · Telegraph 节点: <code>{result['telegraph']:.2f} ms</code>\n"
+        f"<b>加速比:</b> <code>{result['legacy'] / single_pass:.1f}×</code>",
+        parse_mode='html')
+
+
+async def _cache_toggle(message: Message, args: str):
+    is_on = args == "on"
+    db[Config.CACHE_ENABLED] = is_on
+    await message.edit(f"<b>回复缓存已{'启用' if is_on else '禁用'}。</b>", parse_mode='html')
+
+
+async def _cache_stats(message: Message, _):
+    stats = _RESPONSE_CACHE.stats()
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = f"{stats['hits'] / lookups:.0%}" if lookups else "-"
+    text = (
+        "<b>回复缓存:</b>\n\n"
+        f"<b>· 状态:</b> <code>{'启用' if db.get(Config.CACHE_ENABLED) else '禁用'}</code>\n"
+        f"<b>· 条目:</b> <code>{stats['entries']}/{Config.CACHE_MAX_ENTRIES}</code>\n"
+        f"<b>· 字符数:</b> <code>{stats['chars']}</code>\n"
+        f"<b>· 有效期:</b> <code>{db.get(Config.CACHE_TTL, Config.DEFAULT_CACHE_TTL_HOURS)} 小时</code>\n"
+        f"<b>· 本次运行命中:</b> <code>{stats['hits']}/{lookups} ({hit_rate})</code>\n"
+        f"<b>· 已上传文件 (Files API):</b> <code>{_FILE_CACHE.count()}</code>"
+    )
+    await message.edit(text, parse_mode='html')
+
+
+async def _cache_clear(message: Message, _):
+    _RESPONSE_CACHE.clear()
+    await message.edit("<b>回复缓存已清除。</b>", parse_mode='html')
+
+
+async def _cache_ttl(message: Message, args: str):
+    if not args:
+        await _send_usage(message, "cache ttl", "[hours]")
+        return
+    try:
+        hours = int(args)
+        if hours <= 0:
+            await _show_error(message, "有效期必须为正整数。")
+        else:
+            db[Config.CACHE_TTL] = hours
+            await message.edit(f"<b>回复缓存有效期已设置为 {hours} 小时。</b>", parse_mode='html')
+    except ValueError:
+        await _show_error(message, "无效的小时数。")
+
+
+async def _handle_cache(message: Message, args: str):
+    parts = args.split(maxsplit=1)
+    action = parts[0] if parts else None
+    action_args = parts[1] if len(parts) > 1 else ""
+    actions = {"stats": _cache_stats, "clear": _cache_clear, "ttl": _cache_ttl}
+    if action in ("on", "off"):
+        await _cache_toggle(message, action)
+    elif action in actions:
+        await actions[action](message, action_args)
+    else:
+        await _send_usage(message, "cache", "[on|off|stats|clear|ttl]")
+
+
 async def _handle_collapse(message: Message, args: str):
     if args in ["on", "off"]:
         is_on = args == "on"
@@ -759,11 +2183,11 @@ async def _handle_collapse(message: Message, args: str):
         await _send_usage(message, "collapse", "[on|off]")
 
 
-def _build_response_message(prompt_text: str, html_output: str, powered_by: str) -> tuple[str, list]:
-    """Builds the final response text and entities."""
+def _build_response_message(prompt_text: str, rendered: tuple[str, list], powered_by: str) -> tuple[str, list]:
+    """Builds the final response text and entities around a rendered reply."""
     final_text, entities = "", []
     collapsible = db.get(Config.COLLAPSIBLE_QUOTE_ENABLED, False)
-    response_text_formatted, response_entities = tg_html.parse(html_output)
+    response_text_formatted, response_entities = rendered
 
     if prompt_text:
         prompt_header = "👤提示:\n"
@@ -787,11 +2211,10 @@ def _build_response_message(prompt_text: str, html_output: str, powered_by: str)
     return final_text, entities
 
 
-async def _post_to_telegraph_and_reply(message: Message, prompt_text: str, html_output: str, powered_by: str, limit: int):
+async def _post_to_telegraph_and_reply(message: Message, prompt_text: str, tree: list, powered_by: str, limit: int):
     """Handles posting long messages to Telegraph."""
     title = (prompt_text[:15] + '...') if prompt_text and len(prompt_text) > 18 else prompt_text or "Gemini 回复"
-    sanitized_html = _sanitize_html_for_telegraph(html_output)
-    url, error = await _send_to_telegraph(title, sanitized_html)
+    url, error = await _send_to_telegraph(title, _render_telegraph_nodes(tree))
     if url:
         reason = f"超过 {limit} 字符" if limit > 0 else "超过 Telegram 消息最大字符数"
         telegraph_link_text = f"🤖<b>回复:</b>\n<blockquote><b>回复{reason}，已上传到 Telegraph:</b>\n {url}</blockquote>"
@@ -801,14 +2224,15 @@ async def _post_to_telegraph_and_reply(message: Message, prompt_text: str, html_
         await _show_error(message, f"上传到 Telegraph 失败: {error}" if error else "上传到 Telegraph 失败。")
 
 
-async def _send_response(message: Message, prompt_text: str, html_output: str, powered_by: str):
+async def _send_response(message: Message, prompt_text: str, output_text: str, powered_by: str):
     """Formats and sends the final response, handling Telegraph for long messages."""
-    final_text, entities = _build_response_message(prompt_text, html_output, powered_by)
+    tree = _parse_markdown(output_text)
+    final_text, entities = _build_response_message(prompt_text, _render_entities(tree), powered_by)
     telegraph_enabled = db.get(Config.TELEGRAPH_ENABLED)
     telegraph_limit = db.get(Config.TELEGRAPH_LIMIT, 0)
 
     if telegraph_enabled and telegraph_limit > 0 and len(final_text) > telegraph_limit:
-        await _post_to_telegraph_and_reply(message, prompt_text, html_output, powered_by, telegraph_limit)
+        await _post_to_telegraph_and_reply(message, prompt_text, tree, powered_by, telegraph_limit)
         return
 
     try:
@@ -829,11 +2253,51 @@ async def _send_response(message: Message, prompt_text: str, html_output: str, p
         await _show_error(message, "模型返回了空的或无效的回复，无法发送。")
     except MessageTooLongError:
         if telegraph_enabled:
-            await _post_to_telegraph_and_reply(message, prompt_text, html_output, powered_by, 0)
+            await _post_to_telegraph_and_reply(message, prompt_text, tree, powered_by, 0)
         else:
             await _show_error(message, "输出过长。启用 Telegraph 集成以链接形式发送。")
 
 
+class _StreamingEditor:
+    """Progressively edits the message with partial output, at most once per interval."""
+
+    def __init__(self, message: Message, prompt_text: str, powered_by: str):
+        self.message = message
+        self.prompt_text = prompt_text
+        self.powered_by = powered_by
+        self.interval = Config.STREAM_EDIT_INTERVAL
+        self.last_edit = 0.0
+        self.last_text = None
+        self.stopped = False
+
+    async def update(self, text: str):
+        if self.stopped:
+            return
+        loop = asyncio.get_running_loop()
+        if loop.time() - self.last_edit < self.interval:
+            return
+        self.last_edit = loop.time()
+        final_text, entities = _build_response_message(
+            self.prompt_text, _render_entities(_parse_markdown(text)), f"{self.powered_by} · 生成中...")
+        telegraph_limit = db.get(Config.TELEGRAPH_LIMIT, 0) if db.get(Config.TELEGRAPH_ENABLED) else 0
+        max_length = min(telegraph_limit, Config.TELEGRAM_MAX_LENGTH) if telegraph_limit else Config.TELEGRAM_MAX_LENGTH
+        if _get_utf16_length(final_text) > max_length:
+            # The final answer will not fit in a message; stop editing until it is complete.
+            self.stopped = True
+            await self._edit("📝 回复较长，将在生成完成后发送...")
+            return
+        if final_text != self.last_text:
+            self.last_text = final_text
+            await self._edit(final_text, formatting_entities=entities)
+
+    async def _edit(self, text: str, **kwargs):
+        try:
+            await self.message.edit(text, link_preview=False, **kwargs)
+        except Exception:
+            # Usually a flood wait or an unrenderable partial; slow down instead of failing the request.
+            self.interval *= 2
+
+
 async def _execute_gemini_request(message: Message, args: str, use_search: bool):
     """Generic handler for chat and search requests."""
     edit_text = "🔍 正在搜索..." if use_search else "💬 思考中..."
@@ -847,13 +2311,17 @@ async def _execute_gemini_request(message: Message, args: str, use_search: bool)
         await _send_usage(message, "search" if use_search else "", "[query] or reply to a message.")
         return
 
-    output_text = await _call_gemini_api(message, contents, use_search=use_search)
+    prompt_text = await _get_prompt_text_for_display(message, args)
+    streamer = None
+    # Media messages are answered with a new reply, so there is nothing to edit progressively.
+    if db.get(Config.STREAM_ENABLED, True) and not (message.media and not message.web_preview):
+        streamer = _StreamingEditor(message, prompt_text, powered_by)
+    output_text = await _call_gemini_api(message, contents, use_search=use_search,
+                                         on_partial=streamer.update if streamer else None)
     if output_text is None:
         return
 
-    html_output = _format_text_for_telegram(output_text)
-    prompt_text = await _get_prompt_text_for_display(message, args)
-    await _send_response(message, prompt_text, html_output, powered_by)
+    await _send_response(message, prompt_text, output_text, powered_by)
 
 
 async def _handle_search(message: Message, args: str):
@@ -864,6 +2332,86 @@ async def _handle_chat(message: Message, args: str):
     await _execute_gemini_request(message, args, use_search=False)
 
 
+async def _get_batch_inputs(message: Message, args: str) -> tuple[str, list[str]]:
+    """Returns the shared instruction and the batch inputs (one per non-empty line)."""
+    reply = await message.get_reply_message()
+    source = ""
+    if reply and reply.document and reply.file and reply.file.size <= Config.BATCH_MAX_FILE_SIZE and \
+            ((reply.file.mime_type or "").startswith("text/") or (reply.file.name or "").endswith((".txt", ".md"))):
+        data = await reply.download_media(file=bytes)
+        source = data.decode("utf-8", errors="ignore")
+    elif reply and not reply.sticker and reply.text:
+        source = _remove_gemini_footer(reply.text)
+    else:
+        # No reply: every line of the arguments is an input.
+        args, source = "", args
+    return args.strip(), [line.strip() for line in source.splitlines() if line.strip()]
+
+
+async def _handle_batch(message: Message, args: str):
+    """Runs the active chat prompt over many inputs concurrently and collects the answers in input order."""
+    instruction, inputs = await _get_batch_inputs(message, args)
+    if not inputs:
+        await _send_usage(message, "batch", "[instruction] (reply to a message or text file, one input per line)")
+        return
+    if len(inputs) > Config.BATCH_MAX_ITEMS:
+        await _show_error(message, f"最多支持 {Config.BATCH_MAX_ITEMS} 条输入，当前 {len(inputs)} 条。")
+        return
+
+    # Items run quietly, so a missing API key is reported once up front rather than per item.
+    if not await _get_gemini_client(message):
+        return
+
+    total = len(inputs)
+    await message.edit(f"📦 批量处理中 (0/{total})...", parse_mode='html')
+    semaphore = asyncio.Semaphore(Config.BATCH_CONCURRENCY)
+    progress = {"done": 0, "shown": 0.0}
+    loop = asyncio.get_running_loop()
+
+    errors: dict[int, str] = {}
+
+    async def run(index: int, item: str) -> str | None:
+        prompt = f"{instruction}\n\n{item}" if instruction else item
+        answer = None
+        async with semaphore:
+            try:
+                # Quiet calls leave the progress counter alone; errors are collected per item.
+                answer = await _call_gemini_api(message, [prompt], use_search=False, use_context=False, quiet=True)
+            except Exception as e:
+                error = " ".join(str(e).split())
+                errors[index] = f"速率限制 (已自动重试 {Config.MAX_RETRIES} 次): {error}" if _is_rate_limited(e) else error
+        progress["done"] += 1
+        if loop.time() - progress["shown"] >= 2:
+            progress["shown"] = loop.time()
+            await _safe_edit(message, f"📦 批量处理中 ({progress['done']}/{total})...")
+        return answer
+
+    answers = await asyncio.gather(*(run(index, item) for index, item in enumerate(inputs, 1)))
+    failed = answers.count(None)
+    sections = []
+    for index, (item, answer) in enumerate(zip(inputs, answers), 1):
+        title = item if len(item) <= 60 else item[:57] + "..."
+        if answer is None:
+            error = errors.get(index)
+            answer = f"*(生成失败: {error})*" if error else "*(生成失败)*"
+        sections.append(f"### {index}. {title}\n\n{answer}")
+    document = (f"**指令:** {instruction}\n\n---\n\n" if instruction else "") + "\n\n".join(sections)
+    summary = f"<b>批量处理完成:</b> {total - failed}/{total} 条成功"
+
+    if db.get(Config.TELEGRAPH_ENABLED):
+        title = f"Gemini 批量回复 ({total} 条)"
+        url, _ = await _send_to_telegraph(title, _render_telegraph_nodes(_parse_markdown(document)))
+        if url:
+            await message.edit(f"{summary}\n{url}\n<i>Powered by Gemini</i>", parse_mode='html', link_preview=True)
+            return
+    # Telegraph is off or the page was rejected (e.g. over 64KB): send the Markdown as a file instead.
+    stream = io.BytesIO(document.encode("utf-8"))
+    stream.name = "gemini_batch.md"
+    await message.client.send_file(message.chat_id, file=stream, reply_to=message.id,
+                                   caption=f"{summary}\n<i>Powered by Gemini</i>", parse_mode='html')
+    await message.edit(summary, parse_mode='html')
+
+
 async def _handle_image(message: Message, args: str):
     """Handles image generation and editing."""
     await message.edit("🎨 正在生成图片...", parse_mode='html')
@@ -914,55 +2462,38 @@ async def _handle_image(message: Message, args: str):
 
 
 async def _generate_and_send_audio(message: Message, text_to_speak: str, caption_text: str | None = None) -> bool | None:
-    """Generates audio from text, sends it as a voice note, and cleans up. Returns True on success, False on failure, None on API error."""
-    try:
-        audio_path, audio_mime_type = await _call_gemini_tts_api(message, text_to_speak)
-    except ValueError as e:
-        if str(e).startswith("TOKEN_LIMIT_EXCEEDED"):
-            raise e
-        await _show_error(message, f"处理语音生成时发生意外错误: {e}")
-        return False
-    if audio_path is None:
-        return None  # API error was handled
-    if not audio_mime_type:
-        return False  # Should not happen if path is not None, but for safety
-
-    opus_path = f"gemini_tts_{message.id}.ogg"
-    success = False
+    """Generates audio from text and sends it as a voice note. Returns True on success, False on failure, None on API error."""
+    encoder = _OpusVoiceEncoder(message.client)
     try:
-        await message.edit("⚙️ 正在编码为 Opus...", parse_mode='html')
-        params = parse_audio_mime_type(audio_mime_type)
-        ffmpeg_cmd = (
-            f"ffmpeg -f s{params['bits_per_sample']}le -ar {params['rate']} -ac 1 -i {audio_path} "
-            f"-y -c:a libopus {opus_path}"
-        )
-        process = await asyncio.create_subprocess_shell(
-            ffmpeg_cmd,
-            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        _, stderr = await process.communicate()
-        if process.returncode != 0:
-            await _show_error(message, f"FFmpeg 编码失败:\n<pre><code>{html.escape(stderr.decode(errors='ignore').strip())}</code></pre>")
+        try:
+            # Audio is encoded and uploaded while the model is still generating it.
+            result = await _call_gemini_tts_api(message, text_to_speak, encoder.feed)
+        except ValueError as e:
+            if str(e).startswith("TOKEN_LIMIT_EXCEEDED"):
+                raise e
+            await _show_error(message, f"处理语音生成时发生意外错误: {e}")
+            return False
+        if result is None:
+            return None  # API error was handled
+
+        await message.edit("⚙️ 正在完成 Opus 编码与上传...", parse_mode='html')
+        voice_file, error = await encoder.finish()
+        if voice_file is None:
+            await _show_error(message, f"FFmpeg 编码失败:\n<pre><code>{html.escape(error)}</code></pre>")
             return False
 
+        send_kwargs = dict(voice_note=True, reply_to=message.id, parse_mode='html', mime_type="audio/ogg",
+                           attributes=[DocumentAttributeAudio(duration=encoder.duration, voice=True)])
         final_caption = caption_text or "<i>Powered by Gemini TTS</i>"
         try:
-            await message.client.send_file(
-                message.chat_id, file=opus_path, voice_note=True, reply_to=message.id,
-                caption=final_caption, parse_mode='html'
-            )
+            await message.client.send_file(message.chat_id, file=voice_file, caption=final_caption, **send_kwargs)
         except MessageTooLongError:
-            await message.client.send_file(
-                message.chat_id, file=opus_path, voice_note=True, reply_to=message.id,
-                caption="<i>Powered by Gemini TTS</i>", parse_mode='html'
-            )
+            await message.client.send_file(message.chat_id, file=voice_file,
+                                           caption="<i>Powered by Gemini TTS</i>", **send_kwargs)
             await message.reply("回复文本过长，无法作为语音消息的标题发送。")
-        success = True
+        return True
     finally:
-        if os.path.exists(audio_path):
-            os.remove(audio_path)
-        if os.path.exists(opus_path):
-            os.remove(opus_path)
-    return success
+        encoder.close()
 
 
 async def _handle_tts(message: Message, args: str):
@@ -983,7 +2514,7 @@ async def _handle_tts(message: Message, args: str):
     except ValueError as e:
         if str(e).startswith("TOKEN_LIMIT_EXCEEDED"):
             total_tokens = str(e).split(":")[1].strip()
-            await _show_error(message, f"文本超过 1500 tokens 限制 ({total_tokens} tokens)，无法生成语音。")
+            await _show_error(message, f"文本超过语音长度限制 (约 {total_tokens} tokens)，无法生成语音。")
         else:
             await _show_error(message, f"发生意外错误: {e}")
 
@@ -1017,7 +2548,7 @@ async def _execute_audio_request(message: Message, args: str, use_search: bool):
     except ValueError as e:
         if str(e).startswith("TOKEN_LIMIT_EXCEEDED"):
             total_tokens = str(e).split(":")[1].strip()
-            fallback_reason = f"文本超过 1500 tokens 限制 ({total_tokens} tokens)。"
+            fallback_reason = f"文本超过语音长度限制 (约 {total_tokens} tokens)。"
             tts_result = False
         else:
             raise e
@@ -1027,9 +2558,8 @@ async def _execute_audio_request(message: Message, args: str, use_search: bool):
     elif tts_result is False:
         fallback_message = fallback_reason or "语音生成失败。"
         await message.edit(f"{fallback_message} 将以文本形式发送回复。", parse_mode='html')
-        html_output = _format_text_for_telegram(output_text)
         prompt_text = await _get_prompt_text_for_display(message, args)
-        await _send_response(message, prompt_text, html_output, powered_by)
+        await _send_response(message, prompt_text, output_text, powered_by)
     # if tts_result is None, do nothing as the error is already displayed.
 
 
@@ -1053,14 +2583,18 @@ Google Gemini AI 插件。需要 PagerMaid-Modify 1.5.8 及以上版本。
 - `gemini search_audio [query]`: 获取搜索结果并转换为语音。
 - `gemini tts [text]`: 将文本转换为语音。需要安装 ffmpeg。
 - `gemini image [prompt]`: 生成或编辑图片。
+- `gemini batch [指令]`: 回复一条消息或文本文件，对其中每一行并发执行 (可附加统一指令)，按原顺序汇总到 Telegraph 页面或文档。
 
 设置:
 - `gemini settings`: 显示当前配置。
 - `gemini set_api_key [key]`: 设置您的 Gemini API 密钥。
 - `gemini set_base_url [url]`: 设置自定义 Gemini API 基础 URL。留空以清除。
 - `gemini max_tokens [number]`: 设置最大输出 token 数 (0 表示无限制)。
+- `gemini rate_limit [number]`: 设置每个 API 密钥每分钟的最大请求数 (0 表示无限制)。遇到 429 时会自动退避重试。
 - `gemini tts_voice [name]`: 设置 TTS 语音。尝试不同语音: https://aistudio.google.com/generate-speech
 - `gemini collapse [on|off]`: 开启或关闭折叠引用。
+- `gemini stream [on|off]`: 开启或关闭流式输出 (边生成边更新消息)。
+- `gemini bench [KB]`: 测试长回复的渲染性能 (单遍渲染与旧的 markdown/BeautifulSoup 路径对比)。
 
 模型管理:
 - `gemini model list`: 列出可用模型。
@@ -1074,8 +2608,16 @@ Google Gemini AI 插件。需要 PagerMaid-Modify 1.5.8 及以上版本。
 
 上下文管理:
 - `gemini context [on|off]`: 开启或关闭对话上下文。
-- `gemini context clear`: 清除对话历史。
-- `gemini context show`: 显示对话历史。
+- `gemini context clear [all]`: 清除当前对话 (或所有对话) 的历史。
+- `gemini context show`: 显示当前对话的历史。
+- `gemini context budget [tokens]`: 设置每个对话的 token 预算，超出后较早的内容会被压缩为摘要。
+- 较大的文件 (≥1MB) 以及上下文模式下的文件通过 Gemini Files API 上传一次并缓存，之后针对同一文件的提问不再重复上传。
+
+回复缓存:
+- `gemini cache [on|off]`: 开启或关闭回复缓存 (相同模型、提示与内容直接返回缓存的回复，上下文模式下自动跳过)。
+- `gemini cache stats`: 显示缓存条目数与命中率。
+- `gemini cache clear`: 清除所有缓存的回复。
+- `gemini cache ttl [hours]`: 设置缓存有效期 (小时)。
 
 Telegraph 集成:
 - `gemini telegraph [on|off]`: 开启或关闭 Telegraph 集成。
@@ -1094,12 +2636,14 @@ async def gemini(message: Message):
 
     handlers = {
         "set_api_key": _handle_set_api_key, "set_base_url": _handle_set_base_url,
-        "settings": _handle_settings, "max_tokens": _handle_max_tokens,
+        "settings": _handle_settings, "max_tokens": _handle_max_tokens, "rate_limit": _handle_rate_limit,
         "model": _handle_model, "tts_voice": _handle_tts_voice,
         "prompt": _handle_prompt, "search": _handle_search,
         "tts": _handle_tts, "image": _handle_image,
         "context": _handle_context, "telegraph": _handle_telegraph,
-        "collapse": _handle_collapse, "_audio": _handle_audio,
+        "collapse": _handle_collapse, "stream": _handle_stream, "cache": _handle_cache,
+        "bench": _handle_bench, "batch": _handle_batch,
+        "_audio": _handle_audio,
         "search_audio": _handle_search_audio,
     }
 
@@ -74,6 +74,77 @@ HELP_TEXT = """📢 智能转发助手使用说明
 """
 
 
+class ShiftRule:
+    """编译后的转发规则，供每条消息的热路径直接使用"""
+
+    __slots__ = ("target_id", "paused", "options", "filters")
+
+    def __init__(self, data: dict):
+        self.target_id = int(data["target_id"]) if data.get("target_id") else None
+        self.paused = bool(data.get("paused", False))
+        options = data.get("options") or []
+        # None 表示接受全部消息类型
+        self.options = None if "all" in options or not options else frozenset(options)
+        self.filters = tuple(keyword.lower() for keyword in data.get("filters", []) if keyword)
+
+    def is_filtered(self, text: Optional[str]) -> bool:
+        if not self.filters or not text:
+            return False
+        text = text.lower()
+        return any(keyword in text for keyword in self.filters)
+
+    def accepts(self, message_type: str) -> bool:
+        return self.options is None or message_type in self.options
+
+
+# source_id -> ShiftRule，首次使用时从数据库加载，之后由各子命令同步更新
+_rules: Dict[int, ShiftRule] = {}
+_rules_loaded = False
+
+
+def is_rule_key(key: str) -> bool:
+    return key.startswith("shift.") and key.count(".") == 1
+
+
+def compile_rule(key: str):
+    """从数据库重新编译单条规则，规则不存在或已损坏时从内存表移除"""
+    try:
+        source_id = int(key[6:])
+    except ValueError:
+        return
+    rule_str = sqlite.get(key)
+    try:
+        _rules[source_id] = ShiftRule(json.loads(rule_str))
+    except (TypeError, ValueError, KeyError):
+        if rule_str:
+            logs.error(f"[SHIFT] 规则解析失败: {rule_str}")
+        _rules.pop(source_id, None)
+
+
+def load_rules():
+    global _rules_loaded
+    _rules.clear()
+    for key in [k for k in sqlite if is_rule_key(k)]:
+        compile_rule(key)
+    _rules_loaded = True
+
+
+def get_rule(source_id: int) -> Optional[ShiftRule]:
+    if not _rules_loaded:
+        load_rules()
+    return _rules.get(source_id)
+
+
+def save_rule(key: str, rule: dict):
+    sqlite[key] = json.dumps(rule)
+    compile_rule(key)
+
+
+def remove_rule(key: str):
+    sqlite.pop(key, None)
+    _rules.pop(int(key[6:]), None)
+
+
 def check_source_available(chat):
     assert isinstance(chat, (Channel, Chat)) and not getattr(chat, "noforwards", False)
 
@@ -90,17 +161,11 @@ def is_circular_forward(source_id: int, target_id: int) -> (bool, str):
     for _ in range(20):
         if current_id in visited:
             return True, f"检测到间接循环：{current_id}"
-        rule_str = sqlite.get(f"shift.{current_id}")
-        if not rule_str:
-            break
-        try:
-            next_id = int(json.loads(rule_str).get("target_id", -1))
-            if next_id == -1:
-                break
-            visited.add(current_id)
-            current_id = next_id
-        except (json.JSONDecodeError, KeyError, ValueError):
+        rule = get_rule(current_id)
+        if not rule or rule.target_id is None:
             break
+        visited.add(current_id)
+        current_id = rule.target_id
     return False, ""
 
 
@@ -159,19 +224,6 @@ def update_stats(source_id: int, target_id: int, message_type: str):
     sqlite[stats_key] = json.dumps(stats)
 
 
-def is_message_filtered(message: Message, source_id: int) -> bool:
-    rule_str = sqlite.get(f"shift.{source_id}")
-    if not rule_str:
-        return False
-    try:
-        keywords = json.loads(rule_str).get("filters", [])
-        if not keywords or not message.text:
-            return False
-        return any(keyword.lower() in message.text.lower() for keyword in keywords)
-    except (json.JSONDecodeError, KeyError):
-        return False
-
-
 async def resolve_target(client, target_input: str, current_chat_id: int):
     if target_input.lower() in ["me", "here"]:
         return await client.get_entity(current_chat_id)
@@ -243,7 +295,7 @@ async def shift_func_set(message: Message):
         "created_at": datetime.datetime.now().isoformat(),
         "filters": [],
     }
-    sqlite[f"shift.{source_id}"] = json.dumps(rule)
+    save_rule(f"shift.{source_id}", rule)
     logs.info(f"[SHIFT] 成功设置转发: {source_id} -> {target_id}")
     await message.edit(
         f"成功设置转发: {get_display_name(source)} -> {get_display_name(target)}"
@@ -295,13 +347,13 @@ async def shift_func_del(message: Message):
     if len(message.parameter) < 2:
         return await message.edit("请提供序号")
     all_shifts = sorted(
-        [k for k in sqlite if k.startswith("shift.") and k.count(".") == 1]
+        [k for k in sqlite if is_rule_key(k)]
     )
     indices, invalid = parse_indices(message.parameter[1], len(all_shifts))
     deleted_count = 0
     for index in sorted(indices, reverse=True):
         key = all_shifts.pop(index)
-        del sqlite[key]
+        remove_rule(key)
         deleted_count += 1
     msg = f"成功删除 {deleted_count} 条规则。"
     if invalid:
@@ -348,7 +400,7 @@ async def shift_func_stats(message: Message):
 @shift_func.sub_command(command="list")
 async def shift_func_list(message: Message):
     all_shifts = sorted(
-        [k for k in sqlite if k.startswith("shift.") and k.count(".") == 1]
+        [k for k in sqlite if is_rule_key(k)]
     )
     if not all_shifts:
         return await message.edit(
@@ -467,7 +519,7 @@ async def toggle_pause_resume(message: Message, pause: bool):
     if len(message.parameter) < 2:
         return await message.edit("请提供序号")
     all_shifts = sorted(
-        [k for k in sqlite if k.startswith("shift.") and k.count(".") == 1]
+        [k for k in sqlite if is_rule_key(k)]
     )
     indices, invalid = parse_indices(message.parameter[1], len(all_shifts))
     count = 0
@@ -475,7 +527,7 @@ async def toggle_pause_resume(message: Message, pause: bool):
         try:
             rule = json.loads(sqlite[all_shifts[index]])
             rule["paused"] = pause
-            sqlite[all_shifts[index]] = json.dumps(rule)
+            save_rule(all_shifts[index], rule)
             count += 1
         except (IndexError, json.JSONDecodeError):
             pass
@@ -497,7 +549,7 @@ async def shift_func_filter(message: Message):
         message.parameter[3:],
     )
     all_shifts = sorted(
-        [k for k in sqlite if k.startswith("shift.") and k.count(".") == 1]
+        [k for k in sqlite if is_rule_key(k)]
     )
     indices, _ = parse_indices(indices_str, len(all_shifts))
 
@@ -529,7 +581,7 @@ async def shift_func_filter(message: Message):
                 return
 
             rule["filters"] = list(filters)
-            sqlite[key] = json.dumps(rule)
+            save_rule(key, rule)
         except (IndexError, json.JSONDecodeError) as e:
             continue
 
@@ -600,7 +652,7 @@ def get_chat_id_from_message(message: Message) -> int:
 )
 async def shift_channel_message(message: Message):
     try:
-        if not message or not message.chat:
+        if not message:
             return
 
         # 获取标准化的source_id
@@ -608,51 +660,37 @@ async def shift_channel_message(message: Message):
         if not source_id:
             return
 
-        logs.debug(f"[SHIFT] 收到消息: source_id={source_id}, msg_id={message.id}")
-
-        # 检查转发规则
-        rule_str = sqlite.get(f"shift.{source_id}")
-        if not rule_str:
-            return
-
-        try:
-            rule = json.loads(rule_str)
-        except json.JSONDecodeError:
-            logs.error(f"[SHIFT] 规则解析失败: {rule_str}")
-            return
-
-        # 检查规则状态
-        if rule.get("paused", False):
+        # 检查转发规则（内存表，无规则的对话只需一次字典查找）
+        rule = get_rule(source_id)
+        if not rule or rule.paused or rule.target_id is None or not message.chat:
             return
 
-        target_id = rule.get("target_id")
-        if not target_id:
-            return
+        logs.debug(f"[SHIFT] 收到消息: source_id={source_id}, msg_id={message.id}")
+        target_id = rule.target_id
 
         # 检查内容保护
         if hasattr(message.chat, "noforwards") and message.chat.noforwards:
             logs.warning(f"[SHIFT] 源聊天 {source_id} 开启了内容保护，删除转发规则")
-            sqlite.pop(f"shift.{source_id}", None)
+            remove_rule(f"shift.{source_id}")
             return
 
         # 检查消息过滤
-        if is_message_filtered(message, source_id):
+        if rule.is_filtered(message.text):
             logs.debug(f"[SHIFT] 消息被过滤: {source_id}")
             return
 
         # 检查消息类型
-        options = rule.get("options", [])
         message_type = get_media_type(message)
-        if options and "all" not in options and message_type not in options:
-            logs.debug(f"[SHIFT] 消息类型不匹配: {message_type} not in {options}")
+        if not rule.accepts(message_type):
+            logs.debug(f"[SHIFT] 消息类型不匹配: {message_type} not in {sorted(rule.options)}")
             return
 
         # 执行转发
         logs.info(f"[SHIFT] 开始转发: {source_id} -> {target_id}, msg={message.id}")
-        await shift_forward_message(source_id, int(target_id), message.id)
+        await shift_forward_message(source_id, target_id, message.id)
 
         # 更新统计
-        update_stats(source_id, int(target_id), message_type)
+        update_stats(source_id, target_id, message_type)
 
     except Exception as e:
         logs.error(f"[SHIFT] 处理消息时出错: {e}")
@@ -678,12 +716,11 @@ async def shift_forward_message(
         )
 
         # 检查目标是否有下级转发规则
-        next_rule_str = sqlite.get(f"shift.{to_chat_id}")
-        if next_rule_str:
+        next_rule = get_rule(to_chat_id)
+        if next_rule:
             try:
-                next_rule = json.loads(next_rule_str)
-                if not next_rule.get("paused") and next_rule.get("target_id"):
-                    next_target_id = int(next_rule["target_id"])
+                if not next_rule.paused and next_rule.target_id is not None:
+                    next_target_id = next_rule.target_id
 
                     # 短暂延迟，确保消息已送达
                     await sleep(0.2)